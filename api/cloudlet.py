@@ -17,8 +17,9 @@ import webob
 from urlparse import urlsplit
 
 from nova.compute import API
-from nova.compute import HostAPI
 from nova.compute.cloudlet_api import CloudletAPI as CloudletAPI
+from nova.compute.cloudlet_api import HandoffError
+from nova.compute.cloudlet_api import OverlayMismatchError
 from nova import exception
 from nova.api.openstack import extensions
 from nova.api.openstack import wsgi
@@ -51,7 +52,93 @@ class Cloudlet(extensions.ExtensionDescriptor):
     def get_controller_extensions(self):
         servers_extension = extensions.ControllerExtension(
             self, 'servers', CloudletController())
-        return [servers_extension]
+        images_extension = extensions.ControllerExtension(
+            self, 'images', CloudletImageController())
+        return [servers_extension, images_extension]
+
+    def get_resources(self):
+        handoff_sessions = extensions.ResourceExtension(
+            'os-cloudlet-handoff-sessions', CloudletHandoffSessionController())
+        bases = extensions.ResourceExtension(
+            'os-cloudlet-bases', CloudletBaseController())
+        base_jobs = extensions.ResourceExtension(
+            'os-cloudlet-base-jobs', CloudletBaseJobController())
+        return [handoff_sessions, bases, base_jobs]
+
+
+class CloudletBaseJobController(wsgi.Controller):
+
+    """Poll progress of asynchronous cloudlet base creation"""
+
+    def __init__(self, *args, **kwargs):
+        super(CloudletBaseJobController, self).__init__(*args, **kwargs)
+        self.cloudlet_api = CloudletAPI()
+
+    def show(self, req, id):
+        context = req.environ['nova.context']
+        authorize(context)
+        job = self.cloudlet_api.cloudlet_base_job_status(context, id)
+        if job is None:
+            msg = _("Base VM creation job not found")
+            raise webob.exc.HTTPNotFound(explanation=msg)
+        return {'base-job': job}
+
+
+class CloudletBaseController(wsgi.Controller):
+
+    """Look up base VMs by their base_sha256_uuid
+    so that clients and peer cloudlets do not need to list all images
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CloudletBaseController, self).__init__(*args, **kwargs)
+        self.cloudlet_api = CloudletAPI()
+
+    def index(self, req):
+        context = req.environ['nova.context']
+        authorize(context)
+        return {'bases': self.cloudlet_api.get_basevm_list(context)}
+
+    def show(self, req, id):
+        context = req.environ['nova.context']
+        authorize(context)
+        basevm_info = self.cloudlet_api.get_basevm(context, id)
+        if basevm_info is None:
+            msg = _("Base VM not found")
+            raise webob.exc.HTTPNotFound(explanation=msg)
+        return {'base': basevm_info}
+
+
+class CloudletHandoffSessionController(wsgi.Controller):
+
+    """List port forwarding sessions of incoming VM handoff
+    handled by this API worker
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CloudletHandoffSessionController, self).__init__(*args, **kwargs)
+        self.cloudlet_api = CloudletAPI()
+
+    def index(self, req):
+        context = req.environ['nova.context']
+        authorize(context)
+        sessions = self.cloudlet_api.handoff_forwarding_sessions()
+        return {'handoff_sessions': sessions}
+
+
+class CloudletImageController(wsgi.Controller):
+
+    """Drop the base VM index when an image is deleted"""
+
+    def __init__(self, *args, **kwargs):
+        super(CloudletImageController, self).__init__(*args, **kwargs)
+        self.cloudlet_api = CloudletAPI()
+
+    @wsgi.extends
+    def delete(self, req, id):
+        context = req.environ['nova.context']
+        yield
+        self.cloudlet_api.invalidate_basevm_index(context)
 
 
 class CloudletController(wsgi.Controller):
@@ -59,7 +146,6 @@ class CloudletController(wsgi.Controller):
     def __init__(self, *args, **kwargs):
         super(CloudletController, self).__init__(*args, **kwargs)
         self.cloudlet_api = CloudletAPI()
-        self.host_api = HostAPI()
         self.compute_api = API()
 
     def _get_instance(self, context, instance_id, want_objects=False):
@@ -80,54 +166,59 @@ class CloudletController(wsgi.Controller):
         LOG.debug("return handoff information")
         if 'server' not in resp_obj.obj:
             return
-        compute_nodes = self.host_api.compute_node_get_all(context)
         instance_id = resp_obj.obj['server'].get('id', None)
 
-        # wait until the VM instance is scheduled to the compute node
-        # Need fix: seperate one API into two; one for assigning VM to compute
-        # node, the other for setting up port forwarding
-        repeat_count = 0
-        MAX_COUNT = 30
-        while repeat_count < MAX_COUNT:
-            instance = self.compute_api.get(context, instance_id)
-            instance_hostname = instance.get('node', None)
-            if instance_hostname is None:
-                import time
-                time.sleep(0.1)
-                msg = "waiting for VM scheduling %d/%d..."\
-                    % (repeat_count, MAX_COUNT)
-                LOG.debug(msg)
-                repeat_count += 1
-            else:
-                break
-
-        dest_ip = None
-        for node in compute_nodes:
-            node_name = node.get('hypervisor_hostname', None)
-            if str(node_name) == str(instance_hostname):
-                dest_ip = node.get('host_ip', None)
-
-        # set port forwarding
-        if dest_ip:
-            LOG.debug("return port forwarding information")
+        # Do not wait for the VM instance to be scheduled. The listening port
+        # is returned now and forwarding is attached to the compute node
+        # once the instance is placed.
+        try:
             dest_port = 8022
-            source_port = self.cloudlet_api.handoff_port_forwarding(
-                dest_ip, dest_port
-            )
-            server_url = resp_obj.obj['server']['links'][0]['href']
-            server_ipaddr = urlsplit(server_url).netloc.split(":")[0]
-            resp_obj.obj['handoff'] = {
-                "server_ip": str(server_ipaddr),
-                "server_port": int(source_port),
-            }
-        else:
+            session = self.cloudlet_api.handoff_port_forwarding_async(
+                context, instance_id, dest_port)
+        except HandoffError as e:
+            LOG.warning("cannot setup port forwarding: %s" % str(e))
             resp_obj.obj['handoff'] = {
                 "error": "cannot setup port forwarding"
             }
+            return
+        server_url = resp_obj.obj['server']['links'][0]['href']
+        server_ipaddr = urlsplit(server_url).netloc.split(":")[0]
+        resp_obj.obj['handoff'] = {
+            "session_id": session.id,
+            "server_ip": str(server_ipaddr),
+            "server_port": int(session.source_port),
+        }
+
+    def _validate_overlay(self, context, body):
+        server = body['server']
+        image_ref = server.get('imageRef', None)
+        if not image_ref:
+            return
+        image_id = str(image_ref).rstrip("/").rsplit("/", 1)[-1]
+        try:
+            self.cloudlet_api.validate_overlay(
+                context, image_id, server['metadata']['overlay_url'])
+        except OverlayMismatchError as e:
+            msg = _("Cannot synthesize overlay: %s") % str(e)
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        except exception.ImageNotFound as e:
+            raise webob.exc.HTTPBadRequest(explanation=e.format_message())
 
     @wsgi.extends
     def create(self, req, body):
         context = req.environ['nova.context']
+        if 'server' in body and 'metadata' in body['server']:
+            metadata = body['server']['metadata']
+            if ('overlay_url' in metadata) and ('handoff_info' not in metadata):
+                # reject incompatible overlay before creating the instance
+                self._validate_overlay(context, body)
+                # synthesize from the copy in glance if it was imported
+                imported_url = self.cloudlet_api.get_imported_overlay_url(
+                    context, metadata['overlay_url'])
+                if imported_url is not None:
+                    LOG.info(_("Use imported overlay %s for %s") %
+                             (imported_url, metadata['overlay_url']))
+                    metadata['overlay_url'] = imported_url
         resp_obj = (yield)
         if 'server' in body and 'metadata' in body['server']:
             metadata = body['server']['metadata']
@@ -153,9 +244,9 @@ class CloudletController(wsgi.Controller):
 
         LOG.info(_("Importing base VM %r..."), id)
         instance = self._get_instance(context, id, want_objects=True)
-        disk_meta, memory_meta = self.cloudlet_api.cloudlet_create_base(
+        base_job = self.cloudlet_api.cloudlet_create_base(
             context, instance, baseVM_name)
-        return {'base-disk': disk_meta, 'base-memory': memory_meta}
+        return base_job
 
     @wsgi.action('cloudlet-overlay-finish')
     def cloudlet_overlay_finish(self, req, id, body):
@@ -178,6 +269,29 @@ class CloudletController(wsgi.Controller):
             overlay_name)
         return {'overlay-id': overlay_id}
 
+    @wsgi.action('cloudlet-overlay-checkpoint')
+    def cloudlet_overlay_checkpoint(self, req, id, body):
+        """Generate overlay VM from the requested instance
+        and keep the instance running
+        """
+        context = req.environ['nova.context']
+
+        overlay_name = ''
+        if body['cloudlet-overlay-checkpoint'] and \
+                'overlay-name' in body['cloudlet-overlay-checkpoint']:
+            overlay_name = body['cloudlet-overlay-checkpoint']['overlay-name']
+        else:
+            msg = _("Overlay name required.")
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+
+        LOG.info(_("Checkpointing overlay VM %r..."), id)
+        instance = self._get_instance(context, id, want_objects=True)
+        overlay_id = self.cloudlet_api.cloudlet_create_overlay_checkpoint(
+            context,
+            instance,
+            overlay_name)
+        return {'overlay-id': overlay_id}
+
     @wsgi.action('cloudlet-handoff')
     def cloudlet_handoff(self, req, id, body):
         """Perform VM migration across OpenStack
@@ -16,12 +16,23 @@
 #   limitations under the License.
 #
 
+import collections
+import copy
 import eventlet
+import os
+import socket
 import threading
+import time
+import urllib2
+import uuid
+from eventlet import event
+from eventlet import semaphore
 from urlparse import urlparse
 from urlparse import urlsplit
-import httplib
+from nova import exception
 from nova import image as image
+from nova.compute import cloudlet_http
+from nova.compute import cloudlet_overlay
 from nova.compute import api as nova_api
 from nova.compute import rpcapi as nova_rpc
 from nova.compute import vm_states
@@ -39,19 +50,82 @@ except ImportError as e:
     # kilo
     from oslo_serialization import jsonutils
 
+from hashlib import sha1
 from hashlib import sha256
 
+try:
+    from elijah.provisioning import msgpack
+except ImportError as e:
+    try:
+        import msgpack
+    except ImportError as e:
+        # overlays are validated only at the compute node
+        msgpack = None
+
 import logging
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 CONF.import_opt('reclaim_instance_interval', 'nova.compute.cloudlet_manager')
 
+cloudlet_handoff_opts = [
+    cfg.IntOpt('cloudlet_handoff_port_min',
+               default=19000,
+               help='First port used for handoff port forwarding'),
+    cfg.IntOpt('cloudlet_handoff_port_max',
+               default=19099,
+               help='Last port used for handoff port forwarding'),
+    cfg.IntOpt('cloudlet_handoff_max_sessions',
+               default=8,
+               help='Maximum number of concurrently forwarding handoff '
+                    'sessions. Others are queued until a slot is free'),
+    cfg.IntOpt('cloudlet_handoff_accept_timeout',
+               default=60,
+               help='Seconds to wait for the handoff source to connect'),
+    cfg.IntOpt('cloudlet_handoff_idle_timeout',
+               default=300,
+               help='Seconds after which an idle or queued handoff '
+                    'forwarding session is closed'),
+    cfg.IntOpt('cloudlet_handoff_reap_interval',
+               default=10,
+               help='Interval in seconds to clean up expired handoff '
+                    'forwarding sessions'),
+    cfg.IntOpt('cloudlet_handoff_catalog_ttl',
+               default=300,
+               help='Seconds to cache base VM and flavor lookups of '
+                    'handoff destinations'),
+    cfg.IntOpt('cloudlet_http_max_connections',
+               default=4,
+               help='Maximum number of kept-alive connections to a '
+                    'destination cloudlet'),
+    cfg.IntOpt('cloudlet_http_timeout',
+               default=60,
+               help='Timeout in seconds of requests to a destination '
+                    'cloudlet'),
+    cfg.IntOpt('cloudlet_basevm_index_ttl',
+               default=60,
+               help='Seconds before the base VM index of a project is '
+                    'reloaded from glance'),
+    cfg.IntOpt('cloudlet_host_ip_cache_ttl',
+               default=600,
+               help='Seconds to cache the IP addresses of compute nodes'),
+    cfg.BoolOpt('cloudlet_overlay_import',
+                default=True,
+                help='Import external VM overlays into glance on their '
+                     'first use and synthesize later requests of the same '
+                     'URL from glance'),
+]
+CONF.register_opts(cloudlet_handoff_opts)
+
 
 class HandoffError(Exception):
     pass
 
 
+class OverlayMismatchError(Exception):
+    pass
+
+
 class CloudletAPI(nova_rpc.ComputeAPI):
 
     PROPERTY_KEY_CLOUDLET = "is_cloudlet"
@@ -59,12 +133,28 @@ class CloudletAPI(nova_rpc.ComputeAPI):
     PROPERTY_KEY_NETWORK_INFO = "network"
     PROPERTY_KEY_BASE_UUID = "base_sha256_uuid"
     PROPERTY_KEY_BASE_RESOURCE = "base_resource_xml_str"
+    PROPERTY_KEY_BASE_JOB_ID = "cloudlet_base_job_id"
+    PROPERTY_KEY_BASE_JOB_ERROR = "cloudlet_base_job_error"
+    PROPERTY_KEY_BASE_VIRTUAL_SIZE = "cloudlet_base_virtual_size"
+    # sha1 of the overlay URL
+    PROPERTY_KEY_OVERLAY_HASH = "cloudlet_overlay_hash"
+    # ETag, or Last-Modified and Content-Length of an imported overlay
+    PROPERTY_KEY_OVERLAY_VALIDATOR = "cloudlet_overlay_validator"
+    PROPERTY_KEY_RESIDUE_SIZE = "cloudlet_residue_size"
+    PROPERTY_KEY_RESIDUE_UPLOAD_BPS = "cloudlet_residue_upload_bps"
+    # cache inventory in the stats of a compute node
+    STATS_KEY_CACHE = "cloudlet_cache"
 
     IMAGE_TYPE_BASE_DISK = "cloudlet_base_disk"
     IMAGE_TYPE_BASE_MEM = "cloudlet_base_memory"
     IMAGE_TYPE_BASE_DISK_HASH = "cloudlet_base_disk_hash"
     IMAGE_TYPE_BASE_MEM_HASH = "cloudlet_base_memory_hash"
     IMAGE_TYPE_OVERLAY = "cloudlet_overlay"
+    IMAGE_TYPE_WORKING_SET = "cloudlet_working_set"
+
+    # defined at elijah Const and duplicated for the API server
+    OVERLAY_META = "overlay-meta"
+    META_BASE_VM_SHA256 = "base_vm_sha256"
 
     INSTANCE_TYPE_RESUMED_BASE = "cloudlet_resumed_base_instance"
     INSTANCE_TYPE_SYNTHESIZED_VM = "cloudlet_synthesized_vm"
@@ -76,9 +166,25 @@ class CloudletAPI(nova_rpc.ComputeAPI):
         super(CloudletAPI, self).__init__()
         self.nova_api = nova_api.API()
         self.image_api = image.API()
+        self.compute_node_ips = ComputeNodeAddressCache()
+        cloudlet_http.configure(
+            max_connections_per_host=CONF.cloudlet_http_max_connections,
+            timeout=CONF.cloudlet_http_timeout)
+
+    def _get_image_api_ref(self):
+        if hasattr(self.nova_api, "image_service"):
+            # icehouse
+            return self.nova_api.image_service
+        else:
+            # kilo
+            return self.image_api
+
+    def _get_instance_image_metadata(self, context, instance):
+        return compute_utils.get_image_metadata(
+            context, self._get_image_api_ref(), instance.image_ref, instance)
 
     def _cloudlet_create_image(self, context, instance, name, image_type,
-                               extra_properties=None):
+                               extra_properties=None, image_meta=None):
         """Create new image entry in the image service.  This new image
         will be reserved for the compute manager to upload a snapshot
         or backup.
@@ -88,6 +194,7 @@ class CloudletAPI(nova_rpc.ComputeAPI):
         :param name: string for name of the snapshot
         :param image_type: snapshot | backup
         :param extra_properties: dict of extra image properties to include
+        :param image_meta: metadata of the instance image if already fetched
         """
         if extra_properties is None:
             extra_properties = {}
@@ -97,17 +204,11 @@ class CloudletAPI(nova_rpc.ComputeAPI):
             'user_id': str(context.user_id),
             'image_type': image_type,
         }
-        image_ref = instance.image_ref
-
-        if hasattr(self.nova_api, "image_service"):
-            # icehouse
-            image_api_ref = self.nova_api.image_service
+        image_api_ref = self._get_image_api_ref()
+        if image_meta is None:
+            sent_meta = self._get_instance_image_metadata(context, instance)
         else:
-            # kilo
-            image_api_ref = self.image_api
-
-        sent_meta = compute_utils.get_image_metadata(
-            context, image_api_ref, image_ref, instance)
+            sent_meta = copy.deepcopy(image_meta)
         sent_meta['name'] = name
         sent_meta['is_public'] = False
         # The properties set up above and in extra_properties have precedence
@@ -119,9 +220,15 @@ class CloudletAPI(nova_rpc.ComputeAPI):
     @nova_api.check_instance_state(vm_state=[vm_states.ACTIVE])
     def cloudlet_create_base(self, context, instance, base_name,
                              extra_properties=None):
+        # look up network info while fetching the image metadata shared by
+        # all the reserved images
+        pool = eventlet.GreenPool()
+        vifs_thread = pool.spawn(
+            self.nova_api.network_api.get_vifs_by_instance, context, instance)
+        image_meta = self._get_instance_image_metadata(context, instance)
+
         # add network info
-        vifs = self.nova_api.network_api.get_vifs_by_instance(context,
-                                                              instance)
+        vifs = vifs_thread.wait()
         net_info = []
         for vif in vifs:
             vif_info = {'id': vif['uuid'], 'mac_address': vif['address']}
@@ -129,31 +236,36 @@ class CloudletAPI(nova_rpc.ComputeAPI):
 
         # add instance resource info
         base_sha256_uuid = sha256(str(instance['uuid'])).hexdigest()
+        job_id = uuid.uuid4().hex
 
         disk_properties = {
             CloudletAPI.PROPERTY_KEY_CLOUDLET: True,
             CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
             CloudletAPI.IMAGE_TYPE_BASE_DISK,
             CloudletAPI.PROPERTY_KEY_NETWORK_INFO: net_info,
-            CloudletAPI.PROPERTY_KEY_BASE_UUID: base_sha256_uuid, }
+            CloudletAPI.PROPERTY_KEY_BASE_UUID: base_sha256_uuid,
+            CloudletAPI.PROPERTY_KEY_BASE_JOB_ID: job_id, }
         mem_properties = {
             CloudletAPI.PROPERTY_KEY_CLOUDLET: True,
             CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
             CloudletAPI.IMAGE_TYPE_BASE_MEM,
             CloudletAPI.PROPERTY_KEY_NETWORK_INFO: net_info,
-            CloudletAPI.PROPERTY_KEY_BASE_UUID: base_sha256_uuid, }
+            CloudletAPI.PROPERTY_KEY_BASE_UUID: base_sha256_uuid,
+            CloudletAPI.PROPERTY_KEY_BASE_JOB_ID: job_id, }
         diskhash_properties = {
             CloudletAPI.PROPERTY_KEY_CLOUDLET: True,
             CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
             CloudletAPI.IMAGE_TYPE_BASE_DISK_HASH,
             CloudletAPI.PROPERTY_KEY_NETWORK_INFO: net_info,
-            CloudletAPI.PROPERTY_KEY_BASE_UUID: base_sha256_uuid, }
+            CloudletAPI.PROPERTY_KEY_BASE_UUID: base_sha256_uuid,
+            CloudletAPI.PROPERTY_KEY_BASE_JOB_ID: job_id, }
         memhash_properties = {
             CloudletAPI.PROPERTY_KEY_CLOUDLET: True,
             CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
             CloudletAPI.IMAGE_TYPE_BASE_MEM_HASH,
             CloudletAPI.PROPERTY_KEY_NETWORK_INFO: net_info,
-            CloudletAPI.PROPERTY_KEY_BASE_UUID: base_sha256_uuid, }
+            CloudletAPI.PROPERTY_KEY_BASE_UUID: base_sha256_uuid,
+            CloudletAPI.PROPERTY_KEY_BASE_JOB_ID: job_id, }
         disk_properties.update(extra_properties or {})
         mem_properties.update(extra_properties or {})
         diskhash_properties.update(extra_properties or {})
@@ -165,15 +277,21 @@ class CloudletAPI(nova_rpc.ComputeAPI):
         memhash_name = base_name+'-mem-meta'
         snapshot = 'snapshot'
 
-        recv_mem_meta = self._cloudlet_create_image(
-            context, instance, mem_name, snapshot,
-            extra_properties=mem_properties)
-        recv_diskhash_meta = self._cloudlet_create_image(
-            context, instance, diskhash_name, snapshot,
-            extra_properties=diskhash_properties)
-        recv_memhash_meta = self._cloudlet_create_image(
-            context, instance, memhash_name, snapshot,
-            extra_properties=memhash_properties)
+        # reserve images concurrently except the disk image referencing them
+        mem_thread = pool.spawn(
+            self._cloudlet_create_image, context, instance, mem_name,
+            snapshot, extra_properties=mem_properties, image_meta=image_meta)
+        diskhash_thread = pool.spawn(
+            self._cloudlet_create_image, context, instance, diskhash_name,
+            snapshot, extra_properties=diskhash_properties,
+            image_meta=image_meta)
+        memhash_thread = pool.spawn(
+            self._cloudlet_create_image, context, instance, memhash_name,
+            snapshot, extra_properties=memhash_properties,
+            image_meta=image_meta)
+        recv_mem_meta = mem_thread.wait()
+        recv_diskhash_meta = diskhash_thread.wait()
+        recv_memhash_meta = memhash_thread.wait()
 
         # add reference for the other base vm information to get it later
         disk_properties.update({
@@ -183,17 +301,20 @@ class CloudletAPI(nova_rpc.ComputeAPI):
             })
         recv_disk_meta = self._cloudlet_create_image(
             context, instance, disk_name, snapshot,
-            extra_properties=disk_properties)
+            extra_properties=disk_properties, image_meta=image_meta)
+
+        get_basevm_index().invalidate(context.project_id)
 
         instance.task_state = task_states.IMAGE_SNAPSHOT
         instance.save(expected_task_state=[None])
 
-        # api request
+        # api request. Creating base VM takes long, so do not wait for it.
+        # Progress can be polled with the job id.
         version = self.client.target.version
         cctxt = self.client.prepare(
             server=nova_rpc._compute_host(None, instance), version=version
         )
-        cctxt.call(context, 'cloudlet_create_base',
+        cctxt.cast(context, 'cloudlet_create_base',
                    instance=instance,
                    vm_name=base_name,
                    disk_meta_id=recv_disk_meta['id'],
@@ -201,7 +322,64 @@ class CloudletAPI(nova_rpc.ComputeAPI):
                    diskhash_meta_id=recv_diskhash_meta['id'],
                    memoryhash_meta_id=recv_memhash_meta['id']
                    )
-        return recv_disk_meta, recv_mem_meta
+        return {
+            'job-id': job_id,
+            'base-disk': recv_disk_meta,
+            'base-memory': recv_mem_meta,
+            'base-disk-hash': recv_diskhash_meta,
+            'base-memory-hash': recv_memhash_meta,
+        }
+
+    def cloudlet_base_job_status(self, context, job_id):
+        """Return progress of cloudlet base creation
+
+        Progress is derived from the status of the reserved glance images,
+        which compute node updates while uploading base VM.
+        """
+        filters = {'property-%s' % CloudletAPI.PROPERTY_KEY_BASE_JOB_ID:
+                   job_id}
+        if hasattr(self.nova_api, "image_service"):
+            # icehouse
+            image_list = self.nova_api.image_service.detail(
+                context, filters=filters)
+        else:
+            # kilo
+            image_list = self.image_api.get_all(context, filters=filters)
+
+        images = list()
+        error = None
+        for image_meta in image_list:
+            properties = image_meta.get('properties', None) or {}
+            if properties.get(CloudletAPI.PROPERTY_KEY_BASE_JOB_ID) != job_id:
+                continue
+            if properties.get(CloudletAPI.PROPERTY_KEY_BASE_JOB_ERROR):
+                error = properties.get(CloudletAPI.PROPERTY_KEY_BASE_JOB_ERROR)
+            images.append({
+                'id': image_meta['id'],
+                'name': image_meta.get('name', None),
+                CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
+                properties.get(CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE),
+                'status': image_meta.get('status', None),
+            })
+        if len(images) == 0:
+            return None
+
+        image_status = [image['status'] for image in images]
+        active_count = image_status.count('active')
+        if error is not None or 'killed' in image_status or\
+                'deleted' in image_status:
+            status = 'error'
+        elif active_count == len(images):
+            status = 'active'
+        else:
+            status = 'creating'
+        return {
+            'id': job_id,
+            'status': status,
+            'progress': int(100 * active_count / len(images)),
+            'error': error,
+            'images': images,
+        }
     def _create_reservations(self, context, instance, original_task_state,project_id, user_id):
         instance_vcpus = instance.vcpus
         instance_memory_mb = instance.memory_mb
@@ -213,17 +391,28 @@ class CloudletAPI(nova_rpc.ComputeAPI):
         quotas = objects.Quotas(context)
         quotas.reserve(project_id=project_id,user_id=user_id,instances=-1,cores=-instance_vcpus,ram=-instance_memory_mb)
         return quotas
+    def _get_overlay_properties(self, instance, extra_properties=None):
+        properties = {
+            CloudletAPI.PROPERTY_KEY_CLOUDLET: True,
+            CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
+            CloudletAPI.IMAGE_TYPE_OVERLAY, }
+        # lets compute nodes check the overlay before downloading it
+        system_metadata = instance.get('system_metadata', None) or {}
+        base_sha256_uuid = system_metadata.get(
+            'image_%s' % CloudletAPI.PROPERTY_KEY_BASE_UUID, None)
+        if base_sha256_uuid is not None:
+            properties[CloudletAPI.PROPERTY_KEY_BASE_UUID] = base_sha256_uuid
+        properties.update(extra_properties or {})
+        return properties
+
     @nova_api.check_instance_state(vm_state=[vm_states.ACTIVE])
     def cloudlet_create_overlay_finish(self, context, instance,
                                        overlay_name, extra_properties=None):
         project_id, user_id = quotas_obj.ids_from_instance(context, instance)
         original_task_state = instance.task_state
         quotas = self._create_reservations(context,instance, original_task_state,project_id, user_id) 
-        overlay_meta_properties = {
-            CloudletAPI.PROPERTY_KEY_CLOUDLET: True,
-            CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
-            CloudletAPI.IMAGE_TYPE_OVERLAY, }
-        overlay_meta_properties.update(extra_properties or {})
+        overlay_meta_properties = self._get_overlay_properties(
+            instance, extra_properties)
         recv_overlay_meta = self._cloudlet_create_image(
             context, instance, overlay_name, 'snapshot',
             extra_properties=overlay_meta_properties)
@@ -242,6 +431,30 @@ class CloudletAPI(nova_rpc.ComputeAPI):
                    overlay_id=recv_overlay_meta['id'])
         return recv_overlay_meta
 
+    @nova_api.check_instance_state(vm_state=[vm_states.ACTIVE])
+    def cloudlet_create_overlay_checkpoint(self, context, instance,
+                                           overlay_name,
+                                           extra_properties=None):
+        overlay_meta_properties = self._get_overlay_properties(
+            instance, extra_properties)
+        recv_overlay_meta = self._cloudlet_create_image(
+            context, instance, overlay_name, 'snapshot',
+            extra_properties=overlay_meta_properties)
+
+        instance.task_state = task_states.IMAGE_SNAPSHOT
+        instance.save(expected_task_state=[None])
+
+        # api request
+        version = self.client.target.version
+        cctxt = self.client.prepare(
+            server=nova_rpc._compute_host(None, instance), version=version
+        )
+        cctxt.cast(context, 'cloudlet_overlay_checkpoint',
+                   instance=instance,
+                   overlay_name=overlay_name,
+                   overlay_id=recv_overlay_meta['id'])
+        return recv_overlay_meta
+
     @nova_api.check_instance_state(vm_state=[vm_states.ACTIVE])
     def cloudlet_handoff(self, context, instance, handoff_url,
                          dest_token=None, dest_vmname=None,
@@ -255,11 +468,8 @@ class CloudletAPI(nova_rpc.ComputeAPI):
         if parsed_handoff_url.scheme == "file":
             # save the VM residue to glance file
             dest_vm_name = parsed_handoff_url.netloc
-            residue_meta_properties = {
-                CloudletAPI.PROPERTY_KEY_CLOUDLET: True,
-                CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
-                CloudletAPI.IMAGE_TYPE_OVERLAY, }
-            residue_meta_properties.update(extra_properties or {})
+            residue_meta_properties = self._get_overlay_properties(
+                instance, extra_properties)
             recv_residue_meta = self._cloudlet_create_image(
                 context, instance, dest_vm_name, 'snapshot',
                 extra_properties=residue_meta_properties
@@ -306,39 +516,25 @@ class CloudletAPI(nova_rpc.ComputeAPI):
         original_overlay_url = \
             instance.get("metadata", dict()).get("overlay_url", None)
 
-        # find matching base VM
-        image_list = self._get_server_info(end_point, dest_token, "images")
-        basevm_uuid = None
-        for image_item in image_list:
-            properties = image_item.get("metadata", None)
-            if properties is None or len(properties) == 0:
-                continue
-            if properties.get(CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE) != \
-                    CloudletAPI.IMAGE_TYPE_BASE_DISK:
-                continue
-            base_sha256_uuid = properties.get(
-                CloudletAPI.PROPERTY_KEY_BASE_UUID)
-            if base_sha256_uuid == requested_basevm_id:
-                basevm_uuid = image_item['id']
-                break
+        # find matching base VM and flavor
+        catalog = get_handoff_dest_catalog(end_point.netloc, dest_token)
+        basevm_uuid = catalog.get_base(requested_basevm_id)
+        if basevm_uuid is None:
+            basevm_uuid = self._find_dest_basevm(end_point, dest_token,
+                                                 requested_basevm_id)
+            catalog.set_base(requested_basevm_id, basevm_uuid)
         if basevm_uuid is None:
             msg = "Cannot find matching Base VM with (%s) at (%s)" %\
                 (str(requested_basevm_id), end_point.netloc)
             raise HandoffError(msg)
 
-        # Find matching flavor.
-        def find_matching_flavor(flavor_list, cpu_count, memory_mb):
-            for flavor in flavor_list:
-                vcpu = int(flavor['vcpus'])
-                ram_mb = int(flavor['ram'])
-                if vcpu == cpu_count and ram_mb == memory_mb:
-                    flavor_ref = flavor['links'][0]['href']
-                    flavor_id = flavor['id']
-                    return flavor_ref, flavor_id
-            return None, None
-        flavor_list = self._get_server_info(end_point, dest_token, "flavors")
-        flavor_ref, flavor_id = find_matching_flavor(
-            flavor_list, flavor_cpu, flavor_memory)
+        flavor_ref, flavor_id = catalog.get_flavor(flavor_cpu, flavor_memory)
+        if flavor_id is None:
+            flavor_list = self._get_server_info(end_point, dest_token,
+                                                "flavors")
+            catalog.set_flavors(flavor_list)
+            flavor_ref, flavor_id = catalog.get_flavor(flavor_cpu,
+                                                       flavor_memory)
         if flavor_ref is None or flavor_id is None:
             msg = "Cannot find matching flavor with cpu=%d, memory=%d at %s" %\
                 (flavor_cpu, flavor_memory, end_point.netloc)
@@ -362,16 +558,177 @@ class CloudletAPI(nova_rpc.ComputeAPI):
         headers = {
             "X-Auth-Token": dest_token,
             "Content-type": "application/json"}
-        conn = httplib.HTTPConnection(end_point[1])
-        conn.request("POST", "%s/servers" % end_point[2], params, headers)
         LOG.info("request handoff to %s" % (end_point.netloc))
-        response = conn.getresponse()
-        data = response.read()
-        dd = jsonutils.loads(data)
-        conn.close()
+        response = cloudlet_http.request(
+            "POST", end_point[1], "%s/servers" % end_point[2], params,
+            headers, scheme=end_point.scheme)
+        dd = jsonutils.loads(response.data)
+        if 'server' not in dd:
+            # the destination catalog might have been changed
+            catalog.invalidate()
 
         return dd
 
+    def _find_dest_basevm(self, end_point, dest_token, base_sha256_uuid):
+        # ask the destination cloudlet to look up the base VM
+        headers = {
+            "X-Auth-Token": dest_token,
+            "Content-type": "application/json"}
+        response = cloudlet_http.request(
+            "GET", end_point[1],
+            "%s/os-cloudlet-bases/%s" % (end_point[2], base_sha256_uuid),
+            '', headers, scheme=end_point.scheme)
+        if response.status == 200:
+            return jsonutils.loads(response.data)['base']['id']
+        if response.status == 404:
+            return None
+        if response.status not in (400, 501):
+            msg = "Failed to look up Base VM (%s) at %s (%d)" % \
+                (base_sha256_uuid, end_point.netloc, response.status)
+            raise HandoffError(msg)
+
+        # destination does not support the lookup. list all images instead
+        LOG.debug("Base VM lookup is not available at %s (%d)" %
+                  (end_point.netloc, response.status))
+        image_list = self._get_server_info(end_point, dest_token, "images")
+        for image_item in image_list:
+            properties = image_item.get("metadata", None)
+            if properties is None or len(properties) == 0:
+                continue
+            if properties.get(CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE) != \
+                    CloudletAPI.IMAGE_TYPE_BASE_DISK:
+                continue
+            if properties.get(CloudletAPI.PROPERTY_KEY_BASE_UUID) == \
+                    base_sha256_uuid:
+                return image_item['id']
+        return None
+
+    def _get_image(self, context, image_id):
+        if hasattr(self.nova_api, "image_service"):
+            # icehouse
+            return self.nova_api.image_service.show(context, image_id)
+        else:
+            # kilo
+            return self.image_api.get(context, image_id)
+
+    def validate_overlay(self, context, image_id, overlay_url):
+        """Check that the VM overlay is made from the base VM of the image
+
+        Only the overlay meta is fetched with range requests. Overlays that
+        cannot be read this way are left to the check at the compute node.
+
+        :raises OverlayMismatchError: the overlay cannot be synthesized on
+        the image
+        """
+        parsed_url = urlsplit(overlay_url)
+        if parsed_url.scheme == "glance":
+            overlay_id = parsed_url.netloc or parsed_url.path.strip("/")
+            overlay_meta = self._get_image(context, overlay_id)
+            properties = overlay_meta.get('properties', None) or {}
+            if properties.get(CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE) != \
+                    CloudletAPI.IMAGE_TYPE_OVERLAY:
+                raise OverlayMismatchError(
+                    "image %s is not a VM overlay" % overlay_id)
+            basevm_sha256 = properties.get(CloudletAPI.PROPERTY_KEY_BASE_UUID)
+            if basevm_sha256 is None:
+                return
+            image_meta = self._get_image(context, image_id)
+            image_properties = image_meta.get('properties', None) or {}
+            image_sha256 = image_properties.get(
+                CloudletAPI.PROPERTY_KEY_BASE_UUID)
+            if basevm_sha256 != image_sha256:
+                raise OverlayMismatchError(
+                    "overlay is made from base VM %s, not %s" %
+                    (basevm_sha256, image_sha256))
+            return
+        if msgpack is None or parsed_url.scheme not in ("http", "https"):
+            return
+        try:
+            reader = cloudlet_overlay.OverlayReader(overlay_url)
+            meta_info = msgpack.unpackb(
+                reader.read_member(CloudletAPI.OVERLAY_META))
+        except Exception as e:
+            LOG.debug("skip overlay validation of %s: %s" %
+                      (overlay_url, str(e)))
+            return
+        basevm_sha256 = meta_info.get(CloudletAPI.META_BASE_VM_SHA256, None)
+        if basevm_sha256 is None:
+            return
+
+        image_meta = self._get_image(context, image_id)
+        properties = image_meta.get('properties', None) or {}
+        if properties.get(CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE) != \
+                CloudletAPI.IMAGE_TYPE_BASE_DISK:
+            raise OverlayMismatchError(
+                "image %s is not a base VM disk" % image_id)
+        image_sha256 = properties.get(CloudletAPI.PROPERTY_KEY_BASE_UUID)
+        if basevm_sha256 != image_sha256:
+            raise OverlayMismatchError(
+                "overlay is made from base VM %s, not %s" %
+                (basevm_sha256, image_sha256))
+
+    def _list_images(self, context, filters):
+        if hasattr(self.nova_api, "image_service"):
+            # icehouse
+            return self.nova_api.image_service.detail(context,
+                                                      filters=filters)
+        else:
+            # kilo
+            return self.image_api.get_all(context, filters=filters)
+
+    def get_imported_overlay_url(self, context, overlay_url):
+        """Return glance:// URL of the overlay imported from overlay_url
+
+        The overlay starts to be imported if it is not in glance yet.
+
+        :returns: glance:// URL, or None to use overlay_url
+        """
+        if not CONF.cloudlet_overlay_import or \
+                urlsplit(overlay_url).scheme not in ("http", "https"):
+            return None
+        try:
+            return get_overlay_importer().get(self, context, overlay_url)
+        except Exception as e:
+            LOG.warning("cannot look up imported overlay of %s: %s" %
+                        (overlay_url, str(e)))
+            return None
+
+    def find_basevm(self, context, base_sha256_uuid=None):
+        """Find base disk images using glance property filters
+
+        :returns: list of image meta of base disk images
+        """
+        filters = {
+            'property-%s' % CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
+            CloudletAPI.IMAGE_TYPE_BASE_DISK,
+        }
+        if base_sha256_uuid is not None:
+            filters['property-%s' % CloudletAPI.PROPERTY_KEY_BASE_UUID] = \
+                base_sha256_uuid
+        basevm_list = list()
+        for image_meta in self._list_images(context, filters):
+            properties = image_meta.get('properties', None) or {}
+            if properties.get(CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE) != \
+                    CloudletAPI.IMAGE_TYPE_BASE_DISK:
+                continue
+            if base_sha256_uuid is not None and \
+                    properties.get(CloudletAPI.PROPERTY_KEY_BASE_UUID) != \
+                    base_sha256_uuid:
+                continue
+            basevm_list.append(image_meta)
+        return basevm_list
+
+    def get_basevm(self, context, base_sha256_uuid):
+        """Return images of a base VM from the base VM index
+        """
+        return get_basevm_index().get(self, context, base_sha256_uuid)
+
+    def get_basevm_list(self, context):
+        return get_basevm_index().get_all(self, context).values()
+
+    def invalidate_basevm_index(self, context):
+        get_basevm_index().invalidate(context.project_id)
+
     def _get_server_info(self, end_point, token, request_list):
         if not request_list in ('images', 'flavors', 'extensions', 'servers'):
             LOG.debug("Error, Cannot support listing for %s\n" % request_list)
@@ -385,58 +742,595 @@ class CloudletAPI(nova_rpc.ComputeAPI):
             end_string = "%s/%s/detail" % (end_point[2], request_list)
 
         # HTTP response
-        conn = httplib.HTTPConnection(end_point[1])
-        conn.request("GET", end_string, params, headers)
-        response = conn.getresponse()
-        data = response.read()
-        dd = jsonutils.loads(data)
-        conn.close()
+        response = cloudlet_http.request("GET", end_point[1], end_string,
+                                         params, headers,
+                                         scheme=end_point.scheme)
+        dd = jsonutils.loads(response.data)
         return dd[request_list]
 
     def handoff_port_forwarding(self, dest_ip, dest_port):
         # type(dest_ip) = netaddr.ip.IPAddress at kilo
-        o = PortForwarding(str(dest_ip), int(dest_port))
-        # port forwarding server will finish automatically whne a client
-        # disconnects
-        o.start()
-        return o.source_port
+        session = get_port_forwarding_manager().create_session(
+            str(dest_ip), int(dest_port))
+        # forwarding session finishes automatically when a client
+        # disconnects, becomes idle, or never shows up
+        return session.source_port
+
+    def handoff_port_forwarding_async(self, context, instance_uuid,
+                                      dest_port):
+        """Open a forwarding session before the instance is scheduled.
+
+        The listening port is returned right away and the destination
+        compute node is attached once the scheduler places the instance.
+        """
+        session = get_port_forwarding_manager().create_session(
+            None, int(dest_port))
+        eventlet.spawn_n(self._attach_handoff_destination,
+                         context, instance_uuid, session)
+        return session
+
+    def _attach_handoff_destination(self, context, instance_uuid, session):
+        deadline = time.time() + CONF.cloudlet_handoff_accept_timeout
+        interval = 0.1
+        while session.state != PortForwardingSession.STATE_CLOSED and\
+                time.time() < deadline:
+            try:
+                instance = self.nova_api.get(context, instance_uuid)
+                instance_hostname = instance.get('node', None)
+                dest_ip = None
+                if instance_hostname is not None:
+                    dest_ip = self.compute_node_ips.get(context,
+                                                        instance_hostname)
+            except Exception as e:
+                # e.g. the instance is deleted before it is scheduled
+                LOG.warning("Cannot find destination of instance %s: %s" %
+                            (instance_uuid, str(e)))
+                break
+            if instance.get('vm_state', None) == vm_states.ERROR:
+                break
+            if instance_hostname is not None:
+                if dest_ip is None:
+                    LOG.warning("Cannot find IP address of %s" %
+                                instance_hostname)
+                    break
+                session.attach_destination(str(dest_ip))
+                return
+            eventlet.sleep(interval)
+            interval = min(interval * 2, 2.0)
+        LOG.warning("Cannot set up port forwarding for instance %s" %
+                    instance_uuid)
+        session.close()
+
+    def handoff_forwarding_sessions(self):
+        return get_port_forwarding_manager().list_sessions()
+
+
+class ComputeNodeAddressCache(object):
+
+    """Map hypervisor hostname to host IP address of compute nodes"""
+
+    def __init__(self):
+        self.host_api = nova_api.HostAPI()
+        self.node_ips = dict()
+        self.updated_at = 0
+
+    def _refresh(self, context):
+        node_ips = dict()
+        for node in self.host_api.compute_node_get_all(context):
+            node_name = node.get('hypervisor_hostname', None)
+            if node_name is not None:
+                node_ips[str(node_name)] = node.get('host_ip', None)
+        self.node_ips = node_ips
+        self.updated_at = time.time()
+
+    def get(self, context, node_name):
+        is_expired = (time.time() - self.updated_at) > \
+            CONF.cloudlet_host_ip_cache_ttl
+        if is_expired or str(node_name) not in self.node_ips:
+            self._refresh(context)
+        return self.node_ips.get(str(node_name), None)
+
+
+class BaseVMIndex(object):
+
+    """Map base sha256 to the glance images of base VM for each project
+
+    Only base disk images are listed from glance since they have reference
+    to the other images of the base VM. Index of a project is reloaded
+    when it expires or when it is invalidated by base VM creation or image
+    deletion, and a missing base VM is looked up individually in case it
+    was just imported. A hit is checked against glance since the image can
+    also be deleted at glance directly.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # project id -> (base sha256 -> base VM info, loaded time)
+        self.projects = dict()
+
+    def invalidate(self, project_id=None):
+        with self.lock:
+            if project_id is None:
+                self.projects = dict()
+            else:
+                self.projects.pop(project_id, None)
+
+    def _to_basevm_info(self, image_meta):
+        properties = image_meta.get('properties', None) or {}
+        return {
+            'id': image_meta['id'],
+            'name': image_meta.get('name', None),
+            'status': image_meta.get('status', None),
+            'min_disk': image_meta.get('min_disk', 0),
+            CloudletAPI.PROPERTY_KEY_BASE_UUID:
+            properties.get(CloudletAPI.PROPERTY_KEY_BASE_UUID, None),
+            CloudletAPI.IMAGE_TYPE_BASE_MEM:
+            properties.get(CloudletAPI.IMAGE_TYPE_BASE_MEM, None),
+            CloudletAPI.IMAGE_TYPE_BASE_DISK_HASH:
+            properties.get(CloudletAPI.IMAGE_TYPE_BASE_DISK_HASH, None),
+            CloudletAPI.IMAGE_TYPE_BASE_MEM_HASH:
+            properties.get(CloudletAPI.IMAGE_TYPE_BASE_MEM_HASH, None),
+            CloudletAPI.PROPERTY_KEY_BASE_RESOURCE:
+            properties.get(CloudletAPI.PROPERTY_KEY_BASE_RESOURCE, None),
+        }
+
+    def get_all(self, cloudlet_api, context):
+        with self.lock:
+            bases, loaded_at = self.projects.get(context.project_id,
+                                                 (None, 0))
+        if bases is not None and \
+                (time.time() - loaded_at) < CONF.cloudlet_basevm_index_ttl:
+            return bases
+
+        bases = dict()
+        for image_meta in cloudlet_api.find_basevm(context):
+            basevm_info = self._to_basevm_info(image_meta)
+            base_sha256_uuid = basevm_info[CloudletAPI.PROPERTY_KEY_BASE_UUID]
+            if base_sha256_uuid is not None:
+                bases.setdefault(base_sha256_uuid, basevm_info)
+        with self.lock:
+            self.projects[context.project_id] = (bases, time.time())
+        return bases
+
+    def _is_available(self, cloudlet_api, context, basevm_info):
+        try:
+            image_meta = cloudlet_api._get_image(context, basevm_info['id'])
+        except exception.ImageNotFound:
+            return False
+        return image_meta.get('status', None) not in \
+            ('deleted', 'pending_delete', 'killed')
+
+    def get(self, cloudlet_api, context, base_sha256_uuid):
+        bases = self.get_all(cloudlet_api, context)
+        basevm_info = bases.get(base_sha256_uuid, None)
+        if basevm_info is not None and \
+                not self._is_available(cloudlet_api, context, basevm_info):
+            self.invalidate(context.project_id)
+            bases = self.get_all(cloudlet_api, context)
+            basevm_info = bases.get(base_sha256_uuid, None)
+        if basevm_info is None:
+            # base VM might be imported after loading the index
+            image_list = cloudlet_api.find_basevm(context, base_sha256_uuid)
+            if len(image_list) > 0:
+                basevm_info = self._to_basevm_info(image_list[0])
+                with self.lock:
+                    bases[base_sha256_uuid] = basevm_info
+        return basevm_info
+
+
+_basevm_index = BaseVMIndex()
+
+
+def get_basevm_index():
+    return _basevm_index
+
+
+class OverlayImporter(object):
+
+    """Import external VM overlays into glance once per project
+
+    Imported overlays are found by the sha1 of the URL and a validator
+    from a HEAD request (ETag, or Last-Modified and Content-Length), so a
+    changed overlay at the same URL is imported again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (project id, overlay hash, validator) of imports in progress
+        self.importing = set()
+
+    def _get_validator(self, overlay_url):
+        parsed_url = urlsplit(overlay_url)
+        path = parsed_url.path
+        if parsed_url.query:
+            path += "?" + parsed_url.query
+        result = cloudlet_http.request("HEAD", parsed_url.netloc, path,
+                                       scheme=parsed_url.scheme)
+        if result.status != 200:
+            return None
+        etag = result.headers.get("etag", None)
+        if etag:
+            return etag
+        last_modified = result.headers.get("last-modified", None)
+        content_length = result.headers.get("content-length", None)
+        if last_modified and content_length:
+            return "%s/%s" % (last_modified, content_length)
+        return None
+
+    def get(self, cloudlet_api, context, overlay_url):
+        validator = self._get_validator(overlay_url)
+        if validator is None:
+            # cannot tell whether the overlay has changed
+            return None
+        overlay_hash = sha1(overlay_url).hexdigest()
+        filters = {
+            'property-%s' % CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
+            CloudletAPI.IMAGE_TYPE_OVERLAY,
+            'property-%s' % CloudletAPI.PROPERTY_KEY_OVERLAY_HASH:
+            overlay_hash,
+        }
+        for image_meta in cloudlet_api._list_images(context, filters):
+            properties = image_meta.get('properties', None) or {}
+            if image_meta.get('status') == 'active' and \
+                    properties.get(CloudletAPI.PROPERTY_KEY_OVERLAY_HASH) == \
+                    overlay_hash and \
+                    properties.get(
+                        CloudletAPI.PROPERTY_KEY_OVERLAY_VALIDATOR) == \
+                    validator:
+                return "glance://%s" % image_meta['id']
+
+        key = (context.project_id, overlay_hash, validator)
+        with self.lock:
+            if key in self.importing:
+                return None
+            self.importing.add(key)
+        eventlet.spawn_n(self._import, cloudlet_api, context, overlay_url,
+                         overlay_hash, validator, key)
+        return None
+
+    def _import(self, cloudlet_api, context, overlay_url, overlay_hash,
+                validator, key):
+        image_api_ref = cloudlet_api._get_image_api_ref()
+        image_id = None
+        start_time = time.time()
+        try:
+            name = os.path.basename(urlsplit(overlay_url).path) or "overlay"
+            image_meta = image_api_ref.create(context, {
+                'name': "imported-%s" % name,
+                'is_public': False,
+                'disk_format': 'raw',
+                'container_format': 'bare',
+                'properties': {
+                    CloudletAPI.PROPERTY_KEY_CLOUDLET: True,
+                    CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
+                    CloudletAPI.IMAGE_TYPE_OVERLAY,
+                    CloudletAPI.PROPERTY_KEY_OVERLAY_HASH: overlay_hash,
+                    CloudletAPI.PROPERTY_KEY_OVERLAY_VALIDATOR: validator,
+                },
+            })
+            image_id = image_meta['id']
+            overlay_file = urllib2.urlopen(overlay_url,
+                                           timeout=CONF.cloudlet_http_timeout)
+            try:
+                image_api_ref.update(context, image_id, {},
+                                     data=overlay_file, purge_props=False)
+            finally:
+                overlay_file.close()
+            LOG.info("imported overlay %s to image %s in %.1f s" %
+                     (overlay_url, image_id, time.time() - start_time))
+        except Exception as e:
+            LOG.warning("cannot import overlay %s: %s" %
+                        (overlay_url, str(e)))
+            if image_id is not None:
+                try:
+                    image_api_ref.delete(context, image_id)
+                except Exception:
+                    pass
+        finally:
+            with self.lock:
+                self.importing.discard(key)
+
+
+_overlay_importer = OverlayImporter()
+
+
+def get_overlay_importer():
+    return _overlay_importer
+
+
+class HandoffDestCatalog(object):
+
+    """Cache base VM and flavor lookups of a handoff destination
+
+    Image and flavor visibility depends on the project, so a catalog is
+    kept per destination and credential.
+    """
+
+    def __init__(self, netloc):
+        self.netloc = netloc
+        self.lock = threading.Lock()
+        self.used_at = time.time()
+        self.invalidate()
+
+    def invalidate(self):
+        with self.lock:
+            # base sha256 -> (image id, cached time)
+            self.bases = dict()
+            # (vcpus, ram) -> (flavor ref, flavor id)
+            self.flavors = dict()
+            self.flavors_updated_at = 0
+
+    def _is_expired(self, cached_at):
+        return (time.time() - cached_at) > CONF.cloudlet_handoff_catalog_ttl
+
+    def get_base(self, base_sha256_uuid):
+        with self.lock:
+            image_id, cached_at = self.bases.get(base_sha256_uuid,
+                                                 (None, 0))
+            if image_id is None or self._is_expired(cached_at):
+                return None
+            return image_id
+
+    def set_base(self, base_sha256_uuid, image_id):
+        if image_id is None:
+            return
+        with self.lock:
+            self.bases[base_sha256_uuid] = (image_id, time.time())
+
+    def get_flavor(self, cpu_count, memory_mb):
+        with self.lock:
+            if self._is_expired(self.flavors_updated_at):
+                return None, None
+            return self.flavors.get((cpu_count, memory_mb), (None, None))
+
+    def set_flavors(self, flavor_list):
+        flavors = dict()
+        for flavor in flavor_list:
+            key = (int(flavor['vcpus']), int(flavor['ram']))
+            if key not in flavors:
+                flavors[key] = (flavor['links'][0]['href'], flavor['id'])
+        with self.lock:
+            self.flavors = flavors
+            self.flavors_updated_at = time.time()
+
+
+_handoff_dest_catalogs = dict()
+
+
+def get_handoff_dest_catalog(netloc, dest_token):
+    now = time.time()
+    for (key, catalog) in _handoff_dest_catalogs.items():
+        if (now - catalog.used_at) > CONF.cloudlet_handoff_catalog_ttl:
+            _handoff_dest_catalogs.pop(key, None)
+
+    key = (netloc, sha1(dest_token).hexdigest())
+    catalog = _handoff_dest_catalogs.get(key, None)
+    if catalog is None:
+        catalog = _handoff_dest_catalogs.setdefault(
+            key, HandoffDestCatalog(netloc))
+    catalog.used_at = now
+    return catalog
 
 
-class PortForwarding(threading.Thread):
+class PortForwardingSession(object):
 
     """Forward VM handoff packet to the compute node"""
 
-    def __init__(self, dest_ip, dest_port, source_port=None):
+    STATE_QUEUED = "queued"
+    STATE_WAITING = "waiting"
+    STATE_FORWARDING = "forwarding"
+    STATE_CLOSED = "closed"
+
+    BUFFER_SIZE = 32384
+
+    def __init__(self, manager, dest_ip, dest_port, source_port, listener):
+        self.id = uuid.uuid4().hex
+        self.manager = manager
         self.dest_ip = dest_ip
         self.dest_port = dest_port
-        if source_port is None:
-            import socket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.bind(('0.0.0.0', 0))   # get free TCP port
-            local_port = int(sock.getsockname()[1])
-            self.source_port = local_port
-        else:
-            self.source_port = source_port
-        threading.Thread.__init__(self, target=self.port_forwarding)
+        self.source_port = source_port
+        self.listener = listener
+        self.state = PortForwardingSession.STATE_QUEUED
+        self.created_at = time.time()
+        self.connected_at = None
+        self.closed_at = None
+        self.last_activity = self.created_at
+        self.bytes_forwarded = 0
+        self.bytes_returned = 0
+        self._sockets = [listener]
+        self.destination_ready = event.Event()
+        if dest_ip is not None:
+            self.destination_ready.send(True)
 
-    def port_forwarding(self):
+    def attach_destination(self, dest_ip, dest_port=None):
+        self.dest_ip = dest_ip
+        if dest_port is not None:
+            self.dest_port = dest_port
+        if not self.destination_ready.ready():
+            self.destination_ready.send(True)
+
+    def run(self):
+        try:
+            with self.manager.session_slot:
+                if self.state == PortForwardingSession.STATE_CLOSED:
+                    return
+                self._accept_and_forward()
+        except Exception as e:
+            LOG.warning("Port forwarding at %d failed: %s" %
+                        (self.source_port, str(e)))
+        finally:
+            self.close()
+
+    def _accept_and_forward(self):
+        self.state = PortForwardingSession.STATE_WAITING
+        self.last_activity = time.time()
+        try:
+            with eventlet.Timeout(CONF.cloudlet_handoff_accept_timeout):
+                client, addr = self.listener.accept()
+                # a session serves only a single handoff stream
+                self._sockets.append(client)
+                self._close_socket(self.listener)
+                # destination can be attached after the source connects
+                is_attached = self.destination_ready.wait()
+        except eventlet.Timeout:
+            LOG.warning("Handoff at port %d is not ready within %d s" %
+                        (self.source_port,
+                         CONF.cloudlet_handoff_accept_timeout))
+            return
+        if not is_attached:
+            return
         local_addr = ('0.0.0.0', self.source_port)
         remote_addr = (self.dest_ip, self.dest_port)
         LOG.info("Port forwarding starts from %s to %s" % (str(local_addr),
                                                            str(remote_addr)))
-        listener = eventlet.listen(local_addr)
-        client, addr = listener.accept()
         server = eventlet.connect(remote_addr)
-        eventlet.spawn_n(self.forward, client, server, self.closed_callback)
-        eventlet.spawn_n(self.forward, server, client)
+        self._sockets.append(server)
+
+        self.state = PortForwardingSession.STATE_FORWARDING
+        self.connected_at = self.last_activity = time.time()
+        upstream = eventlet.spawn(self.forward, client, server, True)
+        downstream = eventlet.spawn(self.forward, server, client, False)
+        upstream.wait()
+        downstream.wait()
+        LOG.info("Port forwarding finished (%s)" % str(self.to_dict()))
+
+    def forward(self, source, dest, is_upstream):
+        try:
+            while True:
+                d = source.recv(PortForwardingSession.BUFFER_SIZE)
+                if d == '':
+                    # pass the half-close on; the other direction may
+                    # still be sending. run() closes the session when both
+                    # directions are done
+                    dest.shutdown(socket.SHUT_WR)
+                    return
+                dest.sendall(d)
+                self.last_activity = time.time()
+                if is_upstream:
+                    self.bytes_forwarded += len(d)
+                else:
+                    self.bytes_returned += len(d)
+        except socket.error:
+            # wake up the other direction as well
+            self.close()
+
+    def _close_socket(self, sock):
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def close(self):
+        if self.state == PortForwardingSession.STATE_CLOSED:
+            return
+        self.state = PortForwardingSession.STATE_CLOSED
+        self.closed_at = time.time()
+        for sock in self._sockets:
+            self._close_socket(sock)
+        if not self.destination_ready.ready():
+            self.destination_ready.send(False)
+        self.manager.release_session(self)
+
+    def is_expired(self, now):
+        idle_time = now - self.last_activity
+        if self.state == PortForwardingSession.STATE_WAITING:
+            # accept timeout is enforced by run(); this catches leaked ones
+            return idle_time > CONF.cloudlet_handoff_accept_timeout * 2
+        return idle_time > CONF.cloudlet_handoff_idle_timeout
+
+    def to_dict(self):
+        end_time = self.closed_at or time.time()
+        transferred = self.bytes_forwarded + self.bytes_returned
+        throughput = 0.0
+        if self.connected_at is not None and end_time > self.connected_at:
+            throughput = transferred / (end_time - self.connected_at)
+        return {
+            "id": self.id,
+            "state": self.state,
+            "source_port": self.source_port,
+            "dest_ip": self.dest_ip,
+            "dest_port": self.dest_port,
+            "created_at": self.created_at,
+            "connected_at": self.connected_at,
+            "bytes_forwarded": self.bytes_forwarded,
+            "bytes_returned": self.bytes_returned,
+            "throughput_bps": throughput,
+        }
+
 
-    def closed_callback(self):
-        LOG.info("Port forwarding finished.")
+class PortForwardingManager(object):
 
-    def forward(self, source, dest, cb=lambda: None):
+    """Manage port forwarding sessions for incoming VM handoff.
+
+    Listening ports are taken from a configured range and returned when a
+    session finishes. At most cloudlet_handoff_max_sessions sessions forward
+    at the same time; the others keep their listener open so that the
+    source's connection waits in the backlog until a slot is free.
+    """
+
+    def __init__(self):
+        port_min = CONF.cloudlet_handoff_port_min
+        port_max = CONF.cloudlet_handoff_port_max
+        if port_min > port_max:
+            raise HandoffError("Invalid handoff port range (%d-%d)" %
+                               (port_min, port_max))
+        self.free_ports = collections.deque(range(port_min, port_max + 1))
+        self.sessions = dict()
+        self.session_slot = semaphore.Semaphore(
+            CONF.cloudlet_handoff_max_sessions)
+        self.lock = threading.Lock()
+        eventlet.spawn_n(self._reap_sessions)
+
+    def _listen_free_port(self):
+        with self.lock:
+            for _ in range(len(self.free_ports)):
+                port = self.free_ports.popleft()
+                try:
+                    return port, eventlet.listen(('0.0.0.0', port))
+                except socket.error:
+                    # used by other process; try it later again
+                    self.free_ports.append(port)
+        msg = "No free port for handoff forwarding (%d sessions)" %\
+            len(self.sessions)
+        raise HandoffError(msg)
+
+    def create_session(self, dest_ip, dest_port):
+        source_port, listener = self._listen_free_port()
+        session = PortForwardingSession(self, dest_ip, dest_port,
+                                        source_port, listener)
+        with self.lock:
+            self.sessions[session.id] = session
+        eventlet.spawn_n(session.run)
+        return session
+
+    def release_session(self, session):
+        with self.lock:
+            if self.sessions.pop(session.id, None) is not None:
+                self.free_ports.append(session.source_port)
+
+    def list_sessions(self):
+        with self.lock:
+            sessions = self.sessions.values()
+        return [session.to_dict() for session in sessions]
+
+    def _reap_sessions(self):
         while True:
-            d = source.recv(32384)
-            if d == '':
-                cb()
-                break
-            dest.sendall(d)
+            eventlet.sleep(CONF.cloudlet_handoff_reap_interval)
+            now = time.time()
+            with self.lock:
+                expired = [session for session in self.sessions.values()
+                           if session.is_expired(now)]
+            for session in expired:
+                LOG.warning("Close expired handoff forwarding session %s" %
+                            str(session.to_dict()))
+                session.close()
+
+
+_port_forwarding_manager = None
+
+
+def get_port_forwarding_manager():
+    global _port_forwarding_manager
+    if _port_forwarding_manager is None:
+        _port_forwarding_manager = PortForwardingManager()
+    return _port_forwarding_manager
@@ -0,0 +1,181 @@
+# Elijah: Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2014 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Keep-alive HTTP connection pool shared by the cloudlet API extension,
+the dashboard, and the command line client.
+
+This file is deployed to nova/compute/ and linked into the dashboard and
+client directories. It only uses the standard library, so it is
+greenthread-safe wherever eventlet monkey-patches threading and socket.
+"""
+
+import errno
+import httplib
+import socket
+import threading
+import time
+from collections import namedtuple
+
+
+# maximum number of connections to a single host
+MAX_CONNECTIONS_PER_HOST = 4
+# socket timeout in seconds
+TIMEOUT = 60
+# idle connections older than this are not reused
+IDLE_TIMEOUT = 30
+# requests that are safe to send again on a stale kept-alive connection
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+STALE_CONNECTION_ERRORS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+
+HTTPResult = namedtuple("HTTPResult", ["status", "reason", "headers", "data"])
+
+
+class HTTPPoolError(Exception):
+    pass
+
+
+def configure(max_connections_per_host=None, timeout=None, idle_timeout=None):
+    """Change the pool settings
+
+    Existing pools are closed and replaced by pools with the new settings.
+    Requests in flight finish on the old pools.
+    """
+    global MAX_CONNECTIONS_PER_HOST
+    global TIMEOUT
+    global IDLE_TIMEOUT
+    if max_connections_per_host is not None:
+        MAX_CONNECTIONS_PER_HOST = int(max_connections_per_host)
+    if timeout is not None:
+        TIMEOUT = timeout
+    if idle_timeout is not None:
+        IDLE_TIMEOUT = idle_timeout
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+class HTTPConnectionPool(object):
+
+    def __init__(self, scheme, netloc):
+        if scheme not in ("http", "https"):
+            raise HTTPPoolError("Not supported scheme: %s" % scheme)
+        self.scheme = scheme
+        self.netloc = netloc
+        self.idle_connections = list()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        self.is_closed = False
+
+    def _new_connection(self):
+        if self.scheme == "https":
+            return httplib.HTTPSConnection(self.netloc, timeout=TIMEOUT)
+        return httplib.HTTPConnection(self.netloc, timeout=TIMEOUT)
+
+    def _get_connection(self):
+        now = time.time()
+        with self.lock:
+            while self.idle_connections:
+                conn, last_used = self.idle_connections.pop()
+                if now - last_used < IDLE_TIMEOUT:
+                    return conn, True
+                conn.close()
+        return self._new_connection(), False
+
+    def _put_connection(self, conn):
+        with self.lock:
+            if not self.is_closed:
+                self.idle_connections.append((conn, time.time()))
+                return
+        conn.close()
+
+    def request(self, method, path, body=None, headers=None):
+        self.slots.acquire()
+        try:
+            conn, is_reused = self._get_connection()
+            try:
+                response, data = self._send(conn, method, path, body, headers)
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if not self._is_stale_connection(e, is_reused, method):
+                    raise
+                # server closed the kept-alive connection before the request
+                conn = self._new_connection()
+                response, data = self._send(conn, method, path, body, headers)
+            if response.will_close:
+                conn.close()
+            else:
+                self._put_connection(conn)
+            return HTTPResult(response.status, response.reason,
+                              dict(response.getheaders()), data)
+        finally:
+            self.slots.release()
+
+    def _is_stale_connection(self, error, is_reused, method):
+        """Return whether the request can be sent again on a new connection
+
+        Only idempotent requests are retried, since a request that failed
+        after it was sent might have been processed by the server. A
+        timeout is not a closed connection.
+        """
+        if not is_reused or method not in IDEMPOTENT_METHODS:
+            return False
+        if isinstance(error, socket.timeout):
+            return False
+        if isinstance(error, socket.error):
+            return error.errno in STALE_CONNECTION_ERRORS
+        # no status line since the server closed the connection
+        return isinstance(error, (httplib.BadStatusLine,
+                                  httplib.CannotSendRequest))
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        data = response.read()
+        return response, data
+
+    def close(self):
+        with self.lock:
+            self.is_closed = True
+            for conn, last_used in self.idle_connections:
+                conn.close()
+            self.idle_connections = list()
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def get_pool(scheme, netloc):
+    key = (scheme or "http", netloc)
+    with _pools_lock:
+        pool = _pools.get(key, None)
+        if pool is None:
+            pool = HTTPConnectionPool(key[0], netloc)
+            _pools[key] = pool
+    return pool
+
+
+def request(method, netloc, path, body=None, headers=None, scheme="http"):
+    """Send a request through the pooled connection to netloc
+
+    :returns: HTTPResult with status, reason, headers, and body data
+    """
+    return get_pool(scheme, netloc).request(method, path, body, headers)
@@ -0,0 +1,396 @@
+# Elijah: Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2014 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Random access to a VM overlay package.
+
+A VM overlay is a zip of the overlay meta and independently compressed
+blobs (frames). The central directory at the end of the zip is an index
+from each frame to its byte range, and the overlay meta maps the disk and
+memory chunks to frames. OverlayReader reads the central directory and
+single members with HTTP range requests, so the overlay meta can be read
+alone and frames can be fetched in any order over several connections.
+
+This file is deployed to nova/compute/ and only uses the standard library
+and cloudlet_http.
+"""
+
+import hashlib
+import os
+import Queue
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+from urlparse import urlsplit
+
+from nova.compute import cloudlet_http
+
+
+# bytes read from the end of the zip to find the central directory
+TAIL_SIZE = 64 * 1024
+# maximum bytes of a single range request when copying an overlay
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+ZIP_LOCAL_HEADER = "<IHHHHHIIIHH"
+ZIP_CENTRAL_HEADER = "<IHHHHHHIIIHHHHHII"
+ZIP_END_OF_CENTRAL_DIRECTORY = "<IHHHHIIH"
+ZIP_END_SIGNATURE = "PK\x05\x06"
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+
+ZipMember = namedtuple("ZipMember", ["name", "method", "header_offset",
+                                     "compressed_size", "size"])
+
+
+class OverlayReaderError(Exception):
+    pass
+
+
+class RangeNotSupported(OverlayReaderError):
+    pass
+
+
+class OverlayIntegrityError(OverlayReaderError):
+    pass
+
+
+OverlaySource = namedtuple("OverlaySource", ["url", "scheme", "netloc",
+                                             "path"])
+
+
+class OverlayReader(object):
+
+    """Read members of a VM overlay zip at file:// or http(s):// URL
+    without downloading the whole package
+
+    http(s) overlays can have mirrors serving the same file. Sources are
+    ranked by probe(), and a range request that fails at one source is
+    sent again to the next one.
+    """
+
+    def __init__(self, url, mirrors=None):
+        self.url = url
+        self.sources = [self._parse_source(url)]
+        if self.sources[0].scheme != "file":
+            for mirror in mirrors or []:
+                source = self._parse_source(mirror)
+                if source.scheme == "file":
+                    raise OverlayReaderError("Mirror must be http(s): %s" %
+                                             mirror)
+                self.sources.append(source)
+        self.lock = threading.Lock()
+        # source indexes from the fastest one, and those used for striping
+        self.ranked = range(len(self.sources))
+        self.striped = self.ranked[:1]
+        self.failed = set()
+        self.size = None
+        self.members = None
+        self.central_directory_offset = None
+
+    def _parse_source(self, url):
+        parsed = urlsplit(url)
+        scheme = parsed.scheme or "file"
+        if scheme not in ("file", "http", "https"):
+            raise OverlayReaderError("Not supported scheme: %s" % scheme)
+        path = parsed.path
+        if parsed.query:
+            path += "?" + parsed.query
+        return OverlaySource(url, scheme, parsed.netloc, path)
+
+    def _parse_total_size(self, source, headers):
+        # Content-Range: bytes 0-99/1234
+        content_range = headers.get("content-range", "")
+        try:
+            return int(content_range.rsplit("/", 1)[1])
+        except (IndexError, ValueError):
+            raise RangeNotSupported("Invalid Content-Range of %s: %s" %
+                                    (source.url, content_range))
+
+    def _request_range(self, source, byte_range):
+        try:
+            result = cloudlet_http.request(
+                "GET", source.netloc, source.path, scheme=source.scheme,
+                headers={"Range": "bytes=%s" % byte_range})
+        except Exception as e:
+            raise OverlayReaderError("Cannot read %s: %s" %
+                                     (source.url, str(e)))
+        if result.status == 200:
+            raise RangeNotSupported("%s does not support range request" %
+                                    source.url)
+        if result.status != 206:
+            raise OverlayReaderError("Cannot read %s: %d %s" %
+                                     (source.url, result.status,
+                                      result.reason))
+        size = self._parse_total_size(source, result.headers)
+        with self.lock:
+            if self.size is None:
+                self.size = size
+        if size != self.size:
+            raise OverlayReaderError("%s has different size %d != %d" %
+                                     (source.url, size, self.size))
+        return result.data
+
+    def _read_source(self, byte_range, preferred=None):
+        """Send a range request to the sources from the preferred one
+        until one of them succeeds
+        """
+        order = list(self.ranked)
+        if preferred in order:
+            order.remove(preferred)
+            order.insert(0, preferred)
+        error = None
+        for index in order:
+            if index in self.failed:
+                continue
+            try:
+                return self._request_range(self.sources[index], byte_range)
+            except OverlayReaderError as e:
+                error = e
+                if len(self.sources) > 1:
+                    with self.lock:
+                        self.failed.add(index)
+        if error is None:
+            error = OverlayReaderError("No source is left for %s" % self.url)
+        raise error
+
+    def probe(self):
+        """Rank the sources by the time to read the tail of the zip
+
+        Sources within twice the time of the fastest one are used for
+        striping range requests.
+        """
+        if len(self.sources) == 1:
+            return
+        elapsed = dict()
+
+        def _probe(index):
+            start_time = time.time()
+            try:
+                self._request_range(self.sources[index], "-%d" % TAIL_SIZE)
+            except OverlayReaderError:
+                with self.lock:
+                    self.failed.add(index)
+                return
+            elapsed[index] = time.time() - start_time
+
+        threads = [threading.Thread(target=_probe, args=(index,))
+                   for index in range(len(self.sources))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if not elapsed:
+            raise OverlayReaderError("No source of %s is available" %
+                                     self.url)
+        self.ranked = sorted(elapsed, key=lambda index: elapsed[index])
+        fastest = elapsed[self.ranked[0]]
+        self.striped = [index for index in self.ranked
+                        if elapsed[index] <= fastest * 2]
+
+    def read_range(self, offset, length, preferred=None):
+        if self.sources[0].scheme == "file":
+            with open(self.sources[0].path, "rb") as f:
+                f.seek(offset)
+                return f.read(length)
+        return self._read_source("%d-%d" % (offset, offset + length - 1),
+                                 preferred)
+
+    def _read_tail(self, length):
+        if self.sources[0].scheme == "file":
+            self.size = os.path.getsize(self.sources[0].path)
+            length = min(length, self.size)
+            return self.read_range(self.size - length, length)
+        return self._read_source("-%d" % length)
+
+    def get_members(self):
+        """Return dict of zip members by name from the central directory
+        """
+        if self.members is not None:
+            return self.members
+
+        tail = self._read_tail(TAIL_SIZE)
+        tail_offset = self.size - len(tail)
+        end_offset = tail.rfind(ZIP_END_SIGNATURE)
+        if end_offset < 0:
+            raise OverlayReaderError("%s is not a zip file" % self.url)
+        end_size = struct.calcsize(ZIP_END_OF_CENTRAL_DIRECTORY)
+        (_, _, _, _, entries, directory_size, directory_offset, _) = \
+            struct.unpack(ZIP_END_OF_CENTRAL_DIRECTORY,
+                          tail[end_offset:end_offset + end_size])
+        if directory_offset == 0xFFFFFFFF:
+            raise OverlayReaderError("zip64 overlay is not supported")
+        if directory_offset >= tail_offset:
+            start = directory_offset - tail_offset
+            directory = tail[start:start + directory_size]
+        else:
+            directory = self.read_range(directory_offset, directory_size)
+
+        members = dict()
+        header_size = struct.calcsize(ZIP_CENTRAL_HEADER)
+        offset = 0
+        for _ in range(entries):
+            header = struct.unpack(ZIP_CENTRAL_HEADER,
+                                   directory[offset:offset + header_size])
+            (method, compressed_size, size) = \
+                (header[4], header[8], header[9])
+            (name_len, extra_len, comment_len) = header[10:13]
+            header_offset = header[16]
+            name = directory[offset + header_size:
+                             offset + header_size + name_len]
+            members[name] = ZipMember(name, method, header_offset,
+                                      compressed_size, size)
+            offset += header_size + name_len + extra_len + comment_len
+        self.central_directory_offset = directory_offset
+        self.members = members
+        return members
+
+    def read_member(self, name):
+        """Return the uncompressed data of a member
+        """
+        member = self.get_members().get(name, None)
+        if member is None:
+            raise OverlayReaderError("%s does not have %s" % (self.url, name))
+        header_size = struct.calcsize(ZIP_LOCAL_HEADER)
+        # guess the local extra field from the name to save a round trip
+        length = header_size + len(name) + member.compressed_size + 1024
+        record_end = self._get_record_end(member)
+        data = self.read_range(member.header_offset,
+                               min(length, record_end - member.header_offset))
+        header = struct.unpack(ZIP_LOCAL_HEADER, data[:header_size])
+        data_offset = header_size + header[9] + header[10]
+        data_end = data_offset + member.compressed_size
+        if len(data) < data_end:
+            data += self.read_range(member.header_offset + len(data),
+                                    data_end - len(data))
+        data = data[data_offset:data_end]
+        if member.method == ZIP_DEFLATED:
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+        if member.method != ZIP_STORED:
+            raise OverlayReaderError("Not supported compression %d of %s" %
+                                     (member.method, name))
+        return data
+
+    def _get_record_end(self, member):
+        offsets = [m.header_offset for m in self.members.values()
+                   if m.header_offset > member.header_offset]
+        return min(offsets + [self.central_directory_offset])
+
+    def get_record_ranges(self, order=None):
+        """Return (start, end) byte ranges covering the whole zip
+
+        Each member record (local header, data, and data descriptor) is
+        one range. Records of the members in order come first, then the
+        rest in file order, and the central directory last.
+        """
+        members = self.get_members()
+        order = [name for name in (order or []) if name in members]
+        ordered_names = set(order)
+        rest = sorted([m for m in members.values()
+                       if m.name not in ordered_names],
+                      key=lambda m: m.header_offset)
+        ranges = list()
+        for member in [members[name] for name in order] + rest:
+            ranges.append((member.header_offset,
+                           self._get_record_end(member)))
+        ranges.append((self.central_directory_offset, self.size))
+        return ranges
+
+    def copy_to(self, dest_path, order=None, concurrency=4, sha256=None):
+        """Copy the overlay zip to a local file with range requests
+
+        Records are written at the same offsets, so the local file is
+        identical to the remote one. Members in order are requested first
+        and up to concurrency requests are in flight at a time, striped
+        across the fastest sources.
+
+        :raises OverlayIntegrityError: the copy does not match sha256
+        """
+        segments = Queue.Queue()
+        for (start, end) in self.get_record_ranges(order):
+            for offset in xrange(start, end, SEGMENT_SIZE):
+                segments.put((offset, min(end, offset + SEGMENT_SIZE)))
+        with open(dest_path, "wb") as f:
+            f.truncate(self.size)
+
+        errors = list()
+
+        def _copy_segments(preferred):
+            fd = os.open(dest_path, os.O_WRONLY)
+            try:
+                while not errors:
+                    try:
+                        (start, end) = segments.get_nowait()
+                    except Queue.Empty:
+                        return
+                    data = self.read_range(start, end - start, preferred)
+                    if len(data) != end - start:
+                        raise OverlayReaderError(
+                            "Short read of %s at %d" % (self.url, start))
+                    os.lseek(fd, start, os.SEEK_SET)
+                    os.write(fd, data)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                os.close(fd)
+
+        workers = list()
+        for worker_index in range(max(1, concurrency)):
+            preferred = self.striped[worker_index % len(self.striped)]
+            workers.append(threading.Thread(target=_copy_segments,
+                                            args=(preferred,)))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        if sha256 is not None:
+            verify_sha256(dest_path, sha256)
+        return self.size
+
+
+def verify_sha256(path, sha256):
+    """Check the sha256 hex digest of the file
+
+    :raises OverlayIntegrityError: the file does not match
+    """
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(SEGMENT_SIZE)
+            if not data:
+                break
+            file_hash.update(data)
+    if file_hash.hexdigest() != sha256.lower():
+        raise OverlayIntegrityError("sha256 of %s does not match: %s != %s"
+                                    % (path, file_hash.hexdigest(), sha256))
+
+
+def get_frame_index(meta_info, overlay_files_key, name_key, chunks_key):
+    """Return dict from a chunk to the name of the frame that has it
+
+    Keys are those of the overlay meta (see elijah Const.META_OVERLAY_*)
+    """
+    index = dict()
+    for blob_info in meta_info.get(overlay_files_key, None) or []:
+        name = os.path.basename(blob_info.get(name_key))
+        for chunk in blob_info.get(chunks_key, None) or []:
+            index[chunk] = name
+    return index
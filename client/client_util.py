@@ -21,10 +21,11 @@ Views for managing Images and Snapshots.
 
 import logging
 import json
-import httplib
 import sys
 from xml.etree import ElementTree
 
+import cloudlet_http
+
 LOG = logging.getLogger(__name__)
 
 
@@ -141,12 +142,10 @@ def create_flavor(server_address, token, end_point, cpu_count,
     params = json.dumps(request)
     headers = { "X-Auth-Token":token, "Content-type":"application/json" }
 
-    conn = httplib.HTTPConnection(end_point[1])
-    conn.request("POST", "%s/flavors" % end_point[2], params, headers)
-    response = conn.getresponse()
-    data = response.read()
-    dd = json.loads(data)
-    conn.close()
+    response = cloudlet_http.request("POST", end_point[1],
+                                     "%s/flavors" % end_point[2], params,
+                                     headers, scheme=end_point.scheme)
+    dd = json.loads(response.data)
 
     try:
         flavor_ref = dd['flavor']['links'][0]['href']
@@ -18,7 +18,6 @@
 #
 import sys
 import os
-import httplib
 import json
 import math
 import subprocess
@@ -33,6 +32,7 @@ from client_util import CLOUDLET_COMMAND
 from client_util import find_matching_flavor
 from client_util import get_resource_size
 from client_util import create_flavor
+import cloudlet_http
 
 from elijah.provisioning.package import PackagingUtil
 from elijah.provisioning.package import _FileFile
@@ -43,6 +43,11 @@ import zipfile
 import shutil
 
 
+# block size for detecting zero blocks of a downloaded image
+SPARSE_BLOCK_SIZE = 64 * 1024
+QCOW2_MAGIC = "QFI\xfb"
+
+
 class CloudletClientError(Exception):
     pass
 
@@ -62,15 +67,27 @@ def get_list(server_address, token, end_point, request_list):
         end_string = "%s/%s/detail" % (end_point[2], request_list)
 
     # HTTP response
-    conn = httplib.HTTPConnection(end_point[1])
-    conn.request("GET", end_string, params, headers)
-    response = conn.getresponse()
-    data = response.read()
-    dd = json.loads(data)
-    conn.close()
+    response = cloudlet_http.request("GET", end_point[1], end_string, params,
+                                     headers, scheme=end_point.scheme)
+    dd = json.loads(response.data)
     return dd[request_list]
 
 
+def get_basevm(server_address, token, end_point, base_sha256_uuid):
+    """Look up base VM using the base VM index of cloudlet extension
+
+    Returns None if there is no base VM with base_sha256_uuid
+    """
+    headers = {"X-Auth-Token": token, "Content-type": "application/json"}
+    end_string = "%s/os-cloudlet-bases/%s" % (end_point[2], base_sha256_uuid)
+    response = cloudlet_http.request("GET", end_point[1], end_string, '',
+                                     headers, scheme=end_point.scheme)
+    if response.status == 404:
+        return None
+    dd = json.loads(response.data)
+    return dd['base']
+
+
 def request_synthesis(server_address, token, end_point, key_name=None,
                       server_name=None, overlay_url=None):
     # read meta data from vm overlay URL
@@ -86,27 +103,17 @@ def request_synthesis(server_address, token, end_point, key_name=None,
     requested_basevm_id = meta_info['base_vm_sha256']
 
     # find matching base VM
-    image_list = get_list(server_address, token, end_point, "images")
+    basevm = get_basevm(server_address, token, end_point,
+                        requested_basevm_id)
     basevm_uuid = None
     basevm_xml = None
     basevm_name = None
     basevm_disk = 0
-    for image in image_list:
-        properties = image.get("metadata", None)
-        if properties is None or len(properties) == 0:
-            continue
-        if properties.get(CLOUDLET_TYPE.PROPERTY_KEY_CLOUDLET_TYPE) != \
-                CLOUDLET_TYPE.IMAGE_TYPE_BASE_DISK:
-            continue
-        base_sha256_uuid = properties.get(CLOUDLET_TYPE.PROPERTY_KEY_BASE_UUID)
-        if base_sha256_uuid == requested_basevm_id:
-            basevm_uuid = image['id']
-            basevm_name = image['name']
-            basevm_xml = properties.get(
-                CLOUDLET_TYPE.PROPERTY_KEY_BASE_RESOURCE,
-                None)
-            basevm_disk = image.get('minDisk', 0)
-            break
+    if basevm is not None:
+        basevm_uuid = basevm['id']
+        basevm_name = basevm['name']
+        basevm_xml = basevm.get(CLOUDLET_TYPE.PROPERTY_KEY_BASE_RESOURCE, None)
+        basevm_disk = basevm.get('min_disk', 0)
     if basevm_uuid is None:
         raise CloudletClientError("Cannot find matching Base VM with (%s)" %
                                   str(requested_basevm_id))
@@ -137,13 +144,11 @@ def request_synthesis(server_address, token, end_point, key_name=None,
             }}
     params = json.dumps(s)
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
-    conn = httplib.HTTPConnection(end_point[1])
-    conn.request("POST", "%s/servers" % end_point[2], params, headers)
     sys.stdout.write("request new server: %s/servers\n" % (end_point[2]))
-    response = conn.getresponse()
-    data = response.read()
-    dd = json.loads(data)
-    conn.close()
+    response = cloudlet_http.request("POST", end_point[1],
+                                     "%s/servers" % end_point[2], params,
+                                     headers, scheme=end_point.scheme)
+    dd = json.loads(response.data)
     return dd
 
 
@@ -164,27 +169,17 @@ def _request_handoff_recv(server_address, token, end_point,
     requested_basevm_id = meta_info['base_vm_sha256']
 
     # find matching base VM
-    image_list = get_list(server_address, token, end_point, "images")
+    basevm = get_basevm(server_address, token, end_point,
+                        requested_basevm_id)
     basevm_uuid = None
     basevm_xml = None
     basevm_name = None
     basevm_disk = 0
-    for image in image_list:
-        properties = image.get("metadata", None)
-        if properties is None or len(properties) == 0:
-            continue
-        if properties.get(CLOUDLET_TYPE.PROPERTY_KEY_CLOUDLET_TYPE) != \
-                CLOUDLET_TYPE.IMAGE_TYPE_BASE_DISK:
-            continue
-        base_sha256_uuid = properties.get(CLOUDLET_TYPE.PROPERTY_KEY_BASE_UUID)
-        if base_sha256_uuid == requested_basevm_id:
-            basevm_uuid = image['id']
-            basevm_name = image['name']
-            basevm_xml = properties.get(
-                CLOUDLET_TYPE.PROPERTY_KEY_BASE_RESOURCE,
-                None)
-            basevm_disk = image.get('minDisk', 0)
-            break
+    if basevm is not None:
+        basevm_uuid = basevm['id']
+        basevm_name = basevm['name']
+        basevm_xml = basevm.get(CLOUDLET_TYPE.PROPERTY_KEY_BASE_RESOURCE, None)
+        basevm_disk = basevm.get('min_disk', 0)
     if basevm_uuid is None:
         raise CloudletClientError(
             "Cannot find matching Base VM with (%s)" %
@@ -217,13 +212,11 @@ def _request_handoff_recv(server_address, token, end_point,
          }
     params = json.dumps(s)
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
-    conn = httplib.HTTPConnection(end_point[1])
-    conn.request("POST", "%s/servers" % end_point[2], params, headers)
     sys.stdout.write("request new server: %s/servers\n" % (end_point[2]))
-    response = conn.getresponse()
-    data = response.read()
-    dd = json.loads(data)
-    conn.close()
+    response = cloudlet_http.request("POST", end_point[1],
+                                     "%s/servers" % end_point[2], params,
+                                     headers, scheme=end_point.scheme)
+    dd = json.loads(response.data)
     return dd
 
 
@@ -244,12 +237,10 @@ def request_start_stop(server_address, token, end_point,
         params = json.dumps({"os-stop": "null"})
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
 
-    conn = httplib.HTTPConnection(end_point[1])
     command = "%s/servers/%s/action" % (end_point[2], server_id)
-    conn.request("POST", command, params, headers)
-    response = conn.getresponse()
-    data = response.read()
-    conn.close()
+    response = cloudlet_http.request("POST", end_point[1], command, params,
+                                     headers, scheme=end_point.scheme)
+    data = response.data
     print data
 
 
@@ -268,12 +259,10 @@ def request_cloudlet_base(server_address, token, end_point,
     params = json.dumps({"cloudlet-base": {"name": cloudlet_base_name}})
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
 
-    conn = httplib.HTTPConnection(end_point[1])
     command = "%s/servers/%s/action" % (end_point[2], server_id)
-    conn.request("POST", command, params, headers)
-    response = conn.getresponse()
-    data = response.read()
-    conn.close()
+    response = cloudlet_http.request("POST", end_point[1], command, params,
+                                     headers, scheme=end_point.scheme)
+    data = response.data
     print json.dumps(data, indent=2)
     return data
 
@@ -309,18 +298,16 @@ def request_cloudlet_overlay_start(server_address, token, end_point,
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
     print json.dumps(s, indent=4)
 
-    conn = httplib.HTTPConnection(end_point[1])
-    conn.request("POST", "%s/servers" % end_point[2], params, headers)
     print "request new server: %s/servers" % (end_point[2])
-    response = conn.getresponse()
-    data = response.read()
-    dd = json.loads(data)
-    conn.close()
+    response = cloudlet_http.request("POST", end_point[1],
+                                     "%s/servers" % end_point[2], params,
+                                     headers, scheme=end_point.scheme)
+    dd = json.loads(response.data)
     print json.dumps(dd, indent=2)
 
 
 def request_create_overlay(server_address, token, end_point,
-                           instance_uuid, overlay_name):
+                           instance_uuid, overlay_name, checkpoint=False):
     server_list = get_list(server_address, token, end_point, "servers")
     server_id = ''
     for server in server_list:
@@ -330,17 +317,17 @@ def request_create_overlay(server_address, token, end_point,
         msg = "cannot find matching instance UUID (%s)" % instance_uuid
         raise CloudletClientError(msg)
 
-    params = json.dumps(
-        {"cloudlet-overlay-finish": {"overlay-name": overlay_name}})
+    if checkpoint:
+        action = "cloudlet-overlay-checkpoint"
+    else:
+        action = "cloudlet-overlay-finish"
+    params = json.dumps({action: {"overlay-name": overlay_name}})
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
 
-    conn = httplib.HTTPConnection(end_point[1])
     command = "%s/servers/%s/action" % (end_point[2], server_id)
-    conn.request("POST", command, params, headers)
-    response = conn.getresponse()
-    data = response.read()
-    dd = json.loads(data)
-    conn.close()
+    response = cloudlet_http.request("POST", end_point[1], command, params,
+                                     headers, scheme=end_point.scheme)
+    dd = json.loads(response.data)
     return dd
 
 
@@ -365,26 +352,21 @@ def request_handoff(server_address, token, end_point,
     })
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
 
-    conn = httplib.HTTPConnection(end_point[1])
     command = "%s/servers/%s/action" % (end_point[2], server_id)
-    conn.request("POST", command, params, headers)
-    response = conn.getresponse()
-    data = response.read()
-    conn.close()
+    response = cloudlet_http.request("POST", end_point[1], command, params,
+                                     headers, scheme=end_point.scheme)
+    data = response.data
     print data
 
 
 def request_cloudlet_ipaddress(server_address, token, end_point, server_uuid):
     params = urllib.urlencode({})
     # HTTP response
-    conn = httplib.HTTPConnection(end_point[1])
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
     end_string = "%s/servers/%s" % (end_point[2], server_uuid)
-    conn.request("GET", end_string, params, headers)
-    response = conn.getresponse()
-    data = response.read()
-    dd = json.loads(data)
-    conn.close()
+    response = cloudlet_http.request("GET", end_point[1], end_string, params,
+                                     headers, scheme=end_point.scheme)
+    dd = json.loads(response.data)
 
     floating_ip = None
     if dd.get('server', None) is None:
@@ -411,16 +393,13 @@ def get_token(server_address, user, password, tenant_name):
     headers = {"Content-Type": "application/json"}
 
     # HTTP connection
-    conn = httplib.HTTPConnection(url)
     # print json.dumps(params, indent=4)
     # print headers
-    conn.request("POST", "/v2.0/tokens", json.dumps(params), headers)
+    response = cloudlet_http.request("POST", url, "/v2.0/tokens",
+                                     json.dumps(params), headers)
 
     # HTTP response
-    response = conn.getresponse()
-    data = response.read()
-    dd = json.loads(data)
-    conn.close()
+    dd = json.loads(response.data)
 
     # print json.dumps(dd, indent=4)
     try:
@@ -448,15 +427,43 @@ def overlay_download(server_address, token, glance_endpoint,
     http://api.openstack.org/api-ref-image.html
     """
 
-    fout = open(output_file, "wb")
     _PIPE = subprocess.PIPE
     cmd = "glance image-download %s" % (image_name)
-    proc = subprocess.Popen(cmd.split(" "), stdout=fout, stderr=_PIPE)
-    out, err = proc.communicate()
+    proc = subprocess.Popen(cmd.split(" "), stdout=_PIPE, stderr=_PIPE)
+    # leave holes for zero blocks
+    zero_block = '\0' * SPARSE_BLOCK_SIZE
+    with open(output_file, "wb") as fout:
+        while True:
+            block = proc.stdout.read(SPARSE_BLOCK_SIZE)
+            if not block:
+                break
+            if block == zero_block[:len(block)]:
+                fout.seek(len(block), os.SEEK_CUR)
+            else:
+                fout.write(block)
+        fout.truncate(fout.tell())
+    err = proc.stderr.read()
+    proc.wait()
     if err:
         print err
 
 
+def convert_to_sparse_raw(image_path):
+    """Convert qcow2 image (sparse base disk upload) to sparse raw image
+    """
+    with open(image_path, "rb") as image_file:
+        magic = image_file.read(4)
+    if magic != QCOW2_MAGIC:
+        return
+    raw_path = image_path + ".raw"
+    cmd = ["qemu-img", "convert", "-f", "qcow2", "-O", "raw",
+           image_path, raw_path]
+    if subprocess.call(cmd) != 0:
+        raise CloudletClientError("Cannot convert %s to raw image" %
+                                  image_path)
+    os.rename(raw_path, image_path)
+
+
 def request_import_basevm(server_address, token, 
                           endpoint, glance_endpoint,
                           import_filepath, basevm_name):
@@ -484,19 +491,11 @@ def request_import_basevm(server_address, token,
         PackagingUtil._get_basevm_attribute(import_filepath)
 
     # check duplicated base VM
-    image_list = get_list(server_address, token, endpoint, "images")
-    for image in image_list:
-        properties = image.get("metadata", None)
-        if properties is None or len(properties) == 0:
-            continue
-        if properties.get(CLOUDLET_TYPE.PROPERTY_KEY_CLOUDLET_TYPE) != \
-                CLOUDLET_TYPE.IMAGE_TYPE_BASE_DISK:
-            continue
-        base_sha256_uuid = properties.get(CLOUDLET_TYPE.PROPERTY_KEY_BASE_UUID)
-        if base_sha256_uuid == base_hashvalue:
-            msg = "Duplicated base VM is already exists on the system\n"
-            msg += "Image UUID of duplicated Base VM: %s\n" % image['id']
-            raise CloudletClientError(msg)
+    basevm = get_basevm(server_address, token, endpoint, base_hashvalue)
+    if basevm is not None:
+        msg = "Duplicated base VM is already exists on the system\n"
+        msg += "Image UUID of duplicated Base VM: %s\n" % basevm['id']
+        raise CloudletClientError(msg)
 
     # decompress files
     temp_dir = mkdtemp(prefix="cloudlet-base-")
@@ -573,27 +572,31 @@ def request_import_basevm(server_address, token,
 
 def request_export_basevm(server_address, token, end_point,
                           basedisk_uuid, output_file):
-    image_list = get_list(server_address, token, end_point, "images")
+    # read base sha256 of the base disk and look up the other images
+    headers = {"X-Auth-Token": token, "Content-type": "application/json"}
+    response = cloudlet_http.request("GET", end_point[1],
+                                     "%s/images/%s" % (end_point[2],
+                                                       basedisk_uuid),
+                                     '', headers, scheme=end_point.scheme)
+    properties = dict()
+    if response.status == 200:
+        properties = json.loads(response.data)['image'].get('metadata', {})
 
     base_sha256_uuid = None
     basememory_uuid = None
     diskhash_uuid = None
     memoryhash_uuid = None
-    for image in image_list:
-        properties = image.get("metadata", None)
-        if properties is None or len(properties) == 0:
-            continue
-        if properties.get(CLOUDLET_TYPE.PROPERTY_KEY_CLOUDLET_TYPE) != \
-                CLOUDLET_TYPE.IMAGE_TYPE_BASE_DISK:
-            continue
-        base_sha256_uuid = properties.get(CLOUDLET_TYPE.PROPERTY_KEY_BASE_UUID)
-        if basedisk_uuid == image['id']:
-            basememory_uuid = properties.get(CLOUDLET_TYPE.IMAGE_TYPE_BASE_MEM)
-            diskhash_uuid = properties.get(
-                CLOUDLET_TYPE.IMAGE_TYPE_BASE_DISK_HASH)
-            memoryhash_uuid = properties.get(
-                CLOUDLET_TYPE.IMAGE_TYPE_BASE_MEM_HASH)
-            break
+    basevm = None
+    if properties.get(CLOUDLET_TYPE.PROPERTY_KEY_CLOUDLET_TYPE) == \
+            CLOUDLET_TYPE.IMAGE_TYPE_BASE_DISK:
+        basevm = get_basevm(
+            server_address, token, end_point,
+            properties.get(CLOUDLET_TYPE.PROPERTY_KEY_BASE_UUID))
+    if basevm is not None and basevm['id'] == basedisk_uuid:
+        base_sha256_uuid = basevm[CLOUDLET_TYPE.PROPERTY_KEY_BASE_UUID]
+        basememory_uuid = basevm[CLOUDLET_TYPE.IMAGE_TYPE_BASE_MEM]
+        diskhash_uuid = basevm[CLOUDLET_TYPE.IMAGE_TYPE_BASE_DISK_HASH]
+        memoryhash_uuid = basevm[CLOUDLET_TYPE.IMAGE_TYPE_BASE_MEM_HASH]
 
     if base_sha256_uuid is None or basememory_uuid is None or \
             diskhash_uuid is None or memoryhash_uuid is None:
@@ -613,6 +616,7 @@ def request_export_basevm(server_address, token, end_point,
                          (os.path.basename(filename), filename))
         sys.stdout.flush()
         overlay_download(server_address, token, end_point, uuid, filename)
+    convert_to_sparse_raw(download_list[basedisk_uuid])
     sys.stdout.write("start packaging...(this can take a while)")
     BaseVMPackage.create(output_file, base_sha256_uuid,
                          download_list[basedisk_uuid],
@@ -713,15 +717,14 @@ def get_ref_id(server_address, token, end_point, ref_string, name):
 
     params = urllib.urlencode({})
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
-    conn = httplib.HTTPConnection(end_point[1])
-    conn.request("GET", "%s/%s" % (end_point[2], ref_string), params, headers)
     print "requesting %s/%s" % (end_point[2], ref_string)
+    response = cloudlet_http.request("GET", end_point[1],
+                                     "%s/%s" % (end_point[2], ref_string),
+                                     params, headers,
+                                     scheme=end_point.scheme)
 
     # HTTP response
-    response = conn.getresponse()
-    data = response.read()
-    dd = json.loads(data)
-    conn.close()
+    dd = json.loads(response.data)
 
     # Server image URL
     n = len(dd[ref_string])
@@ -749,6 +752,7 @@ def main(argv=None):
     CMD_EXPORT_BASE = "export-base"
     CMD_IMPORT_BASE = "import-base"
     CMD_CREATE_OVERLAY = "create-overlay"
+    CMD_CHECKPOINT_OVERLAY = "checkpoint-overlay"
     CMD_DOWNLOAD = "download"
     CMD_SYNTHESIS = "synthesis"
     CMD_HANDOFF = "handoff"
@@ -757,6 +761,7 @@ def main(argv=None):
     commands = {
         CMD_CREATE_BASE: "create base vm from the running instance",
         CMD_CREATE_OVERLAY: "create VM overlay from the customizaed VM",
+        CMD_CHECKPOINT_OVERLAY: "create VM overlay and keep the VM running",
         CMD_DOWNLOAD: "Download VM overlay",
         CMD_SYNTHESIS: "VM Synthesis (Need downloadable URLs for VM overlay)",
         CMD_HANDOFF: "Perform VM handoff to destination URL",
@@ -803,6 +808,22 @@ def main(argv=None):
                                      instance_uuid,
                                      snapshot_name)
         pprint(ret)
+    elif args[0] == CMD_CHECKPOINT_OVERLAY:
+        if len(args) != 3:
+            msg = "Error: checkpointing VM overlay needs [VM UUID] and [new name]\n"
+            msg += " 1) VM UUID: UUID of a running instance that you want to create VM overlay\n"
+            msg += " 2) new name: name for VM overlay\n"
+            sys.stderr.write(msg)
+            sys.exit(1)
+        instance_uuid = args[1]
+        snapshot_name = args[2]
+        ret = request_create_overlay(settings.server_address,
+                                     token,
+                                     urlparse(endpoint),
+                                     instance_uuid,
+                                     snapshot_name,
+                                     checkpoint=True)
+        pprint(ret)
     elif args[0] == CMD_DOWNLOAD:
         if len(args) != 2:
             msg = "Error: downlading VM overlay needs [Image UUID]\n"
@@ -17,9 +17,26 @@
 #
 
 
+import calendar
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import functools
+import heapq
+import itertools
 import os
+import pickle
+import re
 import uuid
 import hashlib
+import json
+import struct
+import threading
+import time
+import urllib2
+import zlib
 import subprocess
 import select
 import shutil
@@ -27,11 +44,18 @@ import StringIO
 from urlparse import urlsplit
 from tempfile import mkdtemp    # replace it to util.tempdir
 
+import eventlet
+from eventlet import event
+from eventlet import tpool
+from oslo.config import cfg
+
 from nova.virt.libvirt import blockinfo
 from nova.compute import power_state
+from nova import context as nova_context
 from nova import exception
 from nova import utils
 from nova.virt import driver
+from nova.virt import images
 from nova.virt.libvirt import utils as libvirt_utils
 from nova.image import glance
 from nova.compute import task_states
@@ -46,6 +70,8 @@ from nova.openstack.common import loopingcall
 
 from nova.virt.libvirt import driver as libvirt_driver
 from nova.compute.cloudlet_api import CloudletAPI
+from nova.compute import cloudlet_http
+from nova.compute import cloudlet_overlay
 
 from xml.etree import ElementTree
 from elijah.provisioning import synthesis
@@ -64,6 +90,132 @@ import logging
 LOG = logging.getLogger(__name__)
 synthesis.LOG = LOG  # overwrite cloudlet's own log
 
+cloudlet_driver_opts = [
+    cfg.StrOpt('cloudlet_service_auth_url',
+               default=None,
+               help='Keystone v2.0 URL for getting a token used by periodic '
+                    'cloudlet tasks (e.g. http://controller:35357/v2.0)'),
+    cfg.StrOpt('cloudlet_service_user',
+               default='nova',
+               help='Keystone user of periodic cloudlet tasks'),
+    cfg.StrOpt('cloudlet_service_password',
+               default=None,
+               secret=True,
+               help='Keystone password of periodic cloudlet tasks'),
+    cfg.StrOpt('cloudlet_service_tenant',
+               default='service',
+               help='Keystone tenant of periodic cloudlet tasks'),
+    cfg.IntOpt('cloudlet_standby_pool_bases',
+               default=4,
+               help='Number of recently synthesized base VMs whose files '
+                    '(disk, memory snapshot and hash lists) are kept '
+                    'downloaded in the image cache. No VM or synthesis '
+                    'scaffolding is prepared in advance. 0 disables the '
+                    'pool'),
+    cfg.IntOpt('cloudlet_standby_pool_size',
+               default=1,
+               help='Number of syntheses of each base VM that can use its '
+                    'staged files before they are checked and downloaded '
+                    'again'),
+    cfg.DictOpt('cloudlet_standby_pool_sizes',
+                default={},
+                help='cloudlet_standby_pool_size of specific base VMs as '
+                     'base_sha256:size pairs'),
+    cfg.IntOpt('cloudlet_max_network_fetch',
+               default=2,
+               help='Maximum number of concurrent base VM downloads. '
+                    '0 means unlimited'),
+    cfg.IntOpt('cloudlet_max_decompress',
+               default=2,
+               help='Maximum number of concurrent VM overlay downloads and '
+                    'decompressions. 0 means unlimited'),
+    cfg.IntOpt('cloudlet_max_delta_apply',
+               default=2,
+               help='Maximum number of concurrent VM syntheses and handoff '
+                    'receptions. 0 means unlimited'),
+    cfg.IntOpt('cloudlet_max_residue',
+               default=1,
+               help='Maximum number of concurrent VM overlay and residue '
+                    'generations. 0 means unlimited'),
+    cfg.IntOpt('cloudlet_bandwidth_handoff',
+               default=0,
+               help='Rate limit in KB/s for VM handoff traffic. '
+                    '0 means unlimited'),
+    cfg.IntOpt('cloudlet_bandwidth_overlay',
+               default=0,
+               help='Rate limit in KB/s for VM synthesis and overlay '
+                    'traffic. 0 means unlimited'),
+    cfg.IntOpt('cloudlet_bandwidth_base_upload',
+               default=0,
+               help='Rate limit in KB/s for uploading a new base VM. '
+                    '0 means unlimited'),
+    cfg.IntOpt('cloudlet_bandwidth_prefetch',
+               default=10240,
+               help='Rate limit in KB/s for background base VM staging. '
+                    '0 means unlimited'),
+    cfg.FloatOpt('cloudlet_bandwidth_yield_time',
+                 default=1.0,
+                 help='Seconds a traffic class pauses after traffic of a '
+                      'higher class. 0 disables strict priority'),
+    cfg.BoolOpt('cloudlet_base_live_snapshot',
+                default=False,
+                help='Extract the base disk while the VM is running and '
+                     'pause it only to merge recent writes and capture '
+                     'memory. Needs file based instance disks'),
+    cfg.BoolOpt('cloudlet_base_sparse_upload',
+                default=False,
+                help='Upload the base disk as qcow2, which leaves out zero '
+                     'clusters, instead of a dense raw image. Base VM '
+                     'export and import of the dashboard and '
+                     'cloudlet_client expect raw base disks'),
+    cfg.BoolOpt('cloudlet_memory_sharing',
+                default=False,
+                help='Run KSM while VMs resumed from the same base VM are '
+                     'co-resident, so that their unmodified memory pages '
+                     'are shared copy-on-write. The host-wide KSM settings '
+                     'are left to ksmtuned while it is running'),
+    cfg.IntOpt('cloudlet_ksm_pages_to_scan',
+               default=1000,
+               help='KSM pages to scan per wake-up while base VMs share '
+                    'memory'),
+    cfg.IntOpt('cloudlet_ksm_sleep_millisecs',
+               default=20,
+               help='KSM sleep time between scans while base VMs share '
+                    'memory'),
+    cfg.IntOpt('cloudlet_working_set_trace_time',
+               default=30,
+               help='Seconds for recording the disk working set after the '
+                    'first synthesis of a VM overlay. 0 disables tracing'),
+    cfg.BoolOpt('cloudlet_working_set_prefetch',
+                default=True,
+                help='Prefetch disk chunks in the recorded working set order '
+                     'when synthesizing a VM overlay'),
+    cfg.IntOpt('cloudlet_overlay_workers',
+               default=0,
+               help='Number of worker processes for each stage (disk diff, '
+                    'memory diff, compression) of handoff-proc, which '
+                    'creates handoff residues and checkpoints of '
+                    'synthesized VMs. Overlays of resumed base VMs are '
+                    'created serially by elijah. 0 uses the default mode '
+                    'of elijah'),
+    cfg.BoolOpt('cloudlet_overlay_streaming_upload',
+                default=True,
+                help='Upload the VM overlay to glance as a zip stream built '
+                     'from the overlay files instead of writing a local zip '
+                     'file first'),
+    cfg.StrOpt('cloudlet_glance_store_path',
+               default='/var/lib/glance/images',
+               help='Directory of the glance file store. glance:// overlays '
+                    'found there are read directly instead of through '
+                    'glance-api. Empty to always download them'),
+    cfg.IntOpt('cloudlet_overlay_fetch_connections',
+               default=4,
+               help='Number of concurrent range requests for fetching a VM '
+                    'overlay from a http(s) URL'),
+]
+CONF = cfg.CONF
+CONF.register_opts(cloudlet_driver_opts)
+
 
 class CloudletDriver(libvirt_driver.LibvirtDriver):
 
@@ -74,6 +226,17 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
         self.resumed_vm_dict = dict()
         # manage synthesized VM list
         self.synthesized_vm_dics = dict()
+        # decompressed VM overlays of synthesized VMs (for cache report)
+        self.synthesized_overlay_dict = dict()
+        # base VM files staged for the next synthesis
+        self.standby_pool = BaseVMStandbyPool(
+            CONF.cloudlet_standby_pool_bases,
+            CONF.cloudlet_standby_pool_size,
+            CONF.cloudlet_standby_pool_sizes)
+        # copy-on-write memory sharing between VMs of the same base VM
+        self.memory_sharing = BaseMemorySharing()
+        # base VM files read by running VMs
+        self.base_file_refs = BaseFileReferences()
 
     def _get_snapshot_metadata(self, virt_dom, context, instance, snapshot_id):
         _image_service = glance.get_remote_image_service(context, snapshot_id)
@@ -106,13 +269,26 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
         metadata['container_format'] = base.get('container_format', 'bare')
         return metadata
 
+    def _upload_stream_to_glance(self, context, image_service, stream,
+                                 meta_id, metadata, traffic_class=None):
+        if traffic_class is None:
+            traffic_class = TrafficShaper.OVERLAY
+        image_service.update(context,
+                             meta_id,
+                             metadata,
+                             get_traffic_shaper().wrap_file(
+                                 stream, traffic_class))
+
     def _update_to_glance(self, context, image_service, filepath,
-                          meta_id, metadata):
+                          meta_id, metadata, traffic_class=None):
+        if traffic_class is None:
+            traffic_class = TrafficShaper.OVERLAY
         with libvirt_utils.file_open(filepath) as image_file:
             image_service.update(context,
                                  meta_id,
                                  metadata,
-                                 image_file)
+                                 get_traffic_shaper().wrap_file(
+                                     image_file, traffic_class))
 
     @exception.wrap_exception()
     def cloudlet_base(self, context, instance, vm_name,
@@ -130,9 +306,6 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
         except exception.InstanceNotFound:
             raise exception.InstanceNotRunning(instance_id=instance['uuid'])
 
-        # pause VM
-        self.pause(instance)
-
         (image_service, image_id) = glance.get_remote_image_service(
             context, instance['image_ref'])
 
@@ -151,32 +324,43 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
         (state, _max_mem, _mem, _cpus, _t) = virt_dom.info()
         state = libvirt_driver.LIBVIRT_POWER_STATE[state]
 
-        # creating base vm requires cold snapshotting
-        snapshot_backend = self.image_backend.snapshot(
-            disk_path,
-            image_type=source_format)
-
-        LOG.info(_("Beginning cold snapshot process"),
-                 instance=instance)
-        # not available at icehouse
-        # snapshot_backend.snapshot_create()
-
         update_task_state(task_state=task_states.IMAGE_PENDING_UPLOAD,
                           expected_state=None)
         snapshot_directory = libvirt_driver.CONF.libvirt.snapshots_directory
         fileutils.ensure_tree(snapshot_directory)
         with utils.tempdir(dir=snapshot_directory) as tmpdir:
-            try:
-                out_path = os.path.join(tmpdir, snapshot_name)
-                # At this point, base vm should be "raw" format
-                snapshot_backend.snapshot_extract(out_path, "raw")
-            finally:
-                # snapshotting logic is changed since icehouse.
-                #  : cannot find snapshot_create and snapshot_delete.
-                # snapshot_extract is replacing these two operations.
-                # snapshot_backend.snapshot_delete()
-                LOG.info(_("Snapshot extracted, beginning image upload"),
+            out_path = os.path.join(tmpdir, snapshot_name)
+            is_extracted = False
+            if CONF.cloudlet_base_live_snapshot:
+                LOG.info(_("Beginning live snapshot process"),
                          instance=instance)
+                is_extracted = self._extract_base_disk_live(
+                    instance, virt_dom, disk_path, source_format, out_path)
+
+            if not is_extracted:
+                # pause VM
+                self.pause(instance)
+
+                # creating base vm requires cold snapshotting
+                snapshot_backend = self.image_backend.snapshot(
+                    disk_path,
+                    image_type=source_format)
+
+                LOG.info(_("Beginning cold snapshot process"),
+                         instance=instance)
+                # not available at icehouse
+                # snapshot_backend.snapshot_create()
+                try:
+                    # At this point, base vm should be "raw" format
+                    snapshot_backend.snapshot_extract(out_path, "raw")
+                finally:
+                    # snapshotting logic is changed since icehouse.
+                    #  : cannot find snapshot_create and snapshot_delete.
+                    # snapshot_extract is replacing these two operations.
+                    # snapshot_backend.snapshot_delete()
+                    pass
+            LOG.info(_("Snapshot extracted, beginning image upload"),
+                     instance=instance)
 
             # generate memory snapshop and hashlist
             basemem_path = os.path.join(tmpdir, snapshot_name+"-mem")
@@ -193,19 +377,104 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
                                      memhash_path,
                                      nova_util=libvirt_utils)
 
-            self._update_to_glance(context, image_service, out_path,
-                                   disk_meta_id, disk_metadata)
+            upload_path = out_path
+            disk_metadata['properties'][
+                CloudletAPI.PROPERTY_KEY_BASE_VIRTUAL_SIZE] = \
+                os.path.getsize(out_path)
+            if CONF.cloudlet_base_sparse_upload:
+                # qcow2 does not allocate clusters for zero chunks
+                upload_path = out_path + ".qcow2"
+                utils.execute('qemu-img', 'convert', '-f', 'raw',
+                              '-O', 'qcow2', out_path, upload_path)
+                disk_metadata['disk_format'] = 'qcow2'
+            LOG.info(_("Uploading base disk: %d bytes of %d bytes raw disk") %
+                     (os.path.getsize(upload_path), os.path.getsize(out_path)),
+                     instance=instance)
+            self._update_to_glance(context, image_service, upload_path,
+                                   disk_meta_id, disk_metadata,
+                                   TrafficShaper.BASE_UPLOAD)
             LOG.info(_("Base disk upload complete"), instance=instance)
             self._update_to_glance(context, image_service, basemem_path,
-                                   memory_meta_id, mem_metadata)
+                                   memory_meta_id, mem_metadata,
+                                   TrafficShaper.BASE_UPLOAD)
             LOG.info(_("Base memory image upload complete"), instance=instance)
             self._update_to_glance(context, image_service, diskhash_path,
-                                   diskhash_meta_id, diskhash_metadata)
+                                   diskhash_meta_id, diskhash_metadata,
+                                   TrafficShaper.BASE_UPLOAD)
             LOG.info(_("Base disk upload complete"), instance=instance)
             self._update_to_glance(context, image_service, memhash_path,
-                                   memoryhash_meta_id, memhash_metadata)
+                                   memoryhash_meta_id, memhash_metadata,
+                                   TrafficShaper.BASE_UPLOAD)
             LOG.info(_("Base memory image upload complete"), instance=instance)
 
+    def _extract_base_disk_live(self, instance, virt_dom, disk_path,
+                                source_format, out_path):
+        """Extract the base disk to raw out_path while the VM is running
+
+        An external disk-only snapshot redirects guest writes to a new
+        qcow2 file so that the original disk can be converted in the
+        background. Then the VM is paused and only the writes made in the
+        meantime are committed to out_path. The VM stays paused for the
+        memory capture.
+
+        :returns: False if live snapshot is not possible (VM is not paused)
+        """
+        if libvirt_driver.CONF.libvirt.images_type not in \
+                ('default', 'qcow2', 'raw'):
+            LOG.warning(_("Live snapshot needs file based disks. "
+                          "Use cold snapshot"), instance=instance)
+            return False
+
+        # redirect writes of the root disk only
+        delta_path = disk_path + ".cloudlet-live"
+        xml = ElementTree.fromstring(virt_dom.XMLDesc(0))
+        snapshot_xml = ElementTree.Element("domainsnapshot")
+        disks_xml = ElementTree.SubElement(snapshot_xml, "disks")
+        for disk in xml.findall("devices/disk"):
+            target = disk.find("target")
+            source = disk.find("source")
+            if target is None or disk.get("device") != "disk":
+                continue
+            disk_xml = ElementTree.SubElement(disks_xml, "disk",
+                                              name=target.get("dev"))
+            if source is not None and source.get("file") == disk_path:
+                disk_xml.set("snapshot", "external")
+                ElementTree.SubElement(disk_xml, "source", file=delta_path)
+            else:
+                disk_xml.set("snapshot", "no")
+        flags = (libvirt_driver.libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY |
+                 libvirt_driver.libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA)
+        try:
+            virt_dom.snapshotCreateXML(ElementTree.tostring(snapshot_xml),
+                                       flags)
+        except libvirt_driver.libvirt.libvirtError as e:
+            LOG.warning(_("Cannot create live snapshot: %s. "
+                          "Use cold snapshot") % str(e), instance=instance)
+            return False
+
+        # original disk is not written anymore
+        utils.execute('qemu-img', 'convert', '-f', source_format,
+                      '-O', 'raw', disk_path, out_path)
+        LOG.info(_("Base disk extracted while running, merging recent "
+                   "writes"), instance=instance)
+
+        # pausing flushes the block devices of the VM
+        self.pause(instance)
+        pause_time = time.time()
+        delta_copy = out_path + ".delta"
+        try:
+            shutil.copyfile(delta_path, delta_copy)
+            # delta is based on the disk just extracted to out_path
+            utils.execute('qemu-img', 'rebase', '-u', '-f', 'qcow2',
+                          '-b', out_path, '-F', 'raw', delta_copy)
+            utils.execute('qemu-img', 'commit', '-f', 'qcow2', delta_copy)
+        finally:
+            if os.path.exists(delta_copy):
+                os.remove(delta_copy)
+        LOG.info(_("Recent writes merged in %.1f s") %
+                 (time.time() - pause_time), instance=instance)
+        return True
+
     def _create_network_only(self, xml, instance, network_info,
                              block_device_info=None):
         """Only perform network setup but skip set-up for domain (vm instance)
@@ -271,20 +540,168 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
         if vm_overlay is None:
             raise exception.InstanceNotRunning(instance_id=instance['uuid'])
         del self.resumed_vm_dict[instance['uuid']]
-        vm_overlay.create_overlay()
-        overlay_zip = vm_overlay.overlay_zipfile
-        LOG.info("overlay : %s" % str(overlay_zip))
+        is_streaming = CONF.cloudlet_overlay_streaming_upload and \
+            self._has_overlay_files(vm_overlay)
+        if is_streaming:
+            # keep overlay files unpacked to zip them while uploading
+            vm_overlay.options.ZIP_CONTAINER = False
+        with get_admission_controller().admit(
+                AdmissionController.RESIDUE,
+                AdmissionController.PRIORITY_OVERLAY):
+            vm_overlay.create_overlay()
 
         update_task_state(task_state=task_states.IMAGE_UPLOADING,
                           expected_state=task_states.IMAGE_PENDING_UPLOAD)
 
-        # export to glance
-        self._update_to_glance(context, image_service, overlay_zip,
-                               overlay_id, meta_metadata)
+        if is_streaming:
+            self._upload_overlay_files(context, image_service, overlay_id,
+                                       meta_metadata,
+                                       vm_overlay.overlay_metafile,
+                                       vm_overlay.overlay_files)
+        else:
+            overlay_zip = vm_overlay.overlay_zipfile
+            LOG.info("overlay : %s" % str(overlay_zip))
+
+            # export to glance
+            self._update_to_glance(context, image_service, overlay_zip,
+                                   overlay_id, meta_metadata)
+            if os.path.exists(overlay_zip):
+                os.remove(overlay_zip)
         LOG.info(_("overlay_vm upload complete"), instance=instance)
 
-        if os.path.exists(overlay_zip):
-            os.remove(overlay_zip)
+    def _has_overlay_files(self, vm_overlay):
+        """Return True if elijah can leave the overlay files unpacked
+
+        VM_Overlay of older elijah always creates the overlay zip and does
+        not expose the overlay meta and blob files.
+        """
+        return hasattr(vm_overlay.options, 'ZIP_CONTAINER') and \
+            hasattr(vm_overlay, 'overlay_metafile') and \
+            hasattr(vm_overlay, 'overlay_files')
+
+    def _upload_overlay_files(self, context, image_service, overlay_id,
+                              metadata, overlay_metafile, overlay_files):
+        """Upload the overlay meta and blobs as one zip stream
+
+        Falls back to a local zip file when the overlay does not fit into
+        a zip without ZIP64 extensions.
+        """
+        members = [(Cloudlet_Const.OVERLAY_META, overlay_metafile)]
+        members += [(os.path.basename(blob), blob) for blob in overlay_files]
+        try:
+            total_size = sum(os.path.getsize(path) for (name, path) in members)
+            if OverlayZipStream.fits(members, total_size):
+                LOG.info("overlay : streaming %d files (%d bytes)" %
+                         (len(members), total_size))
+                self._upload_stream_to_glance(
+                    context, image_service, OverlayZipStream(members),
+                    overlay_id, metadata)
+            else:
+                overlay_zip = os.path.join(
+                    os.path.dirname(overlay_metafile),
+                    Cloudlet_Const.OVERLAY_ZIP)
+                LOG.info("overlay : %s" % str(overlay_zip))
+                VMOverlayPackage.create(overlay_zip, overlay_metafile,
+                                        overlay_files)
+                try:
+                    self._update_to_glance(context, image_service,
+                                           overlay_zip, overlay_id, metadata)
+                finally:
+                    os.remove(overlay_zip)
+        finally:
+            for (name, path) in members:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def checkpoint_overlay_vm(self, context, instance,
+                              overlay_name, overlay_id, update_task_state):
+        """Create VM overlay from the current state and keep the VM running
+
+        The VM is stopped to generate the overlay, and then synthesized
+        again from the base VM and the new overlay, so that the next
+        checkpoint can be created from the synthesized VM right away.
+        """
+        try:
+            if hasattr(self, "_lookup_by_name"):
+                # icehouse
+                virt_dom = self._lookup_by_name(instance['name'])
+            else:
+                # kilo
+                virt_dom = self._host.get_domain(instance)
+        except exception.InstanceNotFound:
+            raise exception.InstanceNotRunning(instance_id=instance['uuid'])
+        instance_uuid = str(instance['uuid'])
+        if instance_uuid not in self.resumed_vm_dict and \
+                instance_uuid not in self.synthesized_vm_dics:
+            raise exception.InstanceNotRunning(instance_id=instance_uuid)
+
+        (image_service, image_id) = glance.get_remote_image_service(
+            context, instance['image_ref'])
+        image_meta = image_service.show(context, image_id)
+        base_sha256_uuid, memory_snap_id, diskhash_snap_id, memhash_snap_id = \
+            self._get_basevm_meta_info(image_meta)
+        base_vm_paths = [
+            self._get_cache_image(context, instance, image_meta['id']),
+            self._get_cache_image(context, instance, memory_snap_id),
+            self._get_cache_image(context, instance, diskhash_snap_id),
+            self._get_cache_image(context, instance, memhash_snap_id)]
+        meta_metadata = self._get_snapshot_metadata(virt_dom, context,
+                                                    instance, overlay_id)
+        # nova's domain XML saved at spawn
+        xml_path = os.path.join(libvirt_utils.get_instance_path(instance),
+                                'libvirt.xml')
+        with open(xml_path) as xml_file:
+            xml = self._polish_VM_configuration(
+                ElementTree.fromstring(xml_file.read()))
+
+        update_task_state(task_state=task_states.IMAGE_PENDING_UPLOAD,
+                          expected_state=None)
+        vm_overlay = self.resumed_vm_dict.get(instance_uuid, None)
+        synthesized_vm = self.synthesized_vm_dics.get(instance_uuid, None)
+        overlay_tmp_dir = None
+        with get_admission_controller().admit(
+                AdmissionController.RESIDUE,
+                AdmissionController.PRIORITY_OVERLAY):
+            if vm_overlay is not None:
+                vm_overlay.create_overlay()
+                overlay_zip = vm_overlay.overlay_zipfile
+            else:
+                # residue of a synthesized VM is an overlay of the base VM
+                overlay_tmp_dir = mkdtemp(prefix="cloudlet-residue-")
+                try:
+                    overlay_zip = self._handoff_send(
+                        base_vm_paths, base_sha256_uuid, synthesized_vm,
+                        "file://%s" % overlay_name, overlay_tmp_dir)
+                except handoff.HandoffError as e:
+                    shutil.rmtree(overlay_tmp_dir, ignore_errors=True)
+                    msg = "failed to create VM overlay:\n"
+                    msg += str(e)
+                    raise exception.ImageNotFound(msg)
+        LOG.info("overlay : %s" % str(overlay_zip))
+        # the overlay is generated, so the VM is no longer tracked as is
+        self.resumed_vm_dict.pop(instance_uuid, None)
+        self.synthesized_vm_dics.pop(instance_uuid, None)
+        self.synthesized_overlay_dict.pop(instance_uuid, None)
+
+        try:
+            update_task_state(task_state=task_states.IMAGE_UPLOADING,
+                              expected_state=task_states.IMAGE_PENDING_UPLOAD)
+            self._update_to_glance(context, image_service, overlay_zip,
+                                   overlay_id, meta_metadata)
+            LOG.info(_("overlay_vm upload complete"), instance=instance)
+
+            # resume the VM from the overlay just created
+            overlay_url = "file://%s" % os.path.abspath(overlay_zip)
+            synthesized_vm = self._spawn_using_synthesis(
+                context, instance, xml, image_meta, overlay_url)
+            self.synthesized_vm_dics[instance_uuid] = synthesized_vm
+            LOG.info(_("Instance resumed from the checkpoint"),
+                     instance=instance)
+        finally:
+            if overlay_tmp_dir is not None:
+                shutil.rmtree(overlay_tmp_dir, ignore_errors=True)
+            elif os.path.exists(overlay_zip):
+                os.remove(overlay_zip)
 
     def perform_vmhandoff(self, context, instance, handoff_url,
                           update_task_state, residue_glance_id=None):
@@ -307,51 +724,72 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
         image_meta = image_service.show(context, image_id)
         base_sha256_uuid, memory_snap_id, diskhash_snap_id, memhash_snap_id = \
             self._get_basevm_meta_info(image_meta)
+        priority = AdmissionController.PRIORITY_HANDOFF
         basedisk_path = self._get_cache_image(
-            context, instance, image_meta['id'])
-        basemem_path = self._get_cache_image(context, instance, memory_snap_id)
+            context, instance, image_meta['id'], priority=priority)
+        basemem_path = self._get_cache_image(
+            context, instance, memory_snap_id, priority=priority)
         diskhash_path = self._get_cache_image(
-            context, instance, diskhash_snap_id)
+            context, instance, diskhash_snap_id, priority=priority)
         memhash_path = self._get_cache_image(
-            context, instance, memhash_snap_id)
+            context, instance, memhash_snap_id, priority=priority)
         base_vm_paths = [basedisk_path, basemem_path,
                          diskhash_path, memhash_path]
 
         update_task_state(task_state=task_states.IMAGE_PENDING_UPLOAD,
                           expected_state=None)
-        try:
-            residue_filepath = self._handoff_send(
-                base_vm_paths, base_sha256_uuid, synthesized_vm, handoff_url
-            )
-        except handoff.HandoffError as e:
-            msg = "failed to perform VM handoff:\n"
-            msg += str(e)
-            raise exception.ImageNotFound(msg)
+        # handoff data and the residue are removed when leaving the block
+        with utils.tempdir(prefix="cloudlet-residue-") as residue_tmp_dir:
+            try:
+                with get_admission_controller().admit(
+                        AdmissionController.RESIDUE, priority):
+                    residue_filepath = self._handoff_send(
+                        base_vm_paths, base_sha256_uuid, synthesized_vm,
+                        handoff_url, residue_tmp_dir)
+            except handoff.HandoffError as e:
+                msg = "failed to perform VM handoff:\n"
+                msg += str(e)
+                raise exception.ImageNotFound(msg)
 
-        del self.synthesized_vm_dics[instance['uuid']]
-        if residue_filepath:
-            LOG.info("residue saved at %s" % residue_filepath)
-        if residue_filepath and residue_glance_id:
-            # export to glance
-            (image_service, image_id) = glance.get_remote_image_service(
-                context, instance['image_ref'])
-            meta_metadata = self._get_snapshot_metadata(
-                virt_dom,
-                context,
-                instance,
-                residue_glance_id)
-            update_task_state(task_state=task_states.IMAGE_UPLOADING,
-                              expected_state=task_states.IMAGE_PENDING_UPLOAD)
-            self._update_to_glance(context, image_service, residue_filepath,
-                                   residue_glance_id, meta_metadata)
-        # clean up
-        LOG.info(_("VM residue upload complete"), instance=instance)
-        if residue_filepath and os.path.exists(residue_filepath):
-            os.remove(residue_filepath)
+            del self.synthesized_vm_dics[instance['uuid']]
+            if residue_filepath:
+                LOG.info("residue saved at %s" % residue_filepath)
+            if residue_filepath and residue_glance_id:
+                # export to glance
+                (image_service, image_id) = glance.get_remote_image_service(
+                    context, instance['image_ref'])
+                meta_metadata = self._get_snapshot_metadata(
+                    virt_dom,
+                    context,
+                    instance,
+                    residue_glance_id)
+                residue_size = os.path.getsize(residue_filepath)
+                meta_metadata['properties'][
+                    CloudletAPI.PROPERTY_KEY_RESIDUE_SIZE] = residue_size
+                update_task_state(
+                    task_state=task_states.IMAGE_UPLOADING,
+                    expected_state=task_states.IMAGE_PENDING_UPLOAD)
+                start_time = time.time()
+                self._update_to_glance(context, image_service,
+                                       residue_filepath, residue_glance_id,
+                                       meta_metadata, TrafficShaper.HANDOFF)
+                upload_time = max(time.time() - start_time, 1e-3)
+                upload_bps = int(8 * residue_size / upload_time)
+                LOG.info(_("VM residue upload complete (%d bytes, %d bps)") %
+                         (residue_size, upload_bps), instance=instance)
+                image_service.update(
+                    context, residue_glance_id,
+                    {'properties': {
+                        CloudletAPI.PROPERTY_KEY_RESIDUE_UPLOAD_BPS:
+                        upload_bps}},
+                    purge_props=False)
 
     def _handoff_send(self, base_vm_paths, base_hashvalue,
-                      synthesized_vm, handoff_url):
-        """
+                      synthesized_vm, handoff_url, residue_tmp_dir):
+        """Run handoff-proc with the handoff data saved in residue_tmp_dir
+
+        :returns: path of the residue zip file in residue_tmp_dir for
+        file:// handoff URL, otherwise None
         """
         # preload basevm hash dictionary for creating residue
         (basedisk_path, basemem_path,
@@ -366,7 +804,6 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
         options.DISK_ONLY = False
 
         # Set up temp file path for data structure and residue
-        residue_tmp_dir = mkdtemp(prefix="cloudlet-residue-")
         handoff_send_datafile = os.path.join(residue_tmp_dir, "handoff_data")
 
         residue_zipfile = None
@@ -377,8 +814,7 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
                 residue_tmp_dir, Cloudlet_Const.OVERLAY_ZIP)
             dest_handoff_url = "file://%s" % os.path.abspath(residue_zipfile)
 
-        # handoff mode --> fix it to be serializable
-        handoff_mode = None  # use default
+        handoff_mode = self._get_overlay_creation_mode()
 
         # data structure for handoff sending
         handoff_ds_send = handoff.HandoffDataSend()
@@ -428,7 +864,40 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
         LOG.info("Handoff send finishes")
         return residue_zipfile
 
-    def _get_cache_image(self, context, instance, snapshot_id, suffix=''):
+    def _get_overlay_creation_mode(self):
+        """Return multi-process pipelined mode of handoff-proc
+
+        Only _handoff_send takes the mode. VM_Overlay.create_overlay, which
+        creates overlays of resumed base VMs, has no mode to set.
+
+        :returns: VMOverlayCreationMode or None to use the default mode
+        """
+        workers = CONF.cloudlet_overlay_workers
+        if workers <= 0:
+            return None
+        mode_class = getattr(handoff, "VMOverlayCreationMode", None)
+        if mode_class is None or not hasattr(
+                mode_class, "get_pipelined_multi_process_finite_queue"):
+            LOG.warning(_("elijah does not support multi-process overlay "
+                          "creation. Use default mode"))
+            return None
+        mode = mode_class.get_pipelined_multi_process_finite_queue()
+        # disk and memory diffs run concurrently in separate stages
+        mode.NUM_PROC_DISK_DIFF = workers
+        mode.NUM_PROC_MEMORY_DIFF = workers
+        mode.NUM_PROC_OPTIMIZATION = workers
+        mode.NUM_PROC_COMPRESSION = workers
+        try:
+            # handoff data is passed to handoff-proc as a file
+            pickle.dumps(mode)
+        except (pickle.PicklingError, TypeError) as e:
+            LOG.warning(_("Cannot pass overlay creation mode to "
+                          "handoff-proc: %s") % str(e))
+            return None
+        return mode
+
+    def _get_cache_image(self, context, instance, snapshot_id, suffix='',
+                         priority=None):
         def basepath(fname='', suffix=suffix):
             return os.path.join(libvirt_utils.get_instance_path(instance),
                                 fname + suffix)
@@ -440,23 +909,44 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
         fileutils.ensure_tree(basepath(suffix=''))
         fname = hashlib.sha1(snapshot_id).hexdigest()
         LOG.debug(_("cloudlet, caching file at %s" % fname))
-        size = instance['root_gb'] * 1024 * 1024 * 1024
-        if size == 0:
-            size = None
-
-        raw('disk').cache(fetch_func=libvirt_utils.fetch_image,
-                          context=context,
-                          filename=fname,
-                          size=size,
-                          image_id=snapshot_id,
-                          user_id=instance['user_id'],
-                          project_id=instance['project_id'])
+        size = None
+        if snapshot_id == instance['image_ref']:
+            # only the base disk becomes the instance disk. Memory snapshot
+            # and hash lists are not bound to the flavor's disk size
+            size = instance['root_gb'] * 1024 * 1024 * 1024
+            if size == 0:
+                size = None
+
+        if priority is None:
+            priority = AdmissionController.PRIORITY_SYNTHESIS
+        fetch_func = functools.partial(
+            _fetch_image_shaped,
+            traffic_class=TrafficShaper.PRIORITY_TRAFFIC_CLASS[priority])
+
+        def _cache():
+            raw('disk').cache(fetch_func=fetch_func,
+                              context=context,
+                              filename=fname,
+                              size=size,
+                              image_id=snapshot_id,
+                              user_id=instance['user_id'],
+                              project_id=instance['project_id'])
 
         # from cache method at virt/libvirt/imagebackend.py
         abspath = os.path.join(
             libvirt_driver.CONF.instances_path,
             libvirt_driver.CONF.image_cache_subdirectory_name,
             fname)
+        if os.path.exists(abspath):
+            # cached already, so do not wait behind downloads
+            _cache()
+        else:
+            with get_admission_controller().admit(
+                    AdmissionController.NETWORK_FETCH, priority):
+                _cache()
+        if snapshot_id == instance['image_ref']:
+            # nova might have cached the base disk for the instance disk
+            _ensure_raw_image_cache(abspath)
         return abspath
 
     def _polish_VM_configuration(self, xml):
@@ -544,6 +1034,13 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
                 overlay_url = instance_meta.get("overlay_url")
             if "handoff_info" in instance_meta.keys():
                 handoff_info = instance_meta.get("handoff_info")
+        overlay_meta = None
+        if (overlay_url is not None) and (handoff_info is None):
+            overlay_source = self._get_overlay_source(context, instance,
+                                                      overlay_url, image_meta)
+            mirrors = self._get_overlay_mirrors(instance)[0]
+            overlay_meta = self._validate_overlay(image_meta, overlay_source,
+                                                  mirrors)
 
         # original openstack logic
         disk_info = blockinfo.get_disk_info(
@@ -595,9 +1092,13 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
                                       block_device_info)
             synthesized_vm = self._spawn_using_synthesis(context, instance,
                                                          xml, image_meta,
-                                                         overlay_url)
+                                                         overlay_url,
+                                                         overlay_meta,
+                                                         overlay_source)
             instance_uuid = str(instance.get('uuid', ''))
             self.synthesized_vm_dics[instance_uuid] = synthesized_vm
+            self.synthesized_overlay_dict[instance_uuid] = (
+                image_meta['id'], hashlib.sha1(overlay_url).hexdigest())
         elif handoff_info is not None:
             # spawn instance using VM handoff
             LOG.debug(_('cloudlet, Handoff start'))
@@ -635,6 +1136,17 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
                                             network_info,
                                             block_device_info)
 
+        instance_uuid = str(instance.get('uuid', ''))
+        if base_sha256_uuid is not None and \
+                (instance_uuid in self.resumed_vm_dict or
+                 instance_uuid in self.synthesized_vm_dics):
+            self.memory_sharing.add(instance_uuid, base_sha256_uuid)
+            self.base_file_refs.acquire(
+                instance_uuid,
+                [_get_image_cache_path(image_id) for image_id in
+                 (image_meta['id'], memory_snap_id,
+                  diskhash_snap_id, memhash_snap_id)])
+
         LOG.debug(_("Instance is running"), instance=instance)
 
         def _wait_for_boot():
@@ -673,6 +1185,75 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
                 synthesized_VM.machine = None
             synthesized_VM.terminate()
             del self.synthesized_vm_dics[instance_uuid]
+        self.synthesized_overlay_dict.pop(instance_uuid, None)
+        self.memory_sharing.remove(instance_uuid)
+        self.base_file_refs.release(instance_uuid)
+
+    def cloudlet_cache_inventory(self):
+        """Return cached base VMs and decompressed VM overlays of this host
+
+        Base VMs are the image cache file names (sha1 of the image id), so
+        the scheduler matches them without looking up glance.
+        """
+        cache_dir = os.path.join(
+            libvirt_driver.CONF.instances_path,
+            libvirt_driver.CONF.image_cache_subdirectory_name)
+        try:
+            cached_files = os.listdir(cache_dir)
+        except OSError:
+            cached_files = list()
+        bases = [fname for fname in cached_files
+                 if len(fname) == 40 and
+                 all(c in "0123456789abcdef" for c in fname)]
+        overlays = set(overlay_hash for (image_id, overlay_hash)
+                       in self.synthesized_overlay_dict.values())
+        return {
+            't': int(time.time()),
+            'bases': sorted(bases),
+            'overlays': sorted(overlays),
+        }
+
+    def get_available_resource(self, nodename):
+        """Add the cloudlet cache inventory to the stats of the compute node
+
+        The resource tracker merges the stats from the driver into the
+        compute node, which the scheduler reads as HostState.stats
+        (see nova/scheduler/cloudlet_scheduler.py).
+        """
+        data = super(CloudletDriver, self).get_available_resource(nodename)
+        stats = data.get('stats', None) or {}
+        if isinstance(stats, basestring):
+            stats = json.loads(stats)
+        try:
+            stats[CloudletAPI.STATS_KEY_CACHE] = json.dumps(
+                self.cloudlet_cache_inventory())
+        except Exception as e:
+            LOG.warning(_("Cannot report cloudlet cache inventory: %s") %
+                        str(e))
+        data['stats'] = stats
+        return data
+
+    def cloudlet_admission_stats(self):
+        return get_admission_controller().get_stats()
+
+    def cloudlet_traffic_stats(self):
+        return get_traffic_shaper().get_stats()
+
+    def cloudlet_base_read_stats(self):
+        """Keep base files in use from aging out and report page cache
+        sharing of them
+        """
+        self.base_file_refs.touch()
+        return self.base_file_refs.get_stats()
+
+    def cloudlet_memory_sharing_stats(self):
+        return self.memory_sharing.get_stats()
+
+    def cloudlet_refill_standby_pool(self, context):
+        """Stage evicted base VM files again and report pool statistics
+        """
+        self.standby_pool.refill(context)
+        return self.standby_pool.get_stats()
 
     def resume_basevm(self, instance, xml, base_disk, base_memory,
                       base_diskmeta, base_memmeta, base_hashvalue):
@@ -696,71 +1277,253 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
         self.resumed_vm_dict[instance['uuid']] = vm_overlay
         synthesis.rettach_nic(virt_dom, vm_overlay.old_xml_str, xml)
 
-    def _spawn_using_synthesis(self, context, instance, xml,
-                               image_meta, overlay_url):
-        # download vm overlay
-        overlay_package = VMOverlayPackage(overlay_url)
-        meta_raw = overlay_package.read_meta()
-        meta_info = msgpack.unpackb(meta_raw)
-        basevm_sha256 = meta_info.get(Cloudlet_Const.META_BASE_VM_SHA256, None)
+    def _get_overlay_mirrors(self, instance):
+        """Return mirrors and sha256 of the overlay from instance metadata
+
+        Mirrors are given as overlay_mirror_<n> in the order of preference.
+        """
+        instance_meta = instance.get('metadata', None) or {}
+        mirrors = list()
+        for key in instance_meta.keys():
+            if key.startswith("overlay_mirror_") and \
+                    key[len("overlay_mirror_"):].isdigit():
+                mirrors.append((int(key[len("overlay_mirror_"):]),
+                                instance_meta[key]))
+        mirrors = [url for (index, url) in sorted(mirrors)]
+        return mirrors, instance_meta.get("overlay_sha256", None)
+
+    def _fetch_overlay(self, instance, overlay_url, meta_info, working_set,
+                       mirrors=None, sha256=None):
+        """Copy the VM overlay at http(s) URL to the instance directory
+
+        Frames are fetched with concurrent range requests striped across
+        the fastest mirrors, and frames with the disk chunks of the
+        working set come first. A copy is checked against sha256 if given.
+
+        :returns: local path of the overlay zip, or None to let elijah
+        download overlay_url
+        """
+        if urlsplit(overlay_url).scheme not in ("http", "https"):
+            return None
+        order = [Cloudlet_Const.OVERLAY_META]
+        if working_set is not None:
+            frame_index = cloudlet_overlay.get_frame_index(
+                meta_info, Cloudlet_Const.META_OVERLAY_FILES,
+                Cloudlet_Const.META_OVERLAY_FILE_NAME,
+                Cloudlet_Const.META_OVERLAY_FILE_DISK_CHUNKS)
+            for chunk in working_set['disk_chunks']:
+                name = frame_index.get(chunk, None)
+                if name is not None and name not in order:
+                    order.append(name)
+
+        overlay_path = os.path.join(libvirt_utils.get_instance_path(instance),
+                                    'overlay.zip')
+        start_time = time.time()
+        try:
+            reader = cloudlet_overlay.OverlayReader(overlay_url, mirrors)
+            reader.probe()
+            overlay_size = reader.copy_to(
+                overlay_path, order,
+                concurrency=CONF.cloudlet_overlay_fetch_connections,
+                sha256=sha256)
+        except cloudlet_overlay.OverlayIntegrityError as e:
+            os.remove(overlay_path)
+            if not mirrors:
+                raise exception.ImageUnacceptable(image_id=overlay_url,
+                                                  reason=str(e))
+            LOG.warning(_("Fetch overlay again without mirrors: %s") %
+                        str(e), instance=instance)
+            return self._fetch_overlay(instance, overlay_url, meta_info,
+                                       working_set, sha256=sha256)
+        except cloudlet_overlay.OverlayReaderError as e:
+            LOG.info(_("Download whole overlay: %s") % str(e),
+                     instance=instance)
+            if os.path.exists(overlay_path):
+                os.remove(overlay_path)
+            if sha256 is None:
+                return None
+            _download_overlay(overlay_url, overlay_path, sha256)
+            return overlay_path
+        LOG.info(_("Fetched overlay (%d bytes, %d frames first) in %.1f s") %
+                 (overlay_size, len(order), time.time() - start_time),
+                 instance=instance)
+        return overlay_path
+
+    def _validate_overlay(self, image_meta, overlay_url, mirrors=None):
+        """Check that the VM overlay is made from the requested base VM
+
+        Only the overlay meta is read, so an incompatible overlay fails
+        before any image or network setup for the instance.
+
+        :returns: unpacked overlay meta
+        """
         image_properties = image_meta.get("properties", None)
         if image_properties is None:
             msg = "image does not have properties for cloudlet metadata"
             raise exception.ImageNotFound(msg)
         image_sha256 = image_properties.get(CloudletAPI.PROPERTY_KEY_BASE_UUID)
 
+        # read only the meta of vm overlay
+        meta_info = _read_overlay_meta(overlay_url, mirrors)
+        basevm_sha256 = meta_info.get(Cloudlet_Const.META_BASE_VM_SHA256, None)
+
         # check basevm
         if basevm_sha256 != image_sha256:
             msg = "requested base vm is not compatible with openstack base disk %s != %s" \
                 % (basevm_sha256, image_sha256)
             raise exception.ImageNotFound(msg)
+        return meta_info
+
+    def _get_overlay_source(self, context, instance, overlay_url,
+                            image_meta):
+        """Return the URL to read the VM overlay from
+
+        glance://<image-id> is read from the glance file store when the
+        compute node has it, or from the image cache otherwise. Other URLs
+        are returned as they are.
+
+        A glance overlay is checked against the base VM of image_meta with
+        its image properties before it is downloaded.
+        """
+        parsed_url = urlsplit(overlay_url)
+        if parsed_url.scheme != "glance":
+            return overlay_url
+        image_id = parsed_url.netloc or parsed_url.path.strip("/")
+        image_service = glance.get_default_image_service()
+        overlay_meta = image_service.show(context, image_id)
+        if overlay_meta.get('status') != 'active':
+            raise exception.ImageNotFound(image_id=image_id)
+        overlay_properties = overlay_meta.get('properties', None) or {}
+        if overlay_properties.get(CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE) != \
+                CloudletAPI.IMAGE_TYPE_OVERLAY:
+            msg = "image %s is not a VM overlay" % image_id
+            raise exception.ImageNotFound(msg)
+        basevm_sha256 = overlay_properties.get(
+            CloudletAPI.PROPERTY_KEY_BASE_UUID, None)
+        image_properties = image_meta.get('properties', None) or {}
+        image_sha256 = image_properties.get(CloudletAPI.PROPERTY_KEY_BASE_UUID)
+        if basevm_sha256 is not None and basevm_sha256 != image_sha256:
+            msg = "requested base vm is not compatible with openstack base disk %s != %s" \
+                % (basevm_sha256, image_sha256)
+            raise exception.ImageNotFound(msg)
+
+        if CONF.cloudlet_glance_store_path:
+            store_path = os.path.join(CONF.cloudlet_glance_store_path,
+                                      image_id)
+            if os.access(store_path, os.R_OK) and \
+                    os.path.getsize(store_path) == overlay_meta.get('size'):
+                LOG.info(_("Read overlay %s from glance store") % image_id,
+                         instance=instance)
+                return "file://%s" % store_path
+        # not through the image backend, which would copy the overlay to
+        # the disk of the instance
+        cache_path = _fetch_to_image_cache(
+            context, image_id, AdmissionController.PRIORITY_SYNTHESIS)
+        return "file://%s" % cache_path
+
+    def _spawn_using_synthesis(self, context, instance, xml,
+                               image_meta, overlay_url, meta_info=None,
+                               overlay_source=None):
+        if overlay_source is None:
+            overlay_source = self._get_overlay_source(context, instance,
+                                                      overlay_url, image_meta)
+        mirrors, overlay_sha256 = self._get_overlay_mirrors(instance)
+        if meta_info is None:
+            meta_info = self._validate_overlay(image_meta, overlay_source,
+                                               mirrors)
+        image_properties = image_meta.get("properties")
+        image_sha256 = image_properties.get(CloudletAPI.PROPERTY_KEY_BASE_UUID)
         memory_snap_id = str(
             image_properties.get(CloudletAPI.IMAGE_TYPE_BASE_MEM))
         diskhash_snap_id = str(
             image_properties.get(CloudletAPI.IMAGE_TYPE_BASE_DISK_HASH))
         memhash_snap_id = str(
             image_properties.get(CloudletAPI.IMAGE_TYPE_BASE_MEM_HASH))
-        basedisk_path = self._get_cache_image(context, instance,
-                                              image_meta['id'])
-        basemem_path = self._get_cache_image(context, instance, memory_snap_id)
-        diskhash_path = self._get_cache_image(context, instance,
-                                              diskhash_snap_id)
-        memhash_path = self._get_cache_image(context, instance, memhash_snap_id)
+        base_image_ids = (image_meta['id'], memory_snap_id,
+                          diskhash_snap_id, memhash_snap_id)
+        staged_paths = self.standby_pool.claim(image_sha256, base_image_ids)
+        if staged_paths is not None:
+            basedisk_path, basemem_path, diskhash_path, memhash_path = \
+                staged_paths
+        else:
+            basedisk_path = self._get_cache_image(context, instance,
+                                                  image_meta['id'])
+            basemem_path = self._get_cache_image(context, instance,
+                                                 memory_snap_id)
+            diskhash_path = self._get_cache_image(context, instance,
+                                                  diskhash_snap_id)
+            memhash_path = self._get_cache_image(context, instance,
+                                                 memhash_snap_id)
+        self.standby_pool.request_refill(image_sha256)
 
         # download blob
         fileutils.ensure_tree(libvirt_utils.get_instance_path(instance))
         decomp_overlay = os.path.join(libvirt_utils.get_instance_path(instance),
             'decomp_overlay')
-
-        meta_info = compression.decomp_overlayzip(overlay_url, decomp_overlay)
-
-        # recover VM
-        launch_disk, launch_mem, fuse, delta_proc, fuse_proc = \
-            synthesis.recover_launchVM(basedisk_path, meta_info,
-                                       decomp_overlay,
-                                       base_mem=basemem_path,
-                                       base_diskmeta=diskhash_path,
-                                       base_memmeta=memhash_path)
-        # resume VM
-        LOG.info(_("Starting VM synthesis"), instance=instance)
-        synthesized_vm = synthesis.SynthesizedVM(launch_disk, launch_mem, fuse,
-                                                 disk_only=False,
-                                                 qemu_args=False,
-                                                 nova_xml=xml,
-                                                 nova_conn=self._conn,
-                                                 nova_util=libvirt_utils
-                                                 )
-        # testing non-thread resume
-        delta_proc.start()
-        fuse_proc.start()
-        delta_proc.join()
-        fuse_proc.join()
+        if os.path.exists(decomp_overlay):
+            # left by the previous synthesis of an overlay checkpoint
+            os.remove(decomp_overlay)
+
+        # working set recorded at the first synthesis
+        is_traceable = urlsplit(overlay_url).scheme != "file"
+        working_set = None
+        if is_traceable:
+            overlay_hash = hashlib.sha1(overlay_url).hexdigest()
+            working_set = get_working_set(image_sha256, overlay_hash)
+
+        admission = get_admission_controller()
+        priority = AdmissionController.PRIORITY_SYNTHESIS
+        with admission.admit(AdmissionController.NETWORK_FETCH, priority):
+            overlay_path = self._fetch_overlay(instance, overlay_source,
+                                               meta_info, working_set,
+                                               mirrors, overlay_sha256)
+        try:
+            with admission.admit(AdmissionController.DECOMPRESS, priority):
+                if overlay_path is not None:
+                    overlay_source = "file://%s" % overlay_path
+                meta_info = compression.decomp_overlayzip(overlay_source,
+                                                          decomp_overlay)
+        finally:
+            if overlay_path is not None and os.path.exists(overlay_path):
+                os.remove(overlay_path)
+
+        with admission.admit(AdmissionController.DELTA_APPLY, priority):
+            # recover VM
+            launch_disk, launch_mem, fuse, delta_proc, fuse_proc = \
+                synthesis.recover_launchVM(basedisk_path, meta_info,
+                                           decomp_overlay,
+                                           base_mem=basemem_path,
+                                           base_diskmeta=diskhash_path,
+                                           base_memmeta=memhash_path)
+            # resume VM
+            LOG.info(_("Starting VM synthesis"), instance=instance)
+            synthesized_vm = synthesis.SynthesizedVM(
+                launch_disk, launch_mem, fuse,
+                disk_only=False,
+                qemu_args=False,
+                nova_xml=xml,
+                nova_conn=self._conn,
+                nova_util=libvirt_utils
+            )
+            # testing non-thread resume
+            delta_proc.start()
+            fuse_proc.start()
+            delta_proc.join()
+            fuse_proc.join()
         LOG.info(_("Finish VM synthesis"), instance=instance)
+
+        if working_set is not None and CONF.cloudlet_working_set_prefetch:
+            eventlet.spawn_n(prefetch_working_set, launch_disk, working_set)
+
         synthesized_vm.resume()
         # rettach NIC
         synthesis.rettach_nic(synthesized_vm.machine,
                               synthesized_vm.old_xml_str, xml)
 
+        if is_traceable and working_set is None and \
+                CONF.cloudlet_working_set_trace_time > 0:
+            eventlet.spawn_n(trace_working_set, launch_disk,
+                             image_sha256, overlay_hash)
         return synthesized_vm
 
     def _spawn_using_handoff(self, context, instance, xml,
@@ -772,13 +1535,15 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
             image_properties.get(CloudletAPI.IMAGE_TYPE_BASE_DISK_HASH))
         memhash_snap_id = str(
             image_properties.get(CloudletAPI.IMAGE_TYPE_BASE_MEM_HASH))
-        basedisk_path = self._get_cache_image(context, instance,
-                                              image_meta['id'])
-        basemem_path = self._get_cache_image(context, instance, memory_snap_id)
-        diskhash_path = self._get_cache_image(context, instance,
-                                              diskhash_snap_id)
-        memhash_path = self._get_cache_image(context, instance,
-                                             memhash_snap_id)
+        priority = AdmissionController.PRIORITY_HANDOFF
+        basedisk_path = self._get_cache_image(
+            context, instance, image_meta['id'], priority=priority)
+        basemem_path = self._get_cache_image(
+            context, instance, memory_snap_id, priority=priority)
+        diskhash_path = self._get_cache_image(
+            context, instance, diskhash_snap_id, priority=priority)
+        memhash_path = self._get_cache_image(
+            context, instance, memhash_snap_id, priority=priority)
         base_vm_paths = [basedisk_path, basemem_path,
                          diskhash_path, memhash_path]
         image_sha256 = image_properties.get(CloudletAPI.PROPERTY_KEY_BASE_UUID)
@@ -795,10 +1560,11 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
             handoff_recv_datafile = os.path.join(tmp_dir, "handoff-data")
             # recv handoff data and synthesize disk img and memory snapshot
             try:
-                ret_values = self._handoff_recv(base_vm_paths, image_sha256,
-                                                handoff_recv_datafile,
-                                                launch_diskpath,
-                                                launch_memorypath)
+                with get_admission_controller().admit(
+                        AdmissionController.DELTA_APPLY, priority):
+                    ret_values = self._handoff_recv(
+                        base_vm_paths, image_sha256, handoff_recv_datafile,
+                        launch_diskpath, launch_memorypath)
                 # start VM
                 launch_disk_size, launch_memory_size, \
                     disk_overlay_map, memory_overlay_map = ret_values
@@ -881,3 +1647,1065 @@ class CloudletDriver(libvirt_driver.LibvirtDriver):
 
         synthesized_vm.resume()
         return synthesized_vm
+
+
+def _get_image_cache_path(image_id):
+    # same file name as _get_cache_image and the image backend
+    return os.path.join(CONF.instances_path,
+                        CONF.image_cache_subdirectory_name,
+                        hashlib.sha1(image_id).hexdigest())
+
+
+def _fetch_image_shaped(context, target, image_id, user_id, project_id,
+                        max_size=0, traffic_class=None):
+    """Download a cloudlet image from glance at the rate of traffic_class
+
+    Replaces libvirt_utils.fetch_image for the image cache. Zero chunks
+    are left as holes, and a qcow2 base disk (see
+    cloudlet_base_sparse_upload) is converted to a sparse raw image.
+    """
+    (image_service, image_id) = glance.get_remote_image_service(
+        context, image_id)
+    image_meta = image_service.show(context, image_id)
+    part_path = target + ".part"
+    raw_path = target + ".raw"
+    try:
+        with open(part_path, "wb") as image_file:
+            sparse_file = SparseFile(image_file)
+            image_service.download(
+                context, image_id,
+                data=get_traffic_shaper().wrap_file(sparse_file,
+                                                    traffic_class))
+            sparse_file.finish()
+        if image_meta.get('disk_format', 'raw') != 'raw':
+            # qemu-img does not write zero clusters
+            utils.execute('qemu-img', 'convert',
+                          '-f', image_meta['disk_format'],
+                          '-O', 'raw', part_path, raw_path)
+            os.rename(raw_path, part_path)
+        if max_size and os.path.getsize(part_path) > max_size:
+            raise exception.ImageUnacceptable(
+                image_id=image_id,
+                reason=_("Image is larger than the flavor's disk size"))
+        LOG.debug("cached image %s: %d bytes allocated of %d bytes "
+                  "(%d bytes transferred)" %
+                  (image_id, os.stat(part_path).st_blocks * 512,
+                   os.path.getsize(part_path), sparse_file.bytes_written))
+        os.rename(part_path, target)
+    finally:
+        for path in (part_path, raw_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _ensure_raw_image_cache(path):
+    """Convert a cached base disk to raw in place
+
+    nova's own image cache shares the file name and keeps a qcow2 base
+    disk as is when force_raw_images is off, but synthesis reads the base
+    disk as raw.
+    """
+    fname = os.path.basename(path)
+
+    @utils.synchronized(fname, external=True,
+                        lock_path=os.path.join(CONF.instances_path, 'locks'))
+    def _convert():
+        file_format = images.qemu_img_info(path).file_format
+        if file_format == 'raw':
+            return
+        LOG.info(_("Converting cached base disk %s from %s to raw") %
+                 (path, file_format))
+        raw_path = path + ".raw"
+        try:
+            utils.execute('qemu-img', 'convert', '-f', file_format,
+                          '-O', 'raw', path, raw_path)
+            os.rename(raw_path, path)
+        finally:
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+
+    _convert()
+
+
+def _fetch_to_image_cache(context, image_id, priority=None):
+    """Download a glance image into the image cache of this node
+
+    Unlike the cache method of the image backend, the file is not copied
+    to any instance directory.
+    """
+    if priority is None:
+        priority = AdmissionController.PRIORITY_BACKGROUND
+    path = _get_image_cache_path(image_id)
+    fname = os.path.basename(path)
+
+    # share the lock with the cache method at virt/libvirt/imagebackend.py
+    @utils.synchronized(fname, external=True,
+                        lock_path=os.path.join(CONF.instances_path, 'locks'))
+    def _fetch():
+        if not os.path.exists(path):
+            fileutils.ensure_tree(os.path.dirname(path))
+            _fetch_image_shaped(
+                context, path, image_id, None, None,
+                traffic_class=TrafficShaper.PRIORITY_TRAFFIC_CLASS[priority])
+        else:
+            # keep it from being aged out by the image cache manager
+            os.utime(path, None)
+
+    if os.path.exists(path):
+        _fetch()
+    else:
+        with get_admission_controller().admit(
+                AdmissionController.NETWORK_FETCH, priority):
+            _fetch()
+    return path
+
+
+class BaseVMStandbyPool(object):
+
+    """Keep the files of recently synthesized base VMs staged on this node.
+
+    Only the files are staged. No VM, launch disk or FUSE mount is
+    prepared before a synthesis.
+
+    Base memory snapshots and hash lists are not backing files of any
+    instance disk, so nova's image cache manager removes them as unused
+    base files, and the next synthesis downloads several GB again. The
+    pool remembers the most recently used base VMs, touches their files
+    to keep them from aging out, and fetches them again in the background
+    when they were removed.
+
+    Each base VM has its own number of standby entries. A synthesis claims
+    an entry and skips the cache step entirely if all the files of its base
+    VM are staged, and the claimed base VM is checked and staged again in
+    the background to fill its entries up.
+    """
+
+    def __init__(self, max_bases, size, base_sizes=None):
+        self.max_bases = max_bases
+        self.size = size
+        self.base_sizes = base_sizes or dict()
+        # base sha256 -> [(disk, memory, disk hash, memory hash) image ids,
+        #                 number of standby entries]
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.refilling = set()
+        self.stats = {'hits': 0, 'misses': 0, 'refills': 0,
+                      'refill_failures': 0, 'last_refill_time': 0.0,
+                      'total_refill_time': 0.0}
+
+    def get_size(self, base_sha256):
+        return int(self.base_sizes.get(base_sha256, self.size))
+
+    def claim(self, base_sha256, image_ids):
+        """Return cached file paths of the base VM or None if not staged
+        """
+        if self.max_bases <= 0 or self.get_size(base_sha256) <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.pop(base_sha256, None)
+            standby_count = entry[1] if entry is not None else 0
+            self.entries[base_sha256] = [tuple(image_ids),
+                                         max(standby_count - 1, 0)]
+            while len(self.entries) > self.max_bases:
+                self.entries.popitem(last=False)
+        paths = [_get_image_cache_path(image_id) for image_id in image_ids]
+        if standby_count > 0 and all(os.path.exists(path) for path in paths):
+            for path in paths:
+                os.utime(path, None)
+            # same check as _get_cache_image for the base disk
+            _ensure_raw_image_cache(paths[0])
+            with self.lock:
+                self.stats['hits'] += 1
+            return tuple(paths)
+        with self.lock:
+            self.stats['misses'] += 1
+        return None
+
+    def request_refill(self, base_sha256):
+        if self.max_bases <= 0:
+            return
+
+        def _refill():
+            try:
+                context = get_service_context()
+            except Exception as e:
+                LOG.warning(_("Cannot refill base VM %s: %s") %
+                            (base_sha256, str(e)))
+                return
+            self._refill_base(context, base_sha256)
+
+        eventlet.spawn_n(_refill)
+
+    def refill(self, context):
+        with self.lock:
+            bases = self.entries.keys()
+        for base_sha256 in bases:
+            self._refill_base(context, base_sha256)
+
+    def _refill_base(self, context, base_sha256):
+        with self.lock:
+            entry = self.entries.get(base_sha256, None)
+            if entry is None or base_sha256 in self.refilling:
+                return
+            self.refilling.add(base_sha256)
+            image_ids = entry[0]
+        try:
+            if self._stage(context, base_sha256, image_ids):
+                with self.lock:
+                    entry = self.entries.get(base_sha256, None)
+                    if entry is not None:
+                        entry[1] = self.get_size(base_sha256)
+        finally:
+            with self.lock:
+                self.refilling.discard(base_sha256)
+
+    def _stage(self, context, base_sha256, image_ids):
+        missing = list()
+        for image_id in image_ids:
+            path = _get_image_cache_path(image_id)
+            if os.path.exists(path):
+                # keep it from being aged out by the image cache manager
+                os.utime(path, None)
+            else:
+                missing.append(image_id)
+        if not missing:
+            return True
+        start_time = time.time()
+        try:
+            for image_id in missing:
+                _fetch_to_image_cache(context, image_id)
+        except Exception as e:
+            LOG.warning(_("Cannot stage base VM %s: %s") %
+                        (base_sha256, str(e)))
+            with self.lock:
+                self.stats['refill_failures'] += 1
+            return False
+        refill_time = time.time() - start_time
+        LOG.info(_("Staged base VM %s in %.1f s") % (base_sha256, refill_time))
+        with self.lock:
+            self.stats['refills'] += 1
+            self.stats['last_refill_time'] = refill_time
+            self.stats['total_refill_time'] += refill_time
+        return True
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['max_bases'] = self.max_bases
+            # base sha256 -> (standby entries, pool size)
+            stats['bases'] = dict(
+                (base_sha256, (entry[1], self.get_size(base_sha256)))
+                for (base_sha256, entry) in self.entries.items())
+        return stats
+
+
+def _get_resident_pages(path):
+    """Return residency of each page of the file using mincore(2)
+
+    :returns: string with one byte per page. The least significant bit is
+    set for pages in the page cache
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                          ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                             ctypes.c_char_p]
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    size = os.path.getsize(path)
+    if size == 0:
+        return ''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        PROT_READ = 0x1
+        MAP_SHARED = 0x01
+        addr = libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), "mmap failed")
+        try:
+            pages = (size + page_size - 1) // page_size
+            vec = ctypes.create_string_buffer(pages)
+            if libc.mincore(addr, size, vec) != 0:
+                raise OSError(ctypes.get_errno(), "mincore failed")
+            return vec.raw
+        finally:
+            libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+
+
+def _get_resident_bytes(path):
+    """Return bytes of the file in the page cache
+    """
+    def _count_resident_pages():
+        resident = _get_resident_pages(path)
+        # mincore sets only the least significant bit
+        return len(resident) - resident.count("\x00")
+
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    # base files are GBs, so do not block other greenthreads
+    resident_pages = tpool.execute(_count_resident_pages)
+    return min(resident_pages * page_size, os.path.getsize(path))
+
+
+def _download_overlay(overlay_url, overlay_path, sha256):
+    """Download the whole VM overlay and check its sha256
+    """
+    try:
+        overlay_file = urllib2.urlopen(overlay_url)
+        try:
+            with open(overlay_path, "wb") as f:
+                shutil.copyfileobj(overlay_file, f)
+        finally:
+            overlay_file.close()
+        cloudlet_overlay.verify_sha256(overlay_path, sha256)
+    except (IOError, cloudlet_overlay.OverlayReaderError) as e:
+        if os.path.exists(overlay_path):
+            os.remove(overlay_path)
+        raise exception.ImageUnacceptable(image_id=overlay_url,
+                                          reason=str(e))
+
+
+def _read_overlay_meta(overlay_url, mirrors=None):
+    """Return the unpacked meta of the VM overlay
+
+    The meta is read with range requests when the URL allows it, so the
+    rest of the overlay is not downloaded.
+    """
+    try:
+        reader = cloudlet_overlay.OverlayReader(overlay_url, mirrors)
+        meta_raw = reader.read_member(Cloudlet_Const.OVERLAY_META)
+    except cloudlet_overlay.OverlayReaderError as e:
+        LOG.debug("read overlay meta using elijah: %s" % str(e))
+        meta_raw = VMOverlayPackage(overlay_url).read_meta()
+    return msgpack.unpackb(meta_raw)
+
+
+def get_working_set(base_sha256, overlay_hash):
+    """Return disk working set recorded for the overlay
+
+    :returns: dict with chunk_size and disk_chunks in access order, or None
+    """
+    image_service = glance.get_default_image_service()
+    filters = {
+        'property-%s' % CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
+        CloudletAPI.IMAGE_TYPE_WORKING_SET,
+        'property-%s' % CloudletAPI.PROPERTY_KEY_OVERLAY_HASH: overlay_hash,
+    }
+    try:
+        context = get_service_context()
+        for image_meta in image_service.detail(context, filters=filters):
+            properties = image_meta.get('properties', None) or {}
+            if image_meta.get('status') != 'active' or \
+                    properties.get(CloudletAPI.PROPERTY_KEY_BASE_UUID) != \
+                    base_sha256:
+                continue
+            data = StringIO.StringIO()
+            image_service.download(context, image_meta['id'], data=data)
+            return json.loads(zlib.decompress(data.getvalue()))
+    except Exception as e:
+        LOG.warning(_("Cannot get working set of overlay %s: %s") %
+                    (overlay_hash, str(e)))
+    return None
+
+
+def prefetch_working_set(launch_disk, working_set):
+    """Read disk chunks through FUSE in the working set order
+    """
+    def _read_chunks():
+        chunk_size = working_set['chunk_size']
+        fd = os.open(launch_disk, os.O_RDONLY)
+        try:
+            for chunk in working_set['disk_chunks']:
+                os.lseek(fd, chunk * chunk_size, os.SEEK_SET)
+                os.read(fd, chunk_size)
+        finally:
+            os.close(fd)
+
+    start_time = time.time()
+    try:
+        # reads block on FUSE, so use a native thread
+        tpool.execute(_read_chunks)
+    except (OSError, IOError) as e:
+        LOG.warning(_("Cannot prefetch working set: %s") % str(e))
+        return
+    LOG.info(_("Prefetched %d chunks of working set in %.1f s") %
+             (len(working_set['disk_chunks']), time.time() - start_time))
+
+
+def trace_working_set(launch_disk, base_sha256, overlay_hash):
+    """Record the order of disk chunks read by the VM after resume
+
+    The guest's reads through the FUSE disk fill the page cache, so
+    sampling its residency gives the order in which the working set is
+    first touched. The trace is saved to glance with the overlay hash.
+    """
+    chunk_size = Cloudlet_Const.CHUNK_SIZE
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    seen = set()
+    disk_chunks = list()
+
+    def _sample():
+        resident = _get_resident_pages(launch_disk)
+        # mincore sets only the least significant bit
+        for match in re.finditer("\x01", resident):
+            chunk = match.start() * page_size // chunk_size
+            if chunk not in seen:
+                seen.add(chunk)
+                disk_chunks.append(chunk)
+
+    end_time = time.time() + CONF.cloudlet_working_set_trace_time
+    try:
+        while time.time() < end_time:
+            # scanning a multi-GB disk would block other greenthreads
+            tpool.execute(_sample)
+            eventlet.sleep(0.5)
+    except (OSError, IOError) as e:
+        # VM is terminated before the end of tracing
+        LOG.debug("stop tracing working set: %s" % str(e))
+    if not disk_chunks:
+        return
+
+    if get_working_set(base_sha256, overlay_hash) is not None:
+        # recorded by other synthesis in the meantime
+        return
+    image_service = glance.get_default_image_service()
+    metadata = {
+        'name': "working-set-%s" % overlay_hash,
+        # owned by the service project and hidden from other tenants
+        'is_public': False,
+        'disk_format': 'raw',
+        'container_format': 'bare',
+        'properties': {
+            CloudletAPI.PROPERTY_KEY_CLOUDLET: True,
+            CloudletAPI.PROPERTY_KEY_CLOUDLET_TYPE:
+            CloudletAPI.IMAGE_TYPE_WORKING_SET,
+            CloudletAPI.PROPERTY_KEY_BASE_UUID: base_sha256,
+            CloudletAPI.PROPERTY_KEY_OVERLAY_HASH: overlay_hash,
+        },
+    }
+    data = zlib.compress(json.dumps({'chunk_size': chunk_size,
+                                     'disk_chunks': disk_chunks}))
+    try:
+        context = get_service_context()
+        image_service.create(context, metadata, data=StringIO.StringIO(data))
+    except Exception as e:
+        LOG.warning(_("Cannot save working set of overlay %s: %s") %
+                    (overlay_hash, str(e)))
+        return
+    LOG.info(_("Saved working set of overlay %s (%d chunks)") %
+             (overlay_hash, len(disk_chunks)))
+
+
+class BaseFileReferences(object):
+
+    """Reference counts of the cached base VM files read by running VMs.
+
+    The cloudlet FUSE of every VM reads the base disk and memory from the
+    same file in the image cache, so the page cache holds one copy of a
+    base block for all the VMs of that base VM. This keeps the shared
+    files from being aged out by the image cache manager while referenced,
+    and reports how many bytes are deduplicated by sharing.
+    """
+
+    def __init__(self):
+        self.instance_paths = dict()    # instance uuid -> base file paths
+        self.lock = threading.Lock()
+
+    def acquire(self, instance_uuid, paths):
+        with self.lock:
+            self.instance_paths[instance_uuid] = list(paths)
+
+    def release(self, instance_uuid):
+        with self.lock:
+            self.instance_paths.pop(instance_uuid, None)
+
+    def get_refcounts(self):
+        with self.lock:
+            refcounts = collections.Counter()
+            for paths in self.instance_paths.values():
+                refcounts.update(paths)
+        return refcounts
+
+    def touch(self):
+        for path in self.get_refcounts():
+            try:
+                os.utime(path, None)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def get_stats(self):
+        """Return referenced, page cached, and deduplicated bytes
+
+        hit_ratio is the fraction of referenced base bytes in the page
+        cache, that is, the chance that a base read of a VM is served from
+        memory.
+        """
+        stats = {'files': 0, 'references': 0, 'referenced_bytes': 0,
+                 'resident_bytes': 0, 'dedup_bytes': 0, 'hit_ratio': 0.0}
+        for (path, refcount) in self.get_refcounts().iteritems():
+            try:
+                size = os.path.getsize(path)
+                resident = _get_resident_bytes(path)
+            except OSError as e:
+                LOG.debug("cannot read page cache of %s: %s" % (path, e))
+                continue
+            stats['files'] += 1
+            stats['references'] += refcount
+            stats['referenced_bytes'] += size
+            stats['resident_bytes'] += resident
+            # without sharing, each reference would cache its own copy
+            stats['dedup_bytes'] += resident * (refcount - 1)
+        if stats['referenced_bytes'] > 0:
+            stats['hit_ratio'] = float(stats['resident_bytes']) / \
+                stats['referenced_bytes']
+        return stats
+
+
+class BaseMemorySharing(object):
+
+    """Share memory of co-resident VMs resumed from the same base VM.
+
+    QEMU restores a private copy of the base memory snapshot for each VM,
+    but marks guest memory as mergeable. While two or more VMs of the same
+    base VM run on this node, KSM is turned on so that the pages still
+    identical to the base memory are merged copy-on-write, and only the
+    pages dirtied by each VM stay private. The previous KSM settings are
+    restored when the sharing ends. KSM settings are host-wide, so they are
+    not changed while ksmtuned manages them.
+    """
+
+    KSM_PATH = "/sys/kernel/mm/ksm"
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+    def __init__(self):
+        self.instance_bases = dict()    # instance uuid -> base sha256
+        self.saved_settings = None
+        self.lock = threading.Lock()
+
+    def _read_ksm(self, name):
+        with open(os.path.join(BaseMemorySharing.KSM_PATH, name)) as f:
+            return int(f.read().strip())
+
+    def _write_ksm(self, name, value):
+        utils.execute('tee', os.path.join(BaseMemorySharing.KSM_PATH, name),
+                      process_input=str(value), run_as_root=True)
+
+    def _is_ksmtuned_running(self):
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join("/proc", pid, "comm")) as f:
+                    if f.read().strip() == "ksmtuned":
+                        return True
+            except IOError:
+                # the process has exited
+                continue
+        return False
+
+    def _is_sharing(self):
+        bases = self.instance_bases.values()
+        return any(bases.count(base) > 1 for base in set(bases))
+
+    def _update_ksm(self):
+        if not CONF.cloudlet_memory_sharing or \
+                not os.path.exists(BaseMemorySharing.KSM_PATH):
+            return
+        try:
+            if self._is_sharing() and self.saved_settings is None:
+                if self._is_ksmtuned_running():
+                    LOG.debug("ksmtuned is running; leave KSM settings")
+                    return
+                self.saved_settings = dict(
+                    (name, self._read_ksm(name))
+                    for name in ("run", "pages_to_scan", "sleep_millisecs"))
+                self._write_ksm("pages_to_scan",
+                                CONF.cloudlet_ksm_pages_to_scan)
+                self._write_ksm("sleep_millisecs",
+                                CONF.cloudlet_ksm_sleep_millisecs)
+                self._write_ksm("run", 1)
+                LOG.info(_("Start sharing memory of base VMs"))
+            elif not self._is_sharing() and self.saved_settings is not None:
+                for name in ("pages_to_scan", "sleep_millisecs", "run"):
+                    self._write_ksm(name, self.saved_settings[name])
+                self.saved_settings = None
+                LOG.info(_("Stop sharing memory of base VMs"))
+        except Exception as e:
+            LOG.warning(_("Cannot change KSM settings: %s") % str(e))
+
+    def add(self, instance_uuid, base_sha256):
+        with self.lock:
+            self.instance_bases[instance_uuid] = base_sha256
+            self._update_ksm()
+
+    def remove(self, instance_uuid):
+        with self.lock:
+            if self.instance_bases.pop(instance_uuid, None) is not None:
+                self._update_ksm()
+
+    def get_stats(self):
+        with self.lock:
+            stats = {'instances': len(self.instance_bases),
+                     'bases': len(set(self.instance_bases.values())),
+                     'is_sharing': self.saved_settings is not None,
+                     'shared_bytes': 0,
+                     'saved_bytes': 0}
+        try:
+            # pages_sharing counts the mappings deduplicated into
+            # pages_shared pages
+            stats['shared_bytes'] = self._read_ksm("pages_shared") * \
+                BaseMemorySharing.PAGE_SIZE
+            stats['saved_bytes'] = self._read_ksm("pages_sharing") * \
+                BaseMemorySharing.PAGE_SIZE
+        except (IOError, ValueError):
+            pass
+        return stats
+
+
+class AdmissionGate(object):
+
+    """Bounded slots of one resource class with a priority wait queue.
+
+    A released slot is handed over to the waiter with the lowest priority
+    value (FIFO within the same priority) instead of being returned, so a
+    newcomer cannot overtake the queue.
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.running = 0
+        self.waiters = list()   # heap of (priority, sequence, event)
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def acquire(self, priority):
+        start_time = time.time()
+        waiter = None
+        with self.lock:
+            if self.limit <= 0 or \
+                    (self.running < self.limit and not self.waiters):
+                self.running += 1
+            else:
+                waiter = event.Event()
+                heapq.heappush(self.waiters,
+                               (priority, next(self.sequence), waiter))
+        if waiter is not None:
+            LOG.debug("waiting for %s slot (priority %d)" %
+                      (self.name, priority))
+            try:
+                waiter.wait()
+            except BaseException:
+                # killed while waiting, e.g. the instance was deleted
+                self._cancel(waiter)
+                raise
+        wait_time = time.time() - start_time
+        with self.lock:
+            self.admitted += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def _cancel(self, waiter):
+        with self.lock:
+            entries = [entry for entry in self.waiters
+                       if entry[2] is waiter]
+            if entries:
+                self.waiters.remove(entries[0])
+                heapq.heapify(self.waiters)
+                return
+        # the slot was handed over before the waiter was killed
+        self.release()
+
+    def release(self):
+        with self.lock:
+            if self.waiters:
+                # hand over the slot; the number of running stays the same
+                (priority, sequence, waiter) = heapq.heappop(self.waiters)
+                waiter.send()
+            else:
+                self.running -= 1
+
+    def get_stats(self):
+        with self.lock:
+            admitted = self.admitted
+            return {'limit': self.limit,
+                    'running': self.running,
+                    'queued': len(self.waiters),
+                    'admitted': admitted,
+                    'avg_wait_time': self.total_wait_time / admitted
+                    if admitted else 0.0,
+                    'max_wait_time': self.max_wait_time}
+
+
+class AdmissionController(object):
+
+    """Limit heavy cloudlet operations running at the same time on a node.
+
+    Syntheses and handoffs running in parallel contend for disk and CPU
+    and all of them finish late, so each resource class has a bounded
+    number of slots and the others wait in a priority queue.
+    """
+
+    NETWORK_FETCH = "network_fetch"
+    DECOMPRESS = "decompress"
+    DELTA_APPLY = "delta_apply"
+    RESIDUE = "residue"
+
+    # lower value is admitted first
+    PRIORITY_HANDOFF = 0
+    PRIORITY_SYNTHESIS = 1
+    PRIORITY_OVERLAY = 2
+    PRIORITY_BACKGROUND = 3
+
+    def __init__(self):
+        self.gates = {
+            AdmissionController.NETWORK_FETCH: AdmissionGate(
+                AdmissionController.NETWORK_FETCH,
+                CONF.cloudlet_max_network_fetch),
+            AdmissionController.DECOMPRESS: AdmissionGate(
+                AdmissionController.DECOMPRESS,
+                CONF.cloudlet_max_decompress),
+            AdmissionController.DELTA_APPLY: AdmissionGate(
+                AdmissionController.DELTA_APPLY,
+                CONF.cloudlet_max_delta_apply),
+            AdmissionController.RESIDUE: AdmissionGate(
+                AdmissionController.RESIDUE,
+                CONF.cloudlet_max_residue),
+        }
+
+    @contextlib.contextmanager
+    def admit(self, resource_class, priority):
+        gate = self.gates[resource_class]
+        gate.acquire(priority)
+        try:
+            yield
+        finally:
+            gate.release()
+
+    def get_stats(self):
+        return dict((name, gate.get_stats())
+                    for (name, gate) in self.gates.iteritems())
+
+
+_admission_controller = None
+
+
+def get_admission_controller():
+    global _admission_controller
+    if _admission_controller is None:
+        _admission_controller = AdmissionController()
+    return _admission_controller
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """Take size tokens, sleeping while the bucket is in debt
+        """
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(float(self.rate), self.tokens +
+                              (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= size
+            deficit = -self.tokens
+        if deficit > 0:
+            eventlet.sleep(deficit / self.rate)
+
+
+class ShapedFile(object):
+
+    """File wrapper that throttles read and write through the shaper"""
+
+    def __init__(self, shaper, fileobj, traffic_class):
+        self.shaper = shaper
+        self.fileobj = fileobj
+        self.traffic_class = traffic_class
+
+    def read(self, *args):
+        data = self.fileobj.read(*args)
+        if data:
+            self.shaper.throttle(self.traffic_class, len(data))
+        return data
+
+    def write(self, data):
+        self.shaper.throttle(self.traffic_class, len(data))
+        return self.fileobj.write(data)
+
+    def __iter__(self):
+        return iter(functools.partial(self.read, 64 * 1024), '')
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class TrafficShaper(object):
+
+    """Node-level token buckets for the transfers of the cloudlet driver.
+
+    Each traffic class has its own rate limit. With strict priority, a
+    class also pauses while a higher class had traffic within the yield
+    time, so background staging does not slow down a live handoff.
+    """
+
+    HANDOFF = "handoff"
+    OVERLAY = "overlay"
+    BASE_UPLOAD = "base_upload"
+    PREFETCH = "prefetch"
+    # highest priority first
+    TRAFFIC_CLASSES = [HANDOFF, OVERLAY, BASE_UPLOAD, PREFETCH]
+
+    PRIORITY_TRAFFIC_CLASS = {
+        AdmissionController.PRIORITY_HANDOFF: HANDOFF,
+        AdmissionController.PRIORITY_SYNTHESIS: OVERLAY,
+        AdmissionController.PRIORITY_OVERLAY: OVERLAY,
+        AdmissionController.PRIORITY_BACKGROUND: PREFETCH,
+    }
+
+    def __init__(self):
+        rates = {
+            TrafficShaper.HANDOFF: CONF.cloudlet_bandwidth_handoff,
+            TrafficShaper.OVERLAY: CONF.cloudlet_bandwidth_overlay,
+            TrafficShaper.BASE_UPLOAD: CONF.cloudlet_bandwidth_base_upload,
+            TrafficShaper.PREFETCH: CONF.cloudlet_bandwidth_prefetch,
+        }
+        self.buckets = dict((traffic_class, TokenBucket(rate * 1024))
+                            for (traffic_class, rate) in rates.iteritems())
+        self.last_active = dict.fromkeys(TrafficShaper.TRAFFIC_CLASSES, 0)
+        self.total_bytes = dict.fromkeys(TrafficShaper.TRAFFIC_CLASSES, 0)
+        self.reported_bytes = dict.fromkeys(TrafficShaper.TRAFFIC_CLASSES, 0)
+        self.reported_time = time.time()
+        self.lock = threading.Lock()
+
+    def _yield_to_higher_class(self, traffic_class):
+        yield_time = CONF.cloudlet_bandwidth_yield_time
+        if yield_time <= 0:
+            return
+        index = TrafficShaper.TRAFFIC_CLASSES.index(traffic_class)
+        higher_classes = TrafficShaper.TRAFFIC_CLASSES[:index]
+        while higher_classes:
+            latest = max(self.last_active[higher_class]
+                         for higher_class in higher_classes)
+            idle_time = time.time() - latest
+            if idle_time >= yield_time:
+                break
+            eventlet.sleep(yield_time - idle_time)
+
+    def throttle(self, traffic_class, size):
+        self._yield_to_higher_class(traffic_class)
+        self.buckets[traffic_class].consume(size)
+        with self.lock:
+            self.last_active[traffic_class] = time.time()
+            self.total_bytes[traffic_class] += size
+
+    def wrap_file(self, fileobj, traffic_class):
+        return ShapedFile(self, fileobj, traffic_class)
+
+    def get_stats(self):
+        """Return bytes and throughput of each class since the last call
+        """
+        with self.lock:
+            now = time.time()
+            duration = max(now - self.reported_time, 1e-3)
+            stats = dict()
+            for traffic_class in TrafficShaper.TRAFFIC_CLASSES:
+                total_bytes = self.total_bytes[traffic_class]
+                stats[traffic_class] = {
+                    'rate_limit': self.buckets[traffic_class].rate,
+                    'total_bytes': total_bytes,
+                    'throughput_bps': 8.0 * (
+                        total_bytes - self.reported_bytes[traffic_class]) /
+                    duration,
+                }
+            self.reported_bytes = dict(self.total_bytes)
+            self.reported_time = now
+        return stats
+
+
+_traffic_shaper = None
+
+
+def get_traffic_shaper():
+    global _traffic_shaper
+    if _traffic_shaper is None:
+        _traffic_shaper = TrafficShaper()
+    return _traffic_shaper
+
+
+class SparseFile(object):
+
+    """Write-only file wrapper that seeks over zero blocks instead of
+    writing them, so that the file has holes for zero chunks
+    """
+
+    BLOCK_SIZE = 64 * 1024
+    ZERO_BLOCK = '\0' * BLOCK_SIZE
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        for offset in xrange(0, len(data), SparseFile.BLOCK_SIZE):
+            block = data[offset:offset + SparseFile.BLOCK_SIZE]
+            if block == SparseFile.ZERO_BLOCK[:len(block)]:
+                self.fileobj.seek(len(block), os.SEEK_CUR)
+            else:
+                self.fileobj.write(block)
+
+    def finish(self):
+        # extend the file when it ends with a hole
+        self.fileobj.truncate(self.fileobj.tell())
+        self.fileobj.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class OverlayZipStream(object):
+
+    """Read-only file object producing the overlay zip on the fly.
+
+    Members are stored without compression (blobs are already compressed)
+    and with data descriptors, so the zip is written strictly sequentially
+    and at most one chunk is held in memory. The layout is the same as
+    VMOverlayPackage.create, which readers locate via the central directory.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    ZIP_LIMIT = 0xFFFFFFFF
+
+    def __init__(self, members):
+        self.generator = self._generate(members)
+        self.chunk = ''
+        self.chunk_offset = 0
+        self.bytes_produced = 0
+
+    @staticmethod
+    def fits(members, total_size):
+        # local headers, data descriptors, and central directory
+        overhead = sum(30 + 16 + 46 + 2 * len(arcname)
+                       for (arcname, _) in members) + 22
+        return total_size + overhead < OverlayZipStream.ZIP_LIMIT
+
+    @staticmethod
+    def _dos_time(path):
+        t = time.localtime(os.path.getmtime(path))
+        dos_date = (t[0] - 1980) << 9 | t[1] << 5 | t[2]
+        dos_time = t[3] << 11 | t[4] << 5 | (t[5] // 2)
+        return dos_time, dos_date
+
+    def _generate(self, members):
+        offset = 0
+        central_directory = list()
+        for (arcname, path) in members:
+            dos_time, dos_date = self._dos_time(path)
+            # bit 3: crc and sizes follow the data in a data descriptor
+            header = struct.pack("<IHHHHHIIIHH", 0x04034b50, 20, 0x08, 0,
+                                 dos_time, dos_date, 0, 0, 0,
+                                 len(arcname), 0) + arcname
+            yield header
+            crc = 0
+            size = 0
+            with open(path, "rb") as member_file:
+                while True:
+                    data = member_file.read(OverlayZipStream.CHUNK_SIZE)
+                    if not data:
+                        break
+                    crc = zlib.crc32(data, crc)
+                    size += len(data)
+                    yield data
+            crc &= 0xFFFFFFFF
+            yield struct.pack("<IIII", 0x08074b50, crc, size, size)
+            central_directory.append(
+                struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 20, 20, 0x08,
+                            0, dos_time, dos_date, crc, size, size,
+                            len(arcname), 0, 0, 0, 0, 0100644 << 16,
+                            offset) + arcname)
+            offset += len(header) + size + 16
+        central_directory_data = ''.join(central_directory)
+        yield central_directory_data
+        yield struct.pack("<IHHHHIIH", 0x06054b50, 0, 0,
+                          len(central_directory), len(central_directory),
+                          len(central_directory_data), offset, 0)
+
+    def read(self, size=-1):
+        buf = list()
+        while size < 0 or size > 0:
+            if self.chunk_offset >= len(self.chunk):
+                try:
+                    self.chunk = next(self.generator)
+                    self.chunk_offset = 0
+                except StopIteration:
+                    break
+                continue
+            if size < 0:
+                end = len(self.chunk)
+            else:
+                end = min(len(self.chunk), self.chunk_offset + size)
+                size -= end - self.chunk_offset
+            buf.append(self.chunk[self.chunk_offset:end])
+            self.chunk_offset = end
+        data = ''.join(buf)
+        self.bytes_produced += len(data)
+        return data
+
+
+_service_token = None
+
+
+def get_service_context():
+    """Return admin context with a keystone token for periodic tasks
+
+    Contexts of periodic tasks do not carry a token, so glance rejects
+    them when glance uses keystone. Falls back to a plain admin context
+    when no service credential is configured.
+    """
+    global _service_token
+    context = nova_context.get_admin_context()
+    if not CONF.cloudlet_service_auth_url or \
+            not CONF.cloudlet_service_password:
+        return context
+    if _service_token is None or _service_token['expires'] < time.time():
+        auth_url = urlsplit(CONF.cloudlet_service_auth_url)
+        body = json.dumps({"auth": {
+            "tenantName": CONF.cloudlet_service_tenant,
+            "passwordCredentials": {
+                "username": CONF.cloudlet_service_user,
+                "password": CONF.cloudlet_service_password}}})
+        response = cloudlet_http.request(
+            "POST", auth_url.netloc, "%s/tokens" % auth_url.path.rstrip("/"),
+            body, {"Content-Type": "application/json"},
+            scheme=auth_url.scheme)
+        if response.status != 200:
+            raise exception.NovaException(
+                "Cannot get service token: %d %s" %
+                (response.status, response.reason))
+        access = json.loads(response.data)['access']
+        # e.g. 2014-05-27T12:00:00Z or 2014-05-27T12:00:00.000000Z in UTC
+        expires = calendar.timegm(time.strptime(
+            access['token']['expires'][:19], "%Y-%m-%dT%H:%M:%S"))
+        _service_token = {
+            'id': access['token']['id'],
+            'project_id': access['token']['tenant']['id'],
+            # refresh before keystone expires the token
+            'expires': expires - 300,
+        }
+    context.auth_token = _service_token['id']
+    context.project_id = _service_token['project_id']
+    return context
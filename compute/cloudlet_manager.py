@@ -30,17 +30,35 @@ except ImportError as e:
 from nova.objects import block_device as block_device_obj
 from nova.objects import quotas as quotas_obj
 from nova.compute import manager as compute_manager
+from nova.compute.cloudlet_api import CloudletAPI
+from nova.image import glance
+from nova.openstack.common import periodic_task
 from nova.virt import driver
+from nova.virt.libvirt import cloudlet_driver
 from nova import rpc
 from nova import exception
 from nova import utils
 import oslo_messaging as messaging
+from oslo.config import cfg
 
 import logging
 
 
 LOG = logging.getLogger(__name__)
 
+cloudlet_manager_opts = [
+    cfg.IntOpt('cloudlet_cache_report_interval',
+               default=60,
+               help='Interval in seconds for logging cloudlet statistics '
+                    '(admission, traffic, memory and base file sharing)'),
+    cfg.IntOpt('cloudlet_standby_refill_interval',
+               default=300,
+               help='Interval in seconds for staging evicted base VM files '
+                    'of the standby pool'),
+]
+CONF = cfg.CONF
+CONF.register_opts(cloudlet_manager_opts)
+
 get_notifier = functools.partial(rpc.get_notifier, service='compute')
 
 
@@ -68,8 +86,6 @@ class CloudletComputeManager(compute_manager.ComputeManager):
         context = context.elevated()
         LOG.info(_("Generating cloudlet base"), instance=instance)
 
-        self._notify_about_instance_usage(context, instance, "snapshot.start")
-
         def callback_update_task_state(
                 task_state,
                 expected_state=task_states.IMAGE_SNAPSHOT):
@@ -77,24 +93,37 @@ class CloudletComputeManager(compute_manager.ComputeManager):
             instance.save(expected_task_state=expected_state)
             return instance
 
-        self.driver.cloudlet_base(
-            context,
-            instance,
-            vm_name,
-            disk_meta_id,
-            memory_meta_id,
-            diskhash_meta_id,
-            memoryhash_meta_id,
-            callback_update_task_state)
-        instance = self._instance_update(
-            context,
-            instance['uuid'],
-            task_state=None,
-            expected_task_state=task_states.IMAGE_UPLOADING)
+        try:
+            self._notify_about_instance_usage(context, instance,
+                                              "snapshot.start")
+            self.driver.cloudlet_base(
+                context,
+                instance,
+                vm_name,
+                disk_meta_id,
+                memory_meta_id,
+                diskhash_meta_id,
+                memoryhash_meta_id,
+                callback_update_task_state)
+            instance = self._instance_update(
+                context,
+                instance['uuid'],
+                task_state=None,
+                expected_task_state=task_states.IMAGE_UPLOADING)
 
-        # notify will raise exception since instance is already deleted
-        self._notify_about_instance_usage(context, instance, "snapshot.end")
-        self.cloudlet_terminate_instance(context, instance)
+            # notify will raise exception since instance is already deleted
+            self._notify_about_instance_usage(context, instance,
+                                              "snapshot.end")
+            self.cloudlet_terminate_instance(context, instance, None)
+        except Exception as e:
+            # API does not wait for the result, so leave the error
+            # at the reserved images for polling
+            with excutils.save_and_reraise_exception():
+                self._cloudlet_mark_base_error(
+                    context,
+                    [disk_meta_id, memory_meta_id,
+                     diskhash_meta_id, memoryhash_meta_id],
+                    str(e))
 
     @compute_manager.object_compat
     @compute_manager.wrap_exception()
@@ -119,6 +148,34 @@ class CloudletComputeManager(compute_manager.ComputeManager):
                                       overlay_id, callback_update_task_state)
         self.cloudlet_terminate_instance(context, instance,reservations)
 
+    @compute_manager.object_compat
+    @compute_manager.wrap_exception()
+    @compute_manager.reverts_task_state
+    @compute_manager.wrap_instance_fault
+    def cloudlet_overlay_checkpoint(self, context, instance,
+                                    overlay_name, overlay_id):
+        """
+        Generate VM overlay with given instance and keep the instance running
+        """
+        context = context.elevated()
+        LOG.info(_("Checkpointing VM overlay"), instance=instance)
+
+        def callback_update_task_state(
+                task_state,
+                expected_state=task_states.IMAGE_SNAPSHOT):
+            instance.task_state = task_state
+            instance.save(expected_task_state=expected_state)
+            return instance
+
+        self.driver.checkpoint_overlay_vm(context, instance, overlay_name,
+                                          overlay_id,
+                                          callback_update_task_state)
+        self._instance_update(
+            context,
+            instance['uuid'],
+            task_state=None,
+            expected_task_state=task_states.IMAGE_UPLOADING)
+
     @compute_manager.object_compat
     @compute_manager.wrap_exception()
     @compute_manager.reverts_task_state
@@ -143,6 +200,77 @@ class CloudletComputeManager(compute_manager.ComputeManager):
                                       residue_glance_id)
         self.cloudlet_terminate_instance(context, instance,reservations)
 
+    @periodic_task.periodic_task(
+        spacing=CONF.cloudlet_standby_refill_interval)
+    def _refill_cloudlet_standby_pool(self, context):
+        try:
+            stats = self.driver.cloudlet_refill_standby_pool(
+                cloudlet_driver.get_service_context())
+        except Exception as e:
+            LOG.warning(_("Cannot refill cloudlet standby pool: %s") % str(e))
+            return
+        LOG.info(_("Cloudlet standby pool: %(hits)d hits, %(misses)d misses, "
+                   "%(refills)d refills, %(refill_failures)d failures, "
+                   "%(total_refill_time).1f s refill time") % stats)
+
+    @periodic_task.periodic_task(spacing=CONF.cloudlet_cache_report_interval)
+    def _report_cloudlet_admission(self, context):
+        stats = self.driver.cloudlet_admission_stats()
+        for (resource_class, gate_stats) in sorted(stats.items()):
+            gate_stats['resource_class'] = resource_class
+            msg = _("Cloudlet admission %(resource_class)s: "
+                    "%(running)d/%(limit)d running, %(queued)d queued, "
+                    "%(avg_wait_time).1f s avg wait, "
+                    "%(max_wait_time).1f s max wait") % gate_stats
+            if gate_stats['running'] > 0 or gate_stats['queued'] > 0:
+                LOG.info(msg)
+            else:
+                LOG.debug(msg)
+
+    @periodic_task.periodic_task(spacing=CONF.cloudlet_cache_report_interval)
+    def _report_cloudlet_traffic(self, context):
+        stats = self.driver.cloudlet_traffic_stats()
+        for (traffic_class, class_stats) in sorted(stats.items()):
+            class_stats['traffic_class'] = traffic_class
+            msg = _("Cloudlet traffic %(traffic_class)s: "
+                    "%(total_bytes)d bytes, %(throughput_bps).0f bps "
+                    "(limit %(rate_limit)d B/s)") % class_stats
+            if class_stats['throughput_bps'] > 0:
+                LOG.info(msg)
+            else:
+                LOG.debug(msg)
+
+    @periodic_task.periodic_task(spacing=CONF.cloudlet_cache_report_interval)
+    def _report_cloudlet_memory_sharing(self, context):
+        stats = self.driver.cloudlet_memory_sharing_stats()
+        if stats['instances'] > 0:
+            LOG.info(_("Cloudlet memory sharing: %(instances)d VMs of "
+                       "%(bases)d base VMs, %(saved_bytes)d bytes saved "
+                       "(%(shared_bytes)d bytes shared)") % stats)
+
+    @periodic_task.periodic_task(spacing=CONF.cloudlet_cache_report_interval)
+    def _report_cloudlet_base_reads(self, context):
+        stats = self.driver.cloudlet_base_read_stats()
+        if stats['references'] > 0:
+            LOG.info(_("Cloudlet base files: %(references)d references to "
+                       "%(files)d files, %(resident_bytes)d of "
+                       "%(referenced_bytes)d bytes cached, %(dedup_bytes)d "
+                       "bytes deduplicated, hit ratio %(hit_ratio).2f")
+                     % stats)
+
+    def _cloudlet_mark_base_error(self, context, image_ids, error_msg):
+        properties = {CloudletAPI.PROPERTY_KEY_BASE_JOB_ERROR: error_msg}
+        for image_id in image_ids:
+            try:
+                (image_service, image_id) = glance.get_remote_image_service(
+                    context, image_id)
+                image_service.update(context, image_id,
+                                     {'properties': properties},
+                                     purge_props=False)
+            except Exception as e:
+                LOG.warning(_("Cannot update base image %s: %s") %
+                            (image_id, str(e)))
+
     # Direct call to terminate_instance at the manager.py will cause
     # "InstanceActionNotFound_Remote" exception at wrap_instance_event decorator
     # since the VM is already terminated.
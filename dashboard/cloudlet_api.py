@@ -21,10 +21,10 @@ import glanceclient as glance_client
 
 from django.conf import settings
 from novaclient.v1_1 import client as nova_client
-import httplib
 import json
 from urlparse import urlparse
 from openstack_dashboard.api.base import url_for
+from . import cloudlet_http
 
 
 LOG = logging.getLogger(__name__)
@@ -43,17 +43,29 @@ def request_create_overlay(request, instance_id):
     })
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
 
-    conn = httplib.HTTPConnection(end_point[1])
     command = "%s/servers/%s/action" % (end_point[2], instance_id)
-    conn.request("POST", command, params, headers)
-    response = conn.getresponse()
-    data = response.read()
-    dd = json.loads(data)
-    conn.close()
+    response = cloudlet_http.request("POST", end_point[1], command, params,
+                                     headers, scheme=end_point.scheme)
+    dd = json.loads(response.data)
 
     return dd
 
 
+def request_basevm(request, base_sha256_uuid):
+    token = request.user.token.id
+    management_url = url_for(request, 'compute')
+    end_point = urlparse(management_url)
+
+    headers = {"X-Auth-Token": token, "Content-type": "application/json"}
+    command = "%s/os-cloudlet-bases/%s" % (end_point[2], base_sha256_uuid)
+    response = cloudlet_http.request("GET", end_point[1], command, '',
+                                     headers, scheme=end_point.scheme)
+    if response.status == 404:
+        return None
+    dd = json.loads(response.data)
+    return dd['base']
+
+
 def request_synthesis(request, vm_name, base_disk_id, flavor_id, key_name,
                       security_group_id, overlay_url):
     token = request.user.token.id
@@ -73,12 +85,10 @@ def request_synthesis(request, vm_name, base_disk_id, flavor_id, key_name,
     params = json.dumps(s)
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
 
-    conn = httplib.HTTPConnection(end_point[1])
-    conn.request("POST", "%s/servers" % end_point[2], params, headers)
-    response = conn.getresponse()
-    data = response.read()
-    dd = json.loads(data)
-    conn.close()
+    response = cloudlet_http.request("POST", end_point[1],
+                                     "%s/servers" % end_point[2], params,
+                                     headers, scheme=end_point.scheme)
+    dd = json.loads(response.data)
     return dd
 
 
@@ -97,13 +107,10 @@ def request_handoff(request, instance_id, handoff_url,
     })
     headers = {"X-Auth-Token": token, "Content-type": "application/json"}
 
-    conn = httplib.HTTPConnection(end_point[1])
     command = "%s/servers/%s/action" % (end_point[2], instance_id)
-    conn.request("POST", command, params, headers)
-    response = conn.getresponse()
-    data = response.read()
-    conn.close()
-    dd = json.loads(data)
+    response = cloudlet_http.request("POST", end_point[1], command, params,
+                                     headers, scheme=end_point.scheme)
+    dd = json.loads(response.data)
     return dd
 
 
@@ -0,0 +1 @@
+../api/cloudlet_http.py
\ No newline at end of file
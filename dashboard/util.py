@@ -71,24 +71,13 @@ def get_cloudlet_type(instance):
 
 def find_basevm_by_sha256(request, sha256_value):
     from openstack_dashboard.api import glance
+    from . import cloudlet_api
 
-    public = {"is_public": True, "status": "active"}
-    image_detail = glance.image_list_detailed(request, filters=public)
-    if len(image_detail) == 2:  # icehouse
-        public_images, _more_images = image_detail
-    elif len(image_detail) == 3: # kilo
-        public_images, _more_images, has_prev_data = image_detail
-    for image in public_images:
-        properties = getattr(image, "properties")
-        if properties == None or len(properties) == 0:
-            continue
-        if properties.get(CLOUDLET_TYPE.PROPERTY_KEY_CLOUDLET_TYPE) != \
-                CLOUDLET_TYPE.IMAGE_TYPE_BASE_DISK:
-            continue
-        base_sha256_uuid = properties.get(CLOUDLET_TYPE.PROPERTY_KEY_BASE_UUID)
-        if base_sha256_uuid == sha256_value:
-            return image
-    return None
+    # use base VM index at the cloudlet extension instead of listing images
+    basevm = cloudlet_api.request_basevm(request, sha256_value)
+    if basevm is None or basevm.get('status') != "active":
+        return None
+    return glance.image_get(request, basevm['id'])
 
 
 def find_matching_flavor(flavor_list, cpu_count, memory_mb, disk_gb):
@@ -68,13 +68,20 @@ def deploy_cloudlet_api():
 
     ext_file = os.path.abspath("./api/cloudlet.py")
     api_file = os.path.abspath("./api/cloudlet_api.py")
+    http_file = os.path.abspath("./api/cloudlet_http.py")
+    overlay_file = os.path.abspath("./api/cloudlet_overlay.py")
+    scheduler_file = os.path.abspath("./scheduler/cloudlet_scheduler.py")
     ext_lib_dir = os.path.join(NOVA_PACKAGE_PATH,
             "api/openstack/compute/contrib/")
     api_lib_dir = os.path.join(NOVA_PACKAGE_PATH, "compute/")
+    scheduler_lib_dir = os.path.join(NOVA_PACKAGE_PATH, "scheduler/")
 
     deploy_files = [
             (ext_file, ext_lib_dir),
             (api_file, api_lib_dir),
+            (http_file, api_lib_dir),
+            (overlay_file, api_lib_dir),
+            (scheduler_file, scheduler_lib_dir),
             ]
 
     # deploy files
@@ -84,6 +91,7 @@ def deploy_cloudlet_api():
             abort("Cannot copy %s to %s" % (src_file, lib_dir))
 
     sudo("service nova-api restart", shell=False)
+    sudo("service nova-scheduler restart", shell=False)
 
 
 def deploy_compute_manager():
@@ -0,0 +1,207 @@
+# Elijah: Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2014 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Scheduler weigher and filter that steer VM synthesis and resume of cloudlet
+images to compute nodes that already cached the base VM.
+
+Each compute node reports the base VMs in its image cache and the VM
+overlays of its synthesized VMs in the stats of the compute node (see
+CloudletDriver.get_available_resource), so the inventory comes with the
+host state without any additional lookup.
+
+The report reaches host_state.stats only if the resource tracker copies
+the stats of the driver into the compute node, which nova does from Juno
+(Kilo included) on. The resource tracker of Icehouse replaces them with its
+own counters. A host without a usable report is treated as neutral: it gets
+no cache weight and passes CloudletCacheFilter.
+"""
+
+import hashlib
+import json
+import time
+
+from oslo.config import cfg
+
+from nova.scheduler import filters
+from nova.scheduler import weights
+
+import logging
+
+LOG = logging.getLogger(__name__)
+
+cloudlet_scheduler_opts = [
+    cfg.FloatOpt('cloudlet_cache_weight_multiplier',
+                 default=10.0,
+                 help='Multiplier used for weighing hosts that cached the '
+                      'base VM. Negative numbers mean to avoid them'),
+    cfg.FloatOpt('cloudlet_cache_overlay_weight',
+                 default=0.5,
+                 help='Weight of a cached VM overlay relative to a cached '
+                      'base VM'),
+    cfg.StrOpt('cloudlet_cache_weigher_strategy',
+               default='load_aware',
+               help="'cached' weighs hosts only by cache hit. 'load_aware' "
+                    "divides the cache hit by the number of I/O heavy "
+                    "operations at the host"),
+    cfg.IntOpt('cloudlet_cache_stale_time',
+               default=300,
+               help='Seconds after which a cache report of a compute node '
+                    'is ignored'),
+]
+CONF = cfg.CONF
+CONF.register_opts(cloudlet_scheduler_opts)
+
+
+class CLOUDLET_TYPE(object):
+    """Defined at cloudlet_api.py and duplicated for the scheduler
+    """
+    PROPERTY_KEY_CLOUDLET_TYPE = "cloudlet_type"
+    STATS_KEY_CACHE = "cloudlet_cache"
+    IMAGE_TYPE_BASE_DISK = "cloudlet_base_disk"
+
+
+def _get_image_properties(filter_properties):
+    request_spec = filter_properties.get('request_spec', None) or {}
+    image = request_spec.get('image', None) or {}
+    return image.get('properties', None) or {}
+
+
+def _get_image_id(filter_properties):
+    request_spec = filter_properties.get('request_spec', None) or {}
+    image = request_spec.get('image', None) or {}
+    image_id = image.get('id', None)
+    if image_id is None:
+        instance_properties = \
+            request_spec.get('instance_properties', None) or {}
+        image_id = instance_properties.get('image_ref', None)
+    return image_id
+
+
+def _get_overlay_hash(filter_properties):
+    request_spec = filter_properties.get('request_spec', None) or {}
+    instance_properties = request_spec.get('instance_properties', None) or {}
+    metadata = instance_properties.get('metadata', None) or {}
+    if isinstance(metadata, list):
+        metadata = dict((item['key'], item['value']) for item in metadata)
+    overlay_url = metadata.get('overlay_url', None)
+    if overlay_url is None:
+        return None
+    return hashlib.sha1(overlay_url).hexdigest()
+
+
+def is_cloudlet_request(filter_properties):
+    properties = _get_image_properties(filter_properties)
+    return properties.get(CLOUDLET_TYPE.PROPERTY_KEY_CLOUDLET_TYPE) == \
+        CLOUDLET_TYPE.IMAGE_TYPE_BASE_DISK
+
+
+_unreported_hosts = set()
+
+
+def get_cache_report(host_state):
+    """Return the cache inventory reported by the host
+
+    :returns: dict of the report, or None if the host has no usable report
+    """
+    stats = getattr(host_state, 'stats', None) or {}
+    report = stats.get(CLOUDLET_TYPE.STATS_KEY_CACHE, None)
+    reason = None
+    if report is None:
+        reason = "no %s in the host stats" % CLOUDLET_TYPE.STATS_KEY_CACHE
+    else:
+        try:
+            report = json.loads(report)
+            if not isinstance(report, dict):
+                raise ValueError("not a dict")
+        except (TypeError, ValueError) as e:
+            reason = "malformed cache report (%s)" % str(e)
+        else:
+            if (time.time() - report.get('t', 0)) > \
+                    CONF.cloudlet_cache_stale_time:
+                reason = "stale cache report"
+    if reason is None:
+        _unreported_hosts.discard(host_state.host)
+        return report
+    if host_state.host not in _unreported_hosts:
+        # once per host, since it is checked for every request
+        _unreported_hosts.add(host_state.host)
+        LOG.warning("Treat %s as neutral for cloudlet cache: %s" %
+                    (host_state.host, reason))
+    return None
+
+
+def get_cache_hit(host_state, filter_properties):
+    """Return whether the host cached the base VM and the VM overlay
+
+    :returns: (base hit, overlay hit), or None if the host has no usable
+    cache report
+    """
+    report = get_cache_report(host_state)
+    if report is None:
+        return None
+    image_id = _get_image_id(filter_properties)
+    if image_id is None:
+        return False, False
+    base_hit = hashlib.sha1(str(image_id)).hexdigest() in \
+        report.get('bases', [])
+    if not base_hit:
+        return False, False
+    overlay_hash = _get_overlay_hash(filter_properties)
+    overlay_hit = overlay_hash is not None and \
+        overlay_hash in report.get('overlays', [])
+    return True, overlay_hit
+
+
+class CloudletCacheWeigher(weights.BaseHostWeigher):
+
+    """Prefer hosts that cached the base VM (and the VM overlay)"""
+
+    def weight_multiplier(self):
+        return CONF.cloudlet_cache_weight_multiplier
+
+    def _weigh_object(self, host_state, weight_properties):
+        if not is_cloudlet_request(weight_properties):
+            return 0.0
+        cache_hit = get_cache_hit(host_state, weight_properties)
+        if cache_hit is None or not cache_hit[0]:
+            return 0.0
+        base_hit, overlay_hit = cache_hit
+        weight = 1.0
+        if overlay_hit:
+            weight += CONF.cloudlet_cache_overlay_weight
+        if CONF.cloudlet_cache_weigher_strategy == 'load_aware':
+            weight /= (1.0 + host_state.num_io_ops)
+        return weight
+
+
+class CloudletCacheFilter(filters.BaseHostFilter):
+
+    """Only pass hosts that cached the base VM of a cloudlet request.
+    Other requests and hosts without a usable cache report are not filtered.
+    """
+
+    def host_passes(self, host_state, filter_properties):
+        if not is_cloudlet_request(filter_properties):
+            return True
+        cache_hit = get_cache_hit(host_state, filter_properties)
+        if cache_hit is None:
+            return True
+        base_hit, overlay_hit = cache_hit
+        if not base_hit:
+            LOG.debug("%s does not have cached base VM" % host_state.host)
+        return base_hit
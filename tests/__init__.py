@@ -0,0 +1,26 @@
+# Elijah: Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2014 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Unit tests of the cloudlet extension.
+
+The modules are tested where they are deployed (nova/compute/,
+nova/virt/libvirt/ and nova/scheduler/), so run the tests in the virtualenv
+of the nova tree the extension is installed to, e.g.
+
+    $ python -m testtools.run discover -s tests -t .
+"""
@@ -0,0 +1,252 @@
+# Elijah: Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2014 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import socket
+
+import eventlet
+from eventlet.green import socket as green_socket
+import mock
+
+from nova.compute import cloudlet_api
+from nova import exception
+from nova import test
+
+
+BASE_UUID = "base-sha256"
+
+
+def _base_image(image_id, base_sha256_uuid=BASE_UUID, status="active"):
+    properties = dict()
+    if base_sha256_uuid is not None:
+        properties[cloudlet_api.CloudletAPI.PROPERTY_KEY_BASE_UUID] = \
+            base_sha256_uuid
+    return {"id": image_id, "name": image_id, "status": status,
+            "properties": properties}
+
+
+class BaseVMIndexTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(BaseVMIndexTestCase, self).setUp()
+        self.flags(cloudlet_basevm_index_ttl=60)
+        self.now = 1000.0
+        self.stubs.Set(cloudlet_api.time, "time", lambda: self.now)
+        self.images = [_base_image("base-disk"),
+                       _base_image("other-disk", "other-sha256"),
+                       _base_image("not-base", None)]
+        self.api = mock.Mock()
+        self.api.find_basevm.side_effect = self._find_basevm
+        self.api._get_image.return_value = {"status": "active"}
+        self.context = mock.Mock(project_id="project")
+        self.index = cloudlet_api.BaseVMIndex()
+
+    def _find_basevm(self, context, base_sha256_uuid=None):
+        key = cloudlet_api.CloudletAPI.PROPERTY_KEY_BASE_UUID
+        return [image for image in self.images
+                if base_sha256_uuid is None or
+                image["properties"].get(key) == base_sha256_uuid]
+
+    def test_get_all(self):
+        bases = self.index.get_all(self.api, self.context)
+        self.assertEqual(set([BASE_UUID, "other-sha256"]), set(bases.keys()))
+        self.assertEqual("base-disk", bases[BASE_UUID]["id"])
+
+    def test_get_all_cached_within_ttl(self):
+        self.index.get_all(self.api, self.context)
+        self.now += 59
+        self.index.get_all(self.api, self.context)
+        self.assertEqual(1, self.api.find_basevm.call_count)
+        self.now += 2
+        self.index.get_all(self.api, self.context)
+        self.assertEqual(2, self.api.find_basevm.call_count)
+
+    def test_get_all_per_project(self):
+        self.index.get_all(self.api, self.context)
+        other_context = mock.Mock(project_id="other-project")
+        self.index.get_all(self.api, other_context)
+        self.assertEqual(2, self.api.find_basevm.call_count)
+
+    def test_invalidate(self):
+        other_context = mock.Mock(project_id="other-project")
+        self.index.get_all(self.api, self.context)
+        self.index.get_all(self.api, other_context)
+        self.index.invalidate("project")
+        self.index.get_all(self.api, self.context)
+        self.index.get_all(self.api, other_context)
+        self.assertEqual(3, self.api.find_basevm.call_count)
+        self.index.invalidate()
+        self.index.get_all(self.api, other_context)
+        self.assertEqual(4, self.api.find_basevm.call_count)
+
+    def test_get_hit(self):
+        basevm_info = self.index.get(self.api, self.context, BASE_UUID)
+        self.assertEqual("base-disk", basevm_info["id"])
+        self.api._get_image.assert_called_once_with(self.context,
+                                                    "base-disk")
+
+    def test_get_deleted_at_glance(self):
+        self.index.get_all(self.api, self.context)
+        self.api._get_image.side_effect = exception.ImageNotFound(
+            image_id="base-disk")
+        self.images = [_base_image("new-disk")]
+        basevm_info = self.index.get(self.api, self.context, BASE_UUID)
+        self.assertEqual("new-disk", basevm_info["id"])
+        self.assertEqual(2, self.api.find_basevm.call_count)
+
+    def test_get_pending_delete(self):
+        self.index.get_all(self.api, self.context)
+        self.api._get_image.return_value = {"status": "pending_delete"}
+        self.images = []
+        self.assertIsNone(self.index.get(self.api, self.context, BASE_UUID))
+
+    def test_get_imported_after_loading(self):
+        self.index.get_all(self.api, self.context)
+        self.images.append(_base_image("new-disk", "new-sha256"))
+        basevm_info = self.index.get(self.api, self.context, "new-sha256")
+        self.assertEqual("new-disk", basevm_info["id"])
+        self.api.find_basevm.assert_called_with(self.context, "new-sha256")
+        # the lookup is added to the index
+        self.index.get(self.api, self.context, "new-sha256")
+        self.assertEqual(2, self.api.find_basevm.call_count)
+
+    def test_get_missing(self):
+        self.assertIsNone(self.index.get(self.api, self.context, "missing"))
+
+
+class HandoffDestCatalogTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(HandoffDestCatalogTestCase, self).setUp()
+        self.flags(cloudlet_handoff_catalog_ttl=60)
+        self.now = 1000.0
+        self.stubs.Set(cloudlet_api.time, "time", lambda: self.now)
+        self.stubs.Set(cloudlet_api, "_handoff_dest_catalogs", dict())
+        self.catalog = cloudlet_api.HandoffDestCatalog("dest:8774")
+
+    def _flavor(self, flavor_id, vcpus, ram):
+        return {"id": flavor_id, "vcpus": vcpus, "ram": ram,
+                "links": [{"href": "http://dest/flavors/%s" % flavor_id}]}
+
+    def test_base(self):
+        self.assertIsNone(self.catalog.get_base(BASE_UUID))
+        self.catalog.set_base(BASE_UUID, "base-disk")
+        self.assertEqual("base-disk", self.catalog.get_base(BASE_UUID))
+        self.now += 61
+        self.assertIsNone(self.catalog.get_base(BASE_UUID))
+
+    def test_base_not_found_is_not_cached(self):
+        self.catalog.set_base(BASE_UUID, None)
+        self.assertEqual({}, self.catalog.bases)
+
+    def test_flavors(self):
+        self.assertEqual((None, None), self.catalog.get_flavor(1, 1024))
+        self.catalog.set_flavors([self._flavor("1", 1, 1024),
+                                  self._flavor("2", "2", "2048"),
+                                  self._flavor("3", 1, 1024)])
+        self.assertEqual(("http://dest/flavors/1", "1"),
+                         self.catalog.get_flavor(1, 1024))
+        self.assertEqual(("http://dest/flavors/2", "2"),
+                         self.catalog.get_flavor(2, 2048))
+        self.assertEqual((None, None), self.catalog.get_flavor(4, 4096))
+        self.now += 61
+        self.assertEqual((None, None), self.catalog.get_flavor(1, 1024))
+
+    def test_invalidate(self):
+        self.catalog.set_base(BASE_UUID, "base-disk")
+        self.catalog.set_flavors([self._flavor("1", 1, 1024)])
+        self.catalog.invalidate()
+        self.assertIsNone(self.catalog.get_base(BASE_UUID))
+        self.assertEqual((None, None), self.catalog.get_flavor(1, 1024))
+
+    def test_get_catalog_per_credential(self):
+        catalog = cloudlet_api.get_handoff_dest_catalog("dest:8774", "token")
+        self.assertIs(catalog, cloudlet_api.get_handoff_dest_catalog(
+            "dest:8774", "token"))
+        self.assertIsNot(catalog, cloudlet_api.get_handoff_dest_catalog(
+            "dest:8774", "other-token"))
+        self.assertIsNot(catalog, cloudlet_api.get_handoff_dest_catalog(
+            "other:8774", "token"))
+        # the token itself is not kept
+        for (netloc, token_hash) in cloudlet_api._handoff_dest_catalogs:
+            self.assertNotEqual("token", token_hash)
+
+    def test_get_catalog_prunes_unused(self):
+        catalog = cloudlet_api.get_handoff_dest_catalog("dest:8774", "token")
+        self.now += 30
+        other = cloudlet_api.get_handoff_dest_catalog("other:8774", "token")
+        self.now += 31
+        cloudlet_api.get_handoff_dest_catalog("third:8774", "token")
+        self.assertEqual(2, len(cloudlet_api._handoff_dest_catalogs))
+        self.assertIs(other, cloudlet_api.get_handoff_dest_catalog(
+            "other:8774", "token"))
+        self.assertIsNot(catalog, cloudlet_api.get_handoff_dest_catalog(
+            "dest:8774", "token"))
+
+
+class PortForwardingSessionTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(PortForwardingSessionTestCase, self).setUp()
+        self.manager = mock.MagicMock()
+        self.session = cloudlet_api.PortForwardingSession(
+            self.manager, "10.0.0.2", 8022, 19000, mock.Mock())
+
+    def _socketpair(self):
+        pair = green_socket.socketpair()
+        for sock in pair:
+            self.addCleanup(sock.close)
+        return pair
+
+    def _recv_all(self, sock):
+        data = list()
+        while True:
+            d = sock.recv(4096)
+            if d == '':
+                return ''.join(data)
+            data.append(d)
+
+    def test_forward_half_close(self):
+        (client, client_side) = self._socketpair()
+        (server_side, server) = self._socketpair()
+        upstream = eventlet.spawn(self.session.forward,
+                                  client_side, server_side, True)
+        downstream = eventlet.spawn(self.session.forward,
+                                    server_side, client_side, False)
+        client.sendall("request")
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual("request", self._recv_all(server))
+        upstream.wait()
+        # the other direction keeps going after the half-close
+        server.sendall("response")
+        server.shutdown(socket.SHUT_WR)
+        self.assertEqual("response", self._recv_all(client))
+        downstream.wait()
+        self.assertEqual(len("request"), self.session.bytes_forwarded)
+        self.assertEqual(len("response"), self.session.bytes_returned)
+        self.assertNotEqual(cloudlet_api.PortForwardingSession.STATE_CLOSED,
+                            self.session.state)
+        self.assertFalse(self.manager.release_session.called)
+
+    def test_forward_error_closes_session(self):
+        source = mock.Mock()
+        source.recv.return_value = "data"
+        dest = mock.Mock()
+        dest.sendall.side_effect = socket.error("connection reset")
+        self.session.forward(source, dest, True)
+        self.assertEqual(cloudlet_api.PortForwardingSession.STATE_CLOSED,
+                         self.session.state)
+        self.manager.release_session.assert_called_once_with(self.session)
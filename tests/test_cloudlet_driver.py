@@ -0,0 +1,306 @@
+# Elijah: Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2014 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import StringIO
+import tempfile
+import zipfile
+
+import eventlet
+from eventlet import event
+import mock
+
+from nova.compute import cloudlet_overlay
+from nova import test
+from nova.virt.libvirt import cloudlet_driver
+
+
+class OverlayZipStreamTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(OverlayZipStreamTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.contents = {
+            "overlay-meta": "meta " * 1000,
+            "overlay-blob_1.xz": os.urandom(4096),
+            "overlay-blob_2.xz": os.urandom(1024 * 1024 + 17),
+            "overlay-blob_3.xz": "",
+        }
+        self.members = list()
+        for name in sorted(self.contents.keys()):
+            path = os.path.join(self.tmpdir, name)
+            with open(path, "wb") as f:
+                f.write(self.contents[name])
+            self.members.append((name, path))
+
+    def _write_stream(self, read_size):
+        stream = cloudlet_driver.OverlayZipStream(self.members)
+        zip_path = os.path.join(self.tmpdir, "overlay.zip")
+        with open(zip_path, "wb") as f:
+            while True:
+                data = stream.read(read_size)
+                if not data:
+                    break
+                f.write(data)
+        self.assertEqual(os.path.getsize(zip_path), stream.bytes_produced)
+        return zip_path
+
+    def _assert_zip(self, zip_path):
+        overlay_zip = zipfile.ZipFile(zip_path, "r")
+        self.assertIsNone(overlay_zip.testzip())
+        self.assertEqual([name for (name, path) in self.members],
+                         overlay_zip.namelist())
+        for (name, content) in self.contents.iteritems():
+            info = overlay_zip.getinfo(name)
+            self.assertEqual(zipfile.ZIP_STORED, info.compress_type)
+            self.assertEqual(content, overlay_zip.read(name))
+        overlay_zip.close()
+
+    def test_read_all(self):
+        stream = cloudlet_driver.OverlayZipStream(self.members)
+        zip_path = os.path.join(self.tmpdir, "overlay.zip")
+        with open(zip_path, "wb") as f:
+            f.write(stream.read())
+        self.assertEqual("", stream.read())
+        self._assert_zip(zip_path)
+
+    def test_read_odd_sizes(self):
+        for read_size in [7, 4093, cloudlet_driver.OverlayZipStream.
+                          CHUNK_SIZE + 1]:
+            self._assert_zip(self._write_stream(read_size))
+
+    def test_read_with_overlay_reader(self):
+        zip_path = self._write_stream(64 * 1024)
+        reader = cloudlet_overlay.OverlayReader("file://" + zip_path)
+        self.assertEqual(set(self.contents.keys()),
+                         set(reader.get_members().keys()))
+        for (name, content) in self.contents.iteritems():
+            self.assertEqual(content, reader.read_member(name))
+
+    def test_fits(self):
+        total_size = sum(len(content)
+                         for content in self.contents.itervalues())
+        self.assertTrue(cloudlet_driver.OverlayZipStream.fits(
+            self.members, total_size))
+        self.assertFalse(cloudlet_driver.OverlayZipStream.fits(
+            self.members, cloudlet_driver.OverlayZipStream.ZIP_LIMIT))
+
+
+class TrafficShaperTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(TrafficShaperTestCase, self).setUp()
+        self.now = 1000.0
+        self.sleep = mock.Mock(side_effect=self._sleep)
+        self.stubs.Set(cloudlet_driver.time, "time", lambda: self.now)
+        self.stubs.Set(cloudlet_driver.eventlet, "sleep", self.sleep)
+        self.flags(cloudlet_bandwidth_handoff=0,
+                   cloudlet_bandwidth_overlay=1,
+                   cloudlet_bandwidth_base_upload=0,
+                   cloudlet_bandwidth_prefetch=2,
+                   cloudlet_bandwidth_yield_time=0)
+
+    def _sleep(self, seconds):
+        self.now += seconds
+
+    def test_token_bucket_within_rate(self):
+        bucket = cloudlet_driver.TokenBucket(1000)
+        bucket.consume(600)
+        bucket.consume(400)
+        self.assertFalse(self.sleep.called)
+
+    def test_token_bucket_sleeps_for_deficit(self):
+        bucket = cloudlet_driver.TokenBucket(1000)
+        bucket.consume(1500)
+        self.sleep.assert_called_once_with(0.5)
+
+    def test_token_bucket_refills(self):
+        bucket = cloudlet_driver.TokenBucket(1000)
+        bucket.consume(1000)
+        self.now += 1.0
+        bucket.consume(1000)
+        self.assertFalse(self.sleep.called)
+        # the bucket does not hold more than one second of tokens
+        self.now += 10.0
+        bucket.consume(2000)
+        self.sleep.assert_called_once_with(1.0)
+
+    def test_token_bucket_unlimited(self):
+        bucket = cloudlet_driver.TokenBucket(0)
+        bucket.consume(10 ** 9)
+        self.assertFalse(self.sleep.called)
+
+    def test_throttle_rate_limit(self):
+        shaper = cloudlet_driver.TrafficShaper()
+        self.assertEqual(1024, shaper.buckets[shaper.OVERLAY].rate)
+        shaper.throttle(shaper.HANDOFF, 10 ** 9)
+        self.assertFalse(self.sleep.called)
+        shaper.throttle(shaper.OVERLAY, 2048)
+        self.sleep.assert_called_once_with(1.0)
+
+    def test_yield_to_higher_class(self):
+        self.flags(cloudlet_bandwidth_yield_time=2.0)
+        shaper = cloudlet_driver.TrafficShaper()
+        shaper.throttle(shaper.HANDOFF, 100)
+        self.now += 0.5
+        shaper.throttle(shaper.PREFETCH, 100)
+        self.sleep.assert_called_once_with(1.5)
+        # a higher class does not wait for a lower one
+        self.sleep.reset_mock()
+        shaper.throttle(shaper.HANDOFF, 100)
+        self.assertFalse(self.sleep.called)
+
+    def test_no_yield_when_disabled(self):
+        shaper = cloudlet_driver.TrafficShaper()
+        shaper.throttle(shaper.HANDOFF, 100)
+        shaper.throttle(shaper.PREFETCH, 100)
+        self.assertFalse(self.sleep.called)
+
+    def test_wrap_file(self):
+        shaper = cloudlet_driver.TrafficShaper()
+        data = "x" * 5000
+        shaped_file = shaper.wrap_file(StringIO.StringIO(data),
+                                       shaper.BASE_UPLOAD)
+        self.assertEqual(data, "".join(shaped_file))
+        output = StringIO.StringIO()
+        shaper.wrap_file(output, shaper.BASE_UPLOAD).write(data)
+        self.assertEqual(data, output.getvalue())
+        self.assertEqual(2 * len(data),
+                         shaper.total_bytes[shaper.BASE_UPLOAD])
+
+    def test_get_stats(self):
+        shaper = cloudlet_driver.TrafficShaper()
+        shaper.throttle(shaper.HANDOFF, 1000)
+        self.now += 2.0
+        stats = shaper.get_stats()
+        self.assertEqual(set(shaper.TRAFFIC_CLASSES), set(stats.keys()))
+        self.assertEqual(0, stats[shaper.HANDOFF]['rate_limit'])
+        self.assertEqual(2048, stats[shaper.PREFETCH]['rate_limit'])
+        self.assertEqual(1000, stats[shaper.HANDOFF]['total_bytes'])
+        self.assertEqual(4000.0, stats[shaper.HANDOFF]['throughput_bps'])
+        # throughput is measured since the last call
+        self.now += 1.0
+        stats = shaper.get_stats()
+        self.assertEqual(1000, stats[shaper.HANDOFF]['total_bytes'])
+        self.assertEqual(0.0, stats[shaper.HANDOFF]['throughput_bps'])
+
+
+class AdmissionControllerTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(AdmissionControllerTestCase, self).setUp()
+        self.flags(cloudlet_max_network_fetch=0,
+                   cloudlet_max_decompress=2,
+                   cloudlet_max_delta_apply=1,
+                   cloudlet_max_residue=1)
+        self.controller = cloudlet_driver.AdmissionController()
+        self.admitted = list()
+
+    def _spawn(self, resource_class, priority, name):
+        done = event.Event()
+
+        def run():
+            with self.controller.admit(resource_class, priority):
+                self.admitted.append(name)
+                done.wait()
+
+        thread = eventlet.spawn(run)
+        eventlet.sleep(0)
+        return (thread, done)
+
+    def _finish(self, job):
+        (thread, done) = job
+        done.send()
+        thread.wait()
+        eventlet.sleep(0)
+
+    def _stats(self, resource_class):
+        return self.controller.get_stats()[resource_class]
+
+    def test_limit(self):
+        decompress = cloudlet_driver.AdmissionController.DECOMPRESS
+        jobs = [self._spawn(decompress, 1, name) for name in "abc"]
+        self.assertEqual(["a", "b"], self.admitted)
+        self.assertEqual(2, self._stats(decompress)['running'])
+        self.assertEqual(1, self._stats(decompress)['queued'])
+        self._finish(jobs[0])
+        self.assertEqual(["a", "b", "c"], self.admitted)
+        self.assertEqual(2, self._stats(decompress)['running'])
+        for job in jobs[1:]:
+            self._finish(job)
+        stats = self._stats(decompress)
+        self.assertEqual(0, stats['running'])
+        self.assertEqual(0, stats['queued'])
+        self.assertEqual(3, stats['admitted'])
+        self.assertEqual(2, stats['limit'])
+        self.assertTrue(stats['max_wait_time'] >= stats['avg_wait_time'])
+
+    def test_unlimited(self):
+        fetch = cloudlet_driver.AdmissionController.NETWORK_FETCH
+        jobs = [self._spawn(fetch, 3, name) for name in "abcde"]
+        self.assertEqual(list("abcde"), self.admitted)
+        self.assertEqual(0, self._stats(fetch)['queued'])
+        for job in jobs:
+            self._finish(job)
+        self.assertEqual(0, self._stats(fetch)['running'])
+
+    def test_priority_order(self):
+        controller = cloudlet_driver.AdmissionController
+        delta_apply = controller.DELTA_APPLY
+        holder = self._spawn(delta_apply, controller.PRIORITY_OVERLAY,
+                             "holder")
+        jobs = [
+            self._spawn(delta_apply, controller.PRIORITY_BACKGROUND, "bg"),
+            self._spawn(delta_apply, controller.PRIORITY_SYNTHESIS, "syn1"),
+            self._spawn(delta_apply, controller.PRIORITY_SYNTHESIS, "syn2"),
+            self._spawn(delta_apply, controller.PRIORITY_HANDOFF, "handoff"),
+        ]
+        self.assertEqual(["holder"], self.admitted)
+        self._finish(holder)
+        for job in [jobs[3], jobs[1], jobs[2], jobs[0]]:
+            self._finish(job)
+        self.assertEqual(["holder", "handoff", "syn1", "syn2", "bg"],
+                         self.admitted)
+        self.assertEqual(0, self._stats(delta_apply)['running'])
+
+    def test_killed_waiter(self):
+        residue = cloudlet_driver.AdmissionController.RESIDUE
+        holder = self._spawn(residue, 1, "holder")
+        (thread, done) = self._spawn(residue, 1, "killed")
+        self.assertEqual(1, self._stats(residue)['queued'])
+        thread.kill()
+        self.assertEqual(0, self._stats(residue)['queued'])
+        self._finish(holder)
+        self.assertEqual(["holder"], self.admitted)
+        self.assertEqual(0, self._stats(residue)['running'])
+
+    def test_killed_after_handover(self):
+        residue = cloudlet_driver.AdmissionController.RESIDUE
+        gate = self.controller.gates[residue]
+        gate.acquire(1)
+        (thread, done) = self._spawn(residue, 1, "killed")
+        # the slot is handed over but the waiter is killed before it runs
+        gate.release()
+        thread.kill()
+        eventlet.sleep(0)
+        self.assertEqual([], self.admitted)
+        self.assertEqual(0, self._stats(residue)['running'])
+        job = self._spawn(residue, 1, "next")
+        self.assertEqual(["next"], self.admitted)
+        self._finish(job)
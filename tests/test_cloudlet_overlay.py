@@ -0,0 +1,184 @@
+# Elijah: Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2014 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+
+import mock
+
+from nova.compute import cloudlet_http
+from nova.compute import cloudlet_overlay
+from nova import test
+
+
+META = "overlay-meta"
+BLOBS = ["overlay-blob_1.xz", "overlay-blob_2.xz"]
+
+
+def _make_overlay(path):
+    """Write an overlay zip like VMOverlayPackage.create and return the
+    content of each member
+    """
+    contents = {META: "meta " * 1000}
+    for (index, name) in enumerate(BLOBS):
+        contents[name] = os.urandom(4096 * (index + 1))
+    overlay_zip = zipfile.ZipFile(path, "w")
+    overlay_zip.writestr(zipfile.ZipInfo(META), contents[META],
+                         zipfile.ZIP_DEFLATED)
+    for name in BLOBS:
+        overlay_zip.writestr(zipfile.ZipInfo(name), contents[name],
+                             zipfile.ZIP_STORED)
+    overlay_zip.close()
+    return contents
+
+
+class FakeRangeServer(object):
+
+    """Answer cloudlet_http.request with range responses of local files"""
+
+    def __init__(self, files):
+        self.files = files      # netloc -> path or None for an error
+        self.requests = list()
+
+    def request(self, method, netloc, path, body=None, headers=None,
+                scheme="http"):
+        byte_range = headers["Range"]
+        self.requests.append((netloc, byte_range))
+        if self.files.get(netloc) is None:
+            return cloudlet_http.HTTPResult(500, "Error", {}, "")
+        with open(self.files[netloc], "rb") as f:
+            data = f.read()
+        (start, end) = re.match(r"bytes=(\d*)-(\d*)", byte_range).groups()
+        if start == "":
+            start = max(0, len(data) - int(end))
+            end = len(data) - 1
+        start = int(start)
+        end = min(int(end), len(data) - 1)
+        content_range = "bytes %d-%d/%d" % (start, end, len(data))
+        return cloudlet_http.HTTPResult(
+            206, "Partial Content", {"content-range": content_range},
+            data[start:end + 1])
+
+
+class OverlayReaderTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(OverlayReaderTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.overlay_path = os.path.join(self.tmpdir, "overlay.zip")
+        self.contents = _make_overlay(self.overlay_path)
+        self.server = FakeRangeServer({"cloudlet": self.overlay_path})
+        self.stubs.Set(cloudlet_http, "request", self.server.request)
+
+    def test_get_members(self):
+        reader = cloudlet_overlay.OverlayReader("file://" + self.overlay_path)
+        members = reader.get_members()
+        self.assertEqual(set([META] + BLOBS), set(members.keys()))
+        self.assertEqual(cloudlet_overlay.ZIP_DEFLATED, members[META].method)
+        for name in BLOBS:
+            self.assertEqual(cloudlet_overlay.ZIP_STORED,
+                             members[name].method)
+            self.assertEqual(len(self.contents[name]), members[name].size)
+
+    def test_read_member(self):
+        reader = cloudlet_overlay.OverlayReader("file://" + self.overlay_path)
+        for name in [META] + BLOBS:
+            self.assertEqual(self.contents[name], reader.read_member(name))
+
+    def test_read_member_missing(self):
+        reader = cloudlet_overlay.OverlayReader("file://" + self.overlay_path)
+        self.assertRaises(cloudlet_overlay.OverlayReaderError,
+                          reader.read_member, "overlay-blob_3.xz")
+
+    def test_central_directory_out_of_tail(self):
+        self.stubs.Set(cloudlet_overlay, "TAIL_SIZE", 64)
+        reader = cloudlet_overlay.OverlayReader("http://cloudlet/overlay.zip")
+        self.assertEqual(self.contents[META], reader.read_member(META))
+        # tail, central directory, and the member
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_not_zip(self):
+        with open(self.overlay_path, "wb") as f:
+            f.write("not a zip file")
+        reader = cloudlet_overlay.OverlayReader("file://" + self.overlay_path)
+        self.assertRaises(cloudlet_overlay.OverlayReaderError,
+                          reader.get_members)
+
+    def test_read_member_with_range_requests(self):
+        reader = cloudlet_overlay.OverlayReader("http://cloudlet/overlay.zip")
+        self.assertEqual(self.contents[BLOBS[1]],
+                         reader.read_member(BLOBS[1]))
+        self.assertEqual(os.path.getsize(self.overlay_path), reader.size)
+        for (netloc, byte_range) in self.server.requests:
+            self.assertTrue(byte_range.startswith("bytes="))
+
+    def test_range_not_supported(self):
+        whole_file = cloudlet_http.HTTPResult(200, "OK", {}, "")
+        self.stubs.Set(cloudlet_http, "request",
+                       mock.Mock(return_value=whole_file))
+        reader = cloudlet_overlay.OverlayReader("http://cloudlet/overlay.zip")
+        self.assertRaises(cloudlet_overlay.RangeNotSupported,
+                          reader.read_member, META)
+
+    def test_record_ranges_cover_zip(self):
+        reader = cloudlet_overlay.OverlayReader("file://" + self.overlay_path)
+        ranges = reader.get_record_ranges(order=[BLOBS[1]])
+        self.assertEqual(reader.members[BLOBS[1]].header_offset,
+                         ranges[0][0])
+        covered = sum(end - start for (start, end) in ranges)
+        self.assertEqual(os.path.getsize(self.overlay_path), covered)
+        self.assertEqual(reader.size, ranges[-1][1])
+
+    def test_copy_to(self):
+        self.stubs.Set(cloudlet_overlay, "SEGMENT_SIZE", 1000)
+        with open(self.overlay_path, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        dest_path = os.path.join(self.tmpdir, "copy.zip")
+        reader = cloudlet_overlay.OverlayReader("http://cloudlet/overlay.zip")
+        size = reader.copy_to(dest_path, order=BLOBS, concurrency=3,
+                              sha256=sha256)
+        self.assertEqual(os.path.getsize(self.overlay_path), size)
+        with open(self.overlay_path, "rb") as f:
+            original = f.read()
+        with open(dest_path, "rb") as f:
+            self.assertEqual(original, f.read())
+
+    def test_copy_to_integrity_error(self):
+        dest_path = os.path.join(self.tmpdir, "copy.zip")
+        reader = cloudlet_overlay.OverlayReader("http://cloudlet/overlay.zip")
+        self.assertRaises(cloudlet_overlay.OverlayIntegrityError,
+                          reader.copy_to, dest_path,
+                          sha256=hashlib.sha256("other").hexdigest())
+
+    def test_mirror_failover(self):
+        self.server.files["broken"] = None
+        reader = cloudlet_overlay.OverlayReader(
+            "http://broken/overlay.zip", ["http://cloudlet/overlay.zip"])
+        self.assertEqual(self.contents[META], reader.read_member(META))
+        self.assertIn(0, reader.failed)
+
+    def test_file_mirror_rejected(self):
+        self.assertRaises(cloudlet_overlay.OverlayReaderError,
+                          cloudlet_overlay.OverlayReader,
+                          "http://cloudlet/overlay.zip",
+                          ["file://" + self.overlay_path])
@@ -0,0 +1,140 @@
+# Elijah: Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2014 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import json
+
+import mock
+
+from nova.scheduler import cloudlet_scheduler
+from nova import test
+
+
+IMAGE_ID = "base-disk"
+OVERLAY_URL = "http://storage/overlay.zip"
+
+
+def _request(image_id=IMAGE_ID, overlay_url=OVERLAY_URL,
+             cloudlet_type=cloudlet_scheduler.CLOUDLET_TYPE.
+             IMAGE_TYPE_BASE_DISK):
+    properties = dict()
+    if cloudlet_type is not None:
+        properties[cloudlet_scheduler.CLOUDLET_TYPE.
+                   PROPERTY_KEY_CLOUDLET_TYPE] = cloudlet_type
+    metadata = dict()
+    if overlay_url is not None:
+        metadata['overlay_url'] = overlay_url
+    return {'request_spec': {
+        'image': {'id': image_id, 'properties': properties},
+        'instance_properties': {'metadata': metadata}}}
+
+
+class CloudletCacheTestCase(test.NoDBTestCase):
+
+    def setUp(self):
+        super(CloudletCacheTestCase, self).setUp()
+        self.flags(cloudlet_cache_weight_multiplier=10.0,
+                   cloudlet_cache_overlay_weight=0.5,
+                   cloudlet_cache_weigher_strategy='cached',
+                   cloudlet_cache_stale_time=300)
+        self.now = 1000.0
+        self.stubs.Set(cloudlet_scheduler.time, "time", lambda: self.now)
+        self.stubs.Set(cloudlet_scheduler, "_unreported_hosts", set())
+        self.weigher = cloudlet_scheduler.CloudletCacheWeigher()
+        self.filter = cloudlet_scheduler.CloudletCacheFilter()
+
+    def _host(self, bases=None, overlays=None, updated_at=None,
+              report=None, num_io_ops=0):
+        stats = dict()
+        if report is None and bases is not None:
+            report = json.dumps({
+                'bases': [hashlib.sha1(base).hexdigest() for base in bases],
+                'overlays': [hashlib.sha1(url).hexdigest()
+                             for url in overlays or []],
+                't': self.now if updated_at is None else updated_at})
+        if report is not None:
+            stats[cloudlet_scheduler.CLOUDLET_TYPE.STATS_KEY_CACHE] = report
+        return mock.Mock(host="compute", stats=stats, num_io_ops=num_io_ops)
+
+    def _weigh(self, host_state, request=None):
+        return self.weigher._weigh_object(host_state, request or _request())
+
+    def _passes(self, host_state, request=None):
+        return self.filter.host_passes(host_state, request or _request())
+
+    def test_base_hit(self):
+        host_state = self._host(bases=[IMAGE_ID])
+        self.assertEqual(1.0, self._weigh(host_state))
+        self.assertTrue(self._passes(host_state))
+
+    def test_overlay_hit(self):
+        host_state = self._host(bases=[IMAGE_ID], overlays=[OVERLAY_URL])
+        self.assertEqual(1.5, self._weigh(host_state))
+        # an overlay without its base VM does not count
+        host_state = self._host(bases=[], overlays=[OVERLAY_URL])
+        self.assertEqual(0.0, self._weigh(host_state))
+
+    def test_base_miss(self):
+        host_state = self._host(bases=["other-disk"])
+        self.assertEqual(0.0, self._weigh(host_state))
+        self.assertFalse(self._passes(host_state))
+
+    def test_load_aware(self):
+        self.flags(cloudlet_cache_weigher_strategy='load_aware')
+        host_state = self._host(bases=[IMAGE_ID], num_io_ops=3)
+        self.assertEqual(0.25, self._weigh(host_state))
+
+    def test_not_cloudlet_request(self):
+        request = _request(cloudlet_type=None)
+        host_state = self._host(bases=[])
+        self.assertEqual(0.0, self._weigh(host_state, request))
+        self.assertTrue(self._passes(host_state, request))
+
+    def test_no_report_is_neutral(self):
+        host_state = self._host()
+        with mock.patch.object(cloudlet_scheduler.LOG,
+                               "warning") as warning:
+            self.assertEqual(0.0, self._weigh(host_state))
+            self.assertTrue(self._passes(host_state))
+        # warned once per host
+        self.assertEqual(1, warning.call_count)
+
+    def test_no_stats_is_neutral(self):
+        host_state = mock.Mock(host="compute", stats=None)
+        self.assertIsNone(cloudlet_scheduler.get_cache_report(host_state))
+        self.assertTrue(self._passes(host_state))
+
+    def test_malformed_report_is_neutral(self):
+        for report in ["not json", "[1, 2]", "null"]:
+            host_state = self._host(report=report)
+            self.assertIsNone(
+                cloudlet_scheduler.get_cache_report(host_state))
+            self.assertEqual(0.0, self._weigh(host_state))
+            self.assertTrue(self._passes(host_state))
+
+    def test_stale_report_is_neutral(self):
+        host_state = self._host(bases=["other-disk"],
+                                updated_at=self.now - 301)
+        self.assertIsNone(cloudlet_scheduler.get_cache_report(host_state))
+        self.assertTrue(self._passes(host_state))
+
+    def test_report_recovers(self):
+        self.assertIsNone(cloudlet_scheduler.get_cache_report(self._host()))
+        self.assertIn("compute", cloudlet_scheduler._unreported_hosts)
+        host_state = self._host(bases=[IMAGE_ID])
+        self.assertIsNotNone(cloudlet_scheduler.get_cache_report(host_state))
+        self.assertNotIn("compute", cloudlet_scheduler._unreported_hosts)